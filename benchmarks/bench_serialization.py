@@ -0,0 +1,55 @@
+"""Micro-benchmark of payload serialization: building a dict and encoding it with `json.dumps` on every post, against
+splicing the message into each Messenger's precompiled payload template.
+
+Run from the root of the repository with `python -m benchmarks.bench_serialization`.
+"""
+
+
+# import built-in modules
+import argparse
+import json
+import timeit
+
+# import local modules
+from eruption import eruption
+
+
+MESSAGE = 'Deploy of eruption 1.0.0 to production finished in 42.1s'
+
+
+def build_and_dump(instance, message):
+    """Serialize the way every post did before templates were precompiled."""
+    data = dict([(instance.text_key, message)] + list(instance.payload_defaults))
+    return json.dumps(data).encode('utf-8')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--number', type=int, default=200000, help='Payloads serialized per measurement.')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='Measurements taken, the best one is kept.')
+    arguments = parser.parse_args()
+
+    instances = [
+        eruption.Slack(room_id='room', token='token', channel='channel'),
+        eruption.HipChat(room_id='room', token='token'),
+        eruption.Mattermost(token='token', base_url='localhost'),
+        eruption.RocketChat(base_url='localhost', token='token'),
+        eruption.Discord(room_id='room', token='token')
+    ]
+
+    print('{0:<12} {1:>14} {2:>14} {3:>8}'.format('messenger', 'json.dumps', 'template', 'speedup'))
+    for instance in instances:
+        assert instance._process_data(MESSAGE) == build_and_dump(instance, MESSAGE)
+        baseline = min(timeit.repeat(
+            lambda: build_and_dump(instance, MESSAGE), number=arguments.number, repeat=arguments.repeat))
+        template = min(timeit.repeat(
+            lambda: instance._process_data(MESSAGE), number=arguments.number, repeat=arguments.repeat))
+        print('{0:<12} {1:>11.0f} ns {2:>11.0f} ns {3:>7.1f}x'.format(
+            type(instance).__name__,
+            baseline / arguments.number * 1e9,
+            template / arguments.number * 1e9,
+            baseline / template))
+
+
+if __name__ == '__main__':
+    main()
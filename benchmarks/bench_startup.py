@@ -0,0 +1,85 @@
+"""Startup-time benchmark of the command line: how long the interpreter takes to get to the point of posting, and how
+long loading the configuration takes with and without its compiled cache.
+
+Run from the root of the repository with `python -m benchmarks.bench_startup`.
+"""
+
+
+# import built-in modules
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+# import local modules
+from eruption import config
+
+
+CONFIGURATION = """
+[eruption]
+user_name = deploy-bot
+icon = :rocket:
+
+[rocketchat]
+base_url = chat.example.com
+token = abc123
+channel = #deploys
+
+[slack]
+room_id = B0000
+channel = T0000
+token = xyz789
+"""
+
+
+def time_command(arguments, runs, environment):
+    """Run a command repeatedly and get the median wall time of a run, in milliseconds."""
+    timings = []
+    for _ in range(runs):
+        start = time.time()
+        subprocess.check_call(arguments, stdout=subprocess.DEVNULL, env=environment)
+        timings.append((time.time() - start) * 1000)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-r', '--runs', type=int, default=20, help='Runs of each command, the median is kept.')
+    arguments = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'eruption.cfg')
+        with open(path, 'w') as configuration:
+            configuration.write(CONFIGURATION)
+        environment = dict(os.environ, XDG_CACHE_HOME=directory, ERUPTION_CONFIG=path)
+
+        commands = [
+            ('interpreter', [sys.executable, '-c', 'pass']),
+            ('import eruption', [sys.executable, '-c', 'import eruption.eruption']),
+            ('import requests', [sys.executable, '-c', 'import requests']),
+            ('eruption --help', [sys.executable, '-m', 'eruption.cli', '--help']),
+            ('eruption rocketchat --help', [sys.executable, '-m', 'eruption.cli', 'rocketchat', '--help'])
+        ]
+        print('{0:<28} {1:>10}'.format('command', 'median'))
+        for name, command in commands:
+            print('{0:<28} {1:>7.1f} ms'.format(name, time_command(command, arguments.runs, environment)))
+
+        config.CACHE_DIRECTORY = os.path.join(directory, 'eruption')
+        number = 1000
+        parsed = min(timeit.repeat(lambda: config.load(path, use_cache=False), number=number, repeat=5))
+        config.load(path)
+        cached = min(timeit.repeat(lambda: config.load(path), number=number, repeat=5))
+        print('{0:<28} {1:>7.1f} us'.format('parse configuration', parsed / number * 1e6))
+        print('{0:<28} {1:>7.1f} us'.format('cached configuration', cached / number * 1e6))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,262 @@
+"""Benchmark suite for eruption, run against the local stand-in webhook server in `benchmarks.server`.
+
+Measures the throughput, p50/p99 latency and peak traced memory of posting with every Messenger subclass, through
+the decorators, and sequentially against concurrently. The results can be written as JSON and compared against the
+results of an earlier run, such as the previous release.
+
+Run from the root of the repository with `python -m benchmarks.run --output results.json`, and later
+`python -m benchmarks.run --compare results.json`.
+"""
+
+
+# import built-in modules
+import argparse
+import asyncio
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from concurrent import futures
+
+# import local modules
+from eruption import delivery
+from eruption import eruption
+from benchmarks.server import WebhookServer
+
+try:
+    from eruption import aio
+except ImportError:  # aiohttp isn't installed
+    aio = None
+
+
+SCHEMA_VERSION = 1
+
+
+def make_instances(server):
+    """Create one instance of every Messenger subclass, pointed at the stand-in server and without rate limits, since
+    they would measure the limiter instead of eruption.
+
+    Returns:
+        list:
+    """
+    return [
+        eruption.Slack(room_id='B0000', token='token', channel='T0000', rate_limit=None,
+                       url_template=server.url_template('slack')),
+        eruption.Discord(room_id='1234', token='token', rate_limit=None, url_template=server.url_template('discord')),
+        eruption.HipChat(room_id='1234', token='token', rate_limit=None, url_template=server.url_template('hipchat')),
+        eruption.Mattermost(token='token', base_url=server.address, rate_limit=None),
+        eruption.RocketChat(base_url=server.address, token='token', rate_limit=None)
+    ]
+
+
+def failed(result):
+    return result is None or getattr(result, 'status_code', getattr(result, 'status', 0)) >= 400
+
+
+def timed(function, *args, **kwargs):
+    """Call a function and time it.
+
+    Returns:
+        tuple: The seconds the call took, and whether it failed.
+    """
+    start = time.perf_counter()
+    try:
+        is_failed = failed(function(*args, **kwargs))
+    except Exception:
+        is_failed = True
+    return time.perf_counter() - start, is_failed
+
+
+def sequential(instance):
+    def scenario(count, concurrency):
+        return [timed(instance.post, 'Benchmark message {0}'.format(index)) for index in range(count)]
+    return scenario
+
+
+def concurrent(instance):
+    def scenario(count, concurrency):
+        with futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+            return list(executor.map(
+                lambda index: timed(instance.post, 'Benchmark message {0}'.format(index)), range(count)))
+    return scenario
+
+
+def asynchronous(instance):
+    def scenario(count, concurrency):
+        async def run():
+            semaphore = asyncio.Semaphore(concurrency)
+
+            async def post(index):
+                async with semaphore:
+                    start = time.perf_counter()
+                    try:
+                        is_failed = failed(await instance.post('Benchmark message {0}'.format(index)))
+                    except Exception:
+                        is_failed = True
+                    return time.perf_counter() - start, is_failed
+
+            try:
+                return await asyncio.gather(*[post(index) for index in range(count)])
+            finally:
+                await aio.close_async_sessions()
+        return asyncio.run(run())
+    return scenario
+
+
+def decorated(decorator):
+    def scenario(count, concurrency):
+        @decorator
+        def job(index):
+            return index
+
+        return [timed(job, index) for index in range(count)]
+    return scenario
+
+
+def background(instance):
+    def scenario(count, concurrency):
+        @eruption.messenger('Benchmark message', instance, background=True)
+        def job(index):
+            return index
+
+        timings = [timed(job, index) for index in range(count)]
+        delivery.flush()
+        return timings
+    return scenario
+
+
+def broadcast(instances):
+    def scenario(count, concurrency):
+        with eruption.Broadcaster(instances) as broadcaster:
+            timings = []
+            for index in range(count):
+                start = time.perf_counter()
+                results = broadcaster.post('Benchmark message {0}'.format(index))
+                is_failed = any(result.error is not None or failed(result.response) for result in results)
+                timings.append((time.perf_counter() - start, is_failed))
+            return timings
+    return scenario
+
+
+def scenarios(server):
+    """Get the benchmarks to run.
+
+    Returns:
+        list: Pairs of the name of a benchmark and its scenario.
+    """
+    instances = make_instances(server)
+    rocketchat = instances[-1]
+    found = [('post/{0}'.format(type(instance).__name__), sequential(instance)) for instance in instances]
+    found.extend([
+        ('post/sequential', sequential(rocketchat)),
+        ('post/concurrent', concurrent(rocketchat)),
+        ('decorator/messenger', decorated(eruption.rocketchat('Benchmark message', rocketchat))),
+        ('decorator/post_to_rocketchat', decorated(eruption.post_to_rocketchat(
+            'Benchmark message', base_url=server.address, token='token'))),
+        ('decorator/background', background(rocketchat)),
+        ('broadcast/{0}-targets'.format(len(instances)), broadcast(instances))
+    ])
+    if aio is not None:
+        found.append(('post/async', asynchronous(aio.AsyncRocketChat(base_url=server.address, token='token'))))
+    return found
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(int(round(fraction * (len(ordered) - 1))), len(ordered) - 1)]
+
+
+def measure(name, scenario, count, concurrency):
+    """Run a scenario twice, once timed and once under tracemalloc for its peak memory.
+
+    Returns:
+        dict: The results of the scenario.
+    """
+    start = time.perf_counter()
+    timings = scenario(count, concurrency)
+    seconds = time.perf_counter() - start
+    latencies = [latency for latency, _ in timings]
+
+    tracemalloc.start()
+    try:
+        scenario(count, concurrency)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'name': name,
+        'messages': count,
+        'errors': sum(1 for _, is_failed in timings if is_failed),
+        'seconds': seconds,
+        'throughput': count / seconds,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'peak_memory_kb': peak / 1024.0
+    }
+
+
+def compare(results, baseline):
+    """Print how the results changed against a baseline run."""
+    previous = dict((result['name'], result) for result in baseline['results'])
+    print('\n{0:<32} {1:>12} {2:>12}'.format('change against baseline', 'throughput', 'p99'))
+    for result in results:
+        old = previous.get(result['name'])
+        if old is None:
+            continue
+        print('{0:<32} {1:>+11.1f}% {2:>+11.1f}%'.format(
+            result['name'],
+            (result['throughput'] / old['throughput'] - 1) * 100,
+            (result['p99_ms'] / old['p99_ms'] - 1) * 100 if old['p99_ms'] else 0.0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--messages', type=int, default=500, help='Messages posted per benchmark.')
+    parser.add_argument('-c', '--concurrency', type=int, default=8, help='Posts in flight for concurrent ones.')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds the server delays every response.')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Most extra seconds a response is delayed by.')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of posts the server fails.')
+    parser.add_argument('--rate-limit', type=float, default=None, help='Posts per second before the server 429s.')
+    parser.add_argument('-k', '--filter', default='', help='Only run the benchmarks whose name contains this.')
+    parser.add_argument('-o', '--output', help='Write the results to this JSON file.')
+    parser.add_argument('--compare', help='Compare the results against this earlier JSON file.')
+    arguments = parser.parse_args()
+
+    server = WebhookServer(
+        latency=arguments.latency,
+        jitter=arguments.jitter,
+        error_rate=arguments.error_rate,
+        rate_limit=arguments.rate_limit,
+        retry_after=0.1)
+    with server:
+        results = []
+        print('{0:<32} {1:>10} {2:>9} {3:>9} {4:>11} {5:>7}'.format(
+            'benchmark', 'msg/s', 'p50 ms', 'p99 ms', 'memory KiB', 'errors'))
+        for name, scenario in scenarios(server):
+            if arguments.filter not in name:
+                continue
+            result = measure(name, scenario, arguments.messages, arguments.concurrency)
+            results.append(result)
+            print('{name:<32} {throughput:>10.1f} {p50_ms:>9.2f} {p99_ms:>9.2f} {peak_memory_kb:>11.1f} '
+                  '{errors:>7}'.format(**result))
+
+    report = {
+        'schema': SCHEMA_VERSION,
+        'timestamp': time.time(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'settings': vars(arguments),
+        'results': results
+    }
+    if arguments.output:
+        with open(arguments.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    if arguments.compare:
+        with open(arguments.compare) as baseline:
+            compare(results, json.load(baseline))
+
+
+if __name__ == '__main__':
+    main()
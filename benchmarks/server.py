@@ -0,0 +1,197 @@
+"""Local stand-in for the chat services' webhook endpoints, for benchmarking without touching the real services.
+
+Every service is served from the same port, told apart by its path the way the real ones are, and answers the way the
+real one does on success. Latency, errors and rate limiting can be configured to see how eruption behaves when the
+chat server is slow, flaky or throttling.
+
+Run on its own with `python -m benchmarks.server --port 8065 --latency 0.01`.
+"""
+
+
+# import built-in modules
+import argparse
+import random
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:  # pragma: no cover
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+
+# The path each service posts to, as url templates relative to the server, and how it answers a successful post.
+SERVICES = {
+    'slack': ('/services/{channel}/{room_id}/{token}', 200, b'ok'),
+    'discord': ('/api/webhooks/{room_id}/{token}', 204, b''),
+    'hipchat': ('/v2/room/{room_id}/notification', 204, b''),
+    'mattermost': ('/hooks/{token}', 200, b'ok'),
+    'rocketchat': ('/hooks/{token}', 200, b'{"success":true}')
+}
+
+
+def _service(path):
+    if path.startswith('/services/'):
+        return 'slack'
+    if path.startswith('/api/webhooks/'):
+        return 'discord'
+    if path.startswith('/v2/room/'):
+        return 'hipchat'
+    return 'rocketchat'
+
+
+class WebhookServer(ThreadingMixIn, HTTPServer):
+    """A threaded HTTP server that behaves like the services' webhook endpoints.
+
+    Args:
+        host (str): The address to listen on.
+        port (int): The port to listen on, 0 picks a free one.
+        latency (float): The seconds every response is delayed by.
+        jitter (float): The most extra seconds, picked at random, a response is delayed by.
+        error_rate (float): The fraction of posts answered with a 500.
+        rate_limit (float): The posts per second allowed before answering with a 429, or None for no limit.
+        retry_after (float): The seconds a 429 asks to wait.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0, error_rate=0.0, rate_limit=None,
+                 retry_after=1.0):
+        HTTPServer.__init__(self, (host, port), WebhookHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.counts = {}
+        self._lock = threading.Lock()
+        self._window_start = time.time()
+        self._window_count = 0
+        self._thread = None
+
+    @property
+    def address(self):
+        """str: The host and port of the server, as used by a Messenger's base url."""
+        return '{0}:{1}'.format(*self.server_address[:2])
+
+    def url_template(self, service):
+        """Get the url template that points a service's Messenger at this server.
+
+        Args:
+            service (str): The name of the service, one of SERVICES.
+
+        Returns:
+            str:
+        """
+        return 'http://{0}{1}'.format(self.address, SERVICES[service][0])
+
+    def count(self, status):
+        with self._lock:
+            self.counts[status] = self.counts.get(status, 0) + 1
+
+    def throttled(self):
+        """Count a post against the rate limit.
+
+        Returns:
+            bool: Whether the post goes over the rate limit.
+        """
+        if self.rate_limit is None:
+            return False
+        with self._lock:
+            now = time.time()
+            if now - self._window_start >= 1.0:
+                self._window_start, self._window_count = now, 0
+            self._window_count += 1
+            return self._window_count > self.rate_limit
+
+    def start(self):
+        """Serve from a daemon thread.
+
+        Returns:
+            WebhookServer: This server.
+        """
+        self._thread = threading.Thread(target=self.serve_forever, kwargs={'poll_interval': 0.05})
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving and close the socket."""
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    # The headers and the body are written separately, which Nagle's algorithm would hold back for a delayed ack.
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        server = self.server
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        delay = server.latency + (random.random() * server.jitter if server.jitter else 0)
+        if delay:
+            time.sleep(delay)
+
+        headers = {}
+        if server.throttled():
+            status, body = 429, b'{"message": "You are being rate limited."}'
+            headers['Retry-After'] = str(server.retry_after)
+        elif server.error_rate and random.random() < server.error_rate:
+            status, body = 500, b'internal error'
+        else:
+            _, status, body = SERVICES[_service(self.path)]
+        server.count(status)
+
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8065)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds every response is delayed by.')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Most extra seconds a response is delayed by.')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of posts answered with a 500.')
+    parser.add_argument('--rate-limit', type=float, default=None, help='Posts per second allowed before a 429.')
+    parser.add_argument('--retry-after', type=float, default=1.0, help='Seconds a 429 asks to wait.')
+    arguments = parser.parse_args()
+
+    server = WebhookServer(
+        host=arguments.host,
+        port=arguments.port,
+        latency=arguments.latency,
+        jitter=arguments.jitter,
+        error_rate=arguments.error_rate,
+        rate_limit=arguments.rate_limit,
+        retry_after=arguments.retry_after)
+    print('Serving webhooks on http://{0}'.format(server.address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print('Responses by status: {0}'.format(server.counts))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,362 @@
+"""Asyncio counterparts of the Messenger family, for posting from inside an event loop without blocking it. The
+payloads are built by the same `_process_data` as the blocking classes, and go through the same rate limiting,
+retries, circuit breaking, deduplication, coalescing, outbox and relay, over a pooled aiohttp session that is shared
+by every instance running on the same loop.
+
+Requires aiohttp, which can be installed with the `async` extra.
+"""
+
+
+# import built-in modules
+import asyncio
+import functools
+import logging
+import sys
+
+# import 3rd party modules
+import aiohttp
+
+# import local modules
+from eruption import chunking
+from eruption import eruption
+from eruption import exceptions
+from eruption import metrics
+from eruption import retry
+
+__all__ = [
+    'AsyncMessenger',
+    'AsyncSlack',
+    'AsyncHipChat',
+    'AsyncMattermost',
+    'AsyncRocketChat',
+    'AsyncDiscord',
+    'AsyncSessionPool',
+    'get_async_session_pool',
+    'close_async_sessions'
+]
+
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CONCURRENCY = 10
+
+LOGGER = logging.getLogger(__name__)
+
+
+class AsyncSessionPool(object):
+    """Registry of `aiohttp.ClientSession` objects, one per event loop, each holding a keep-alive connection pool.
+
+    Args:
+        pool_size (int): The maximum number of connections kept open per host.
+        keep_alive (bool): Whether connections should be kept open between posts.
+    """
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, keep_alive=True):
+        self.pool_size = pool_size
+        self.keep_alive = keep_alive
+        # The loop and its session by the id of the loop. Sessions hold on to their loop, so keying them by the loop
+        # itself, even weakly, would keep every loop alive.
+        self._sessions = {}
+
+    def get(self):
+        """Get the session for the running event loop, creating it on first use.
+
+        Returns:
+            aiohttp.ClientSession:
+        """
+        loop = asyncio.get_running_loop()
+        entry = self._sessions.get(id(loop))
+        if entry is not None and entry[0] is loop and not entry[1].closed:
+            return entry[1]
+        self._forget_closed_loops()
+        connector = aiohttp.TCPConnector(
+            limit_per_host=self.pool_size,
+            force_close=not self.keep_alive)
+        session = aiohttp.ClientSession(connector=connector)
+        self._sessions[id(loop)] = (loop, session)
+        return session
+
+    def _forget_closed_loops(self):
+        # The sessions of loops that were closed without closing them first can't be closed anymore, only let go of.
+        for key, (loop, _) in list(self._sessions.items()):
+            if loop.is_closed():
+                self._sessions.pop(key, None)
+
+    async def close(self):
+        """Close the session belonging to the running event loop, if there is one."""
+        entry = self._sessions.pop(id(asyncio.get_running_loop()), None)
+        if entry is not None:
+            await entry[1].close()
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+_default_pool = AsyncSessionPool()
+
+
+def get_async_session_pool():
+    """Get the process-wide AsyncSessionPool.
+
+    Returns:
+        AsyncSessionPool:
+    """
+    return _default_pool
+
+
+async def close_async_sessions():
+    """Close the process-wide pooled session of the running event loop. Should be awaited before the loop shuts down."""
+    await _default_pool.close()
+
+
+def _unpack(message):
+    """Split an item given to `post_many` into the arguments for `post`.
+
+    Args:
+        message (str|tuple): Either the message to post, or a pair of the message and a dict of payload overrides.
+
+    Returns:
+        tuple: The positional and keyword arguments.
+    """
+    if isinstance(message, tuple):
+        text, overrides = message
+        return (text,), dict(overrides or {})
+    return (message,), {}
+
+
+def _is_transient(error):
+    """Check whether a post that raised is worth sending again, like `retry.is_transient` does for blocking posts.
+
+    Args:
+        error (Exception): What the post raised.
+
+    Returns:
+        bool: Whether it failed to connect, or timed out connecting.
+    """
+    return isinstance(error, (aiohttp.ClientConnectorError, getattr(aiohttp, 'ConnectionTimeoutError', ())))
+
+
+class AsyncMessenger(eruption.Messenger):
+    """Mixin that makes a Messenger post through asyncio. Takes the same arguments as the Messenger it's mixed into,
+    where `session` is an `aiohttp.ClientSession` and `session_pool` is an AsyncSessionPool.
+
+    Coalesced posts and the summaries of deduplicated ones are sent on the event loop the instance last posted from.
+    """
+
+    concurrency = DEFAULT_CONCURRENCY
+    _loop = None
+
+    def get_session(self, url=None):
+        """Get the session to post with. Must be called from inside a running event loop.
+
+        Args:
+            url (str): The url that will be posted to. Every url of the loop shares the same session.
+
+        Returns:
+            aiohttp.ClientSession: The session given to this instance, otherwise the pooled one for the running loop.
+        """
+        if self.session is not None:
+            return self.session
+        pool = self.session_pool if self.session_pool is not None else _default_pool
+        return pool.get()
+
+    async def post(self, *args, **kwargs):
+        # Posts are tasks on the event loop rather than calls queued on the background sender, so there's no lane to
+        # queue them in.
+        kwargs.pop('priority', None)
+        self._loop = asyncio.get_running_loop()
+        if self._hold(args[0], kwargs):
+            return None
+        if self._is_too_long(args[0]):
+            return (await self.post_chunks(args[0], **kwargs))[-1]
+        return await self._send(self._process_data(*args, **kwargs))
+
+    async def post_chunks(self, source, **kwargs):
+        """Post text that may be too long for one post in chunks, like `Messenger.post_chunks` does. `post` does this
+        by itself for text that is too long.
+
+        Args:
+            source (str|iterable): The text, or an iterable of pieces of it. Iterables are read on the event loop, so
+                they shouldn't block on reads the way file objects do.
+            **kwargs: Any overriding information for the payloads.
+
+        Returns:
+            list: The response of every chunk posted.
+        """
+        results = []
+        for chunk in chunking.split(source, self.max_text_length or sys.maxsize):
+            result = await self._send(self._process_data(chunk, **kwargs))
+            results.append(result)
+            if result is not None and result.status >= 400:
+                break
+        return results
+
+    def _post_coalesced(self, message, overrides):
+        # Called by the coalescer and the deduplicator, from their timers as well as from the loop, and so hands the
+        # post over to the loop instead of sending it.
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            LOGGER.warning('Dropped a post of %s, the event loop it was posted from is closed.', type(self).__name__)
+            return
+        loop.call_soon_threadsafe(self._start_post, message, overrides)
+
+    def _start_post(self, message, overrides):
+        if self._is_too_long(message):
+            post = self.post_chunks(message, **overrides)
+        else:
+            post = self._send(self._process_data(message, **overrides))
+        eruption._track(asyncio.ensure_future(eruption._post_async(post)))
+
+    async def _send(self, data):
+        """Post an already processed payload.
+
+        Args:
+            data (bytes): The payload, as returned by `_process_data`.
+
+        Returns:
+            aiohttp.ClientResponse: None if the payload was handed to a relay.
+        """
+        loop = asyncio.get_running_loop()
+        if self.relay is not None:
+            try:
+                await loop.run_in_executor(None, self.relay.post, self, data)
+                return None
+            except (IOError, OSError) as error:
+                LOGGER.warning('Posting directly, the relay at %s is unreachable: %s', self.relay.path, error)
+
+        if self.outbox is None:
+            return await self._post_data(data)
+
+        # The outbox writes, and syncs to disk, from the executor rather than the loop.
+        record_id = await loop.run_in_executor(None, self.outbox.put, self.room_url, self.headers, data)
+        try:
+            result = await self._post_data(data)
+        except Exception as error:
+            await loop.run_in_executor(None, self.outbox.release, record_id, str(error))
+            raise
+        await loop.run_in_executor(None, self.outbox.settle, record_id, result.status)
+        return result
+
+    async def _post_data(self, data):
+        breaker = self.get_circuit_breaker()
+        if breaker is not None and not breaker.allow():
+            if metrics.enabled:
+                metrics.increment('circuit_open_total', metrics.labels(self))
+            raise exceptions.CircuitOpenError(self.room_url, breaker.retry_after())
+
+        bucket = self.get_rate_limiter()
+        session = self.get_session()
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        retries = rate_limited = 0
+        while True:
+            if bucket is not None:
+                await bucket.acquire_async()
+            if metrics.enabled:
+                start = metrics.clock()
+            try:
+                async with session.post(self.room_url, data=data, headers=self.headers, timeout=timeout) as result:
+                    await result.read()
+            except Exception as error:
+                if metrics.enabled:
+                    metrics.increment('errors_total', metrics.labels(self))
+                if breaker is not None:
+                    breaker.record_failure()
+                if not _is_transient(error) or not self._should_retry(retries, breaker):
+                    raise
+                retries += 1
+                await asyncio.sleep(retry.backoff(retries, *self.retry_backoff))
+                continue
+
+            if bucket is not None and bucket.observe(result) and rate_limited < self.rate_limit_retries:
+                rate_limited += 1
+                continue
+            if breaker is not None:
+                if result.status >= 500:
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
+            if result.status in retry.RETRY_STATUSES and self._should_retry(retries, breaker):
+                retries += 1
+                await asyncio.sleep(retry.backoff(retries, *self.retry_backoff))
+                continue
+            if metrics.enabled:
+                metrics.record_response(
+                    metrics.labels(self), result, metrics.clock() - start, len(data), retries + rate_limited)
+            return result
+
+    async def post_many(self, messages, concurrency=None):
+        """Post many messages concurrently.
+
+        Args:
+            messages (iterable): The messages to post. Each one is either a string, or a pair of a string and a dict
+                of payload overrides.
+            concurrency (int): The maximum number of posts in flight at once, defaults to the class's concurrency.
+
+        Returns:
+            list: The response for each message, in order. A post that failed has its exception in its place.
+        """
+        semaphore = asyncio.Semaphore(concurrency or self.concurrency)
+
+        async def post_one(message):
+            args, kwargs = _unpack(message)
+            async with semaphore:
+                return await self.post(*args, **kwargs)
+
+        return await asyncio.gather(*[post_one(message) for message in messages], return_exceptions=True)
+
+
+async def _upload(instance, blocking_class, *args, **kwargs):
+    """Upload a file with the `post_file` of a blocking class, from the default executor of the running loop, since
+    files are streamed from disk with blocking reads.
+
+    Args:
+        instance (AsyncMessenger): The instance to upload with.
+        blocking_class (type): The blocking class it is mixed into.
+        *args: The positional arguments for the upload.
+        **kwargs: The keyword arguments for the upload.
+
+    Returns:
+        requests.Response:
+    """
+    # A blocking copy of the instance, which uploads over the pooled sessions of the blocking classes rather than the
+    # aiohttp session, and shares its rate limiter and circuit breaker by url.
+    blocking = blocking_class.__new__(blocking_class)
+    blocking.__dict__.update(instance.__dict__)
+    blocking.session = None
+    blocking.session_pool = None
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(blocking.post_file, *args, **kwargs))
+
+
+class AsyncSlack(AsyncMessenger, eruption.Slack):
+
+    async def post_file(self, file, message=None, filename=None, title=None, channel_id=None, gzip=False):
+        """Upload a file and share it in a channel, like `Slack.post_file` does, without blocking the event loop.
+
+        Returns:
+            requests.Response: The response of completing the upload.
+        """
+        return await _upload(self, eruption.Slack, file, message=message, filename=filename, title=title,
+                             channel_id=channel_id, gzip=gzip)
+
+
+class AsyncHipChat(AsyncMessenger, eruption.HipChat):
+    pass
+
+
+class AsyncMattermost(AsyncMessenger, eruption.Mattermost):
+    pass
+
+
+class AsyncRocketChat(AsyncMessenger, eruption.RocketChat):
+    pass
+
+
+class AsyncDiscord(AsyncMessenger, eruption.Discord):
+
+    async def post_file(self, file, message=None, filename=None, gzip=False, **kwargs):
+        """Upload a file as an attachment of a message, like `Discord.post_file` does, without blocking the event loop.
+
+        Returns:
+            requests.Response:
+        """
+        return await _upload(self, eruption.Discord, file, message=message, filename=filename, gzip=gzip, **kwargs)
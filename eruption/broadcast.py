@@ -0,0 +1,152 @@
+"""Fan-out of one message to many Messenger targets at once. Each platform's payload is built once and then every
+target is posted to in parallel, so the total latency is that of the slowest target rather than the sum of them all.
+"""
+
+
+# import built-in modules
+import collections
+import threading
+import time
+from concurrent import futures
+
+__all__ = [
+    'Broadcaster',
+    'BroadcastResult'
+]
+
+
+MAX_WORKERS = 16
+
+
+BroadcastResult = collections.namedtuple('BroadcastResult', ['messenger', 'response', 'error', 'elapsed'])
+BroadcastResult.__doc__ = """The outcome of posting to one target of a broadcast.
+
+Args:
+    messenger (Messenger): The target that was posted to.
+    response (requests.Response): The response of the post, or None if it failed or timed out, or if the target's
+        deduplicator dropped the message or its coalescer took it to post later.
+    error (Exception): What went wrong, if anything. A `concurrent.futures.TimeoutError` when the broadcast stopped
+        waiting on the target, in which case the post carries on in the background.
+    elapsed (float): How many seconds the post took, or had taken when the broadcast stopped waiting on it.
+"""
+
+
+class Broadcaster(object):
+    """Holds many Messenger instances and posts the same message to all of them in parallel.
+
+    Args:
+        messengers (iterable): The Messenger instances to post to.
+        timeout (float): The most seconds to wait on the targets of a broadcast, or None to wait on all of them.
+        workers (int): The number of threads posting at once, defaults to one per target, up to MAX_WORKERS.
+    """
+
+    def __init__(self, messengers=(), timeout=None, workers=None):
+        self.messengers = list(messengers)
+        self.timeout = timeout
+        self.workers = workers
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def add(self, messenger):
+        """Add a target to post to.
+
+        Args:
+            messenger (Messenger): The Messenger instance to add.
+        """
+        self.messengers.append(messenger)
+
+    def remove(self, messenger):
+        """Stop posting to a target.
+
+        Args:
+            messenger (Messenger): The Messenger instance to remove.
+        """
+        self.messengers.remove(messenger)
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                workers = self.workers or min(max(len(self.messengers), 1), MAX_WORKERS)
+                self._executor = futures.ThreadPoolExecutor(max_workers=workers)
+            return self._executor
+
+    def post(self, *args, **kwargs):
+        """Post a message to every target.
+
+        Text that is too long for a target is posted to it in chunks, like its own post does, and the response of the
+        last chunk posted is the target's.
+
+        Args:
+            *args: The positional arguments for each target's post, usually just the message.
+            **kwargs: The payload overrides for each target's post.
+
+        Returns:
+            list: A BroadcastResult for each target, in the order of `messengers`.
+        """
+        messengers = list(self.messengers)
+        # Targets that deduplicate or coalesce get to drop or take the message first, like they do in their own post.
+        held = [messenger._hold(args[0], kwargs) for messenger in messengers]
+        chunked = [not is_held and messenger._is_too_long(args[0]) for messenger, is_held in zip(messengers, held)]
+        payloads = {}
+        for messenger, is_held, is_chunked in zip(messengers, held, chunked):
+            platform = self._platform(messenger)
+            if not is_held and not is_chunked and platform not in payloads:
+                payloads[platform] = messenger._process_data(*args, **kwargs)
+
+        executor = self._get_executor()
+        started = time.time()
+        pending = []
+        for messenger, is_held, is_chunked in zip(messengers, held, chunked):
+            if is_held:
+                pending.append(None)
+            elif is_chunked:
+                pending.append(executor.submit(self._send, messenger, self._post_chunks, messenger, args[0], kwargs))
+            else:
+                pending.append(executor.submit(
+                    self._send, messenger, messenger._send, payloads[self._platform(messenger)]))
+        futures.wait([future for future in pending if future is not None], timeout=self.timeout)
+
+        results = []
+        for messenger, future in zip(messengers, pending):
+            if future is None:
+                results.append(BroadcastResult(messenger, None, None, 0.0))
+            elif future.done():
+                results.append(future.result())
+            else:
+                error = futures.TimeoutError('Stopped waiting on {0}'.format(messenger.room_url))
+                results.append(BroadcastResult(messenger, None, error, time.time() - started))
+        return results
+
+    @staticmethod
+    def _platform(messenger):
+        # Targets of the same class with the same payload template get the same payload.
+        return type(messenger), getattr(messenger, 'payload_template', None)
+
+    @staticmethod
+    def _post_chunks(messenger, text, overrides):
+        return messenger.post_chunks(text, **overrides)[-1]
+
+    @staticmethod
+    def _send(messenger, function, *args):
+        start = time.time()
+        try:
+            response = function(*args)
+        except Exception as error:
+            return BroadcastResult(messenger, None, error, time.time() - start)
+        return BroadcastResult(messenger, response, None, time.time() - start)
+
+    def close(self):
+        """Stop the broadcast threads, once they are done with the posts already in flight."""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return len(self.messengers)
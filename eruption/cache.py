@@ -0,0 +1,94 @@
+"""Process-wide cache of Messenger instances, so that decorators which build their own instance from its
+configuration reuse a warm one instead of creating a new instance on every call.
+"""
+
+
+# import built-in modules
+import collections
+import threading
+import weakref
+
+# import local modules
+from eruption import forking
+
+__all__ = [
+    'CacheInfo',
+    'InstanceCache'
+]
+
+
+DEFAULT_MAXSIZE = 128
+
+_caches = weakref.WeakSet()
+
+
+CacheInfo = collections.namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+class InstanceCache(object):
+    """Thread-safe cache of Messenger instances keyed by their class and configuration, with LRU eviction.
+
+    Args:
+        maxsize (int): The most instances kept.
+    """
+
+    def __init__(self, maxsize=DEFAULT_MAXSIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._instances = collections.OrderedDict()
+        self._lock = threading.Lock()
+        _caches.add(self)
+
+    def get(self, cls, **config):
+        """Get the cached instance for a configuration, creating it on a miss.
+
+        Args:
+            cls (type): The Messenger class to instantiate.
+            **config: The arguments to instantiate it with.
+
+        Returns:
+            Messenger:
+        """
+        key = (cls, tuple(sorted(config.items())))
+        with self._lock:
+            instance = self._instances.get(key)
+            if instance is not None:
+                self.hits += 1
+                self._instances.move_to_end(key)
+                return instance
+            self.misses += 1
+        instance = cls(**config)
+        with self._lock:
+            # Another thread may have missed on the same key in the meantime, in which case the first one wins.
+            instance = self._instances.setdefault(key, instance)
+            self._instances.move_to_end(key)
+            while len(self._instances) > self.maxsize:
+                self._instances.popitem(last=False)
+        return instance
+
+    def info(self):
+        """Get the statistics of the cache.
+
+        Returns:
+            CacheInfo:
+        """
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.maxsize, len(self._instances))
+
+    def clear(self):
+        """Remove every instance and reset the statistics."""
+        with self._lock:
+            self._instances.clear()
+            self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self._instances)
+
+
+@forking.after_fork
+def _reset_after_fork():
+    # The cached instances are safe to share with the child, since their connections and queues are reset by the
+    # modules that own them.
+    for cache in list(_caches):
+        cache._lock = threading.Lock()
@@ -0,0 +1,170 @@
+"""Splitting of text that is too long for one post. The text is split into chunks that fit the platform's limit, at
+line boundaries where possible, and code blocks that straddle two chunks are closed at the end of the first and
+reopened at the start of the second, so that each chunk renders on its own. Text can be read incrementally from an
+iterator or a file object, so that long command output is split as it is read instead of being held whole.
+"""
+
+
+# import built-in modules
+import codecs
+
+__all__ = [
+    'split'
+]
+
+
+FENCE = '```'
+# What closes a code block at the end of a chunk.
+CLOSING_FENCE = '\n' + FENCE
+# The label of each chunk, when the number of chunks is known and when it isn't yet.
+LABEL_TEMPLATE = '({index}/{total})\n'
+OPEN_LABEL_TEMPLATE = '({index})\n'
+# The room kept free in every chunk for its label.
+LABEL_RESERVE = 16
+
+
+def _lines(source, max_length):
+    """Read text line by line.
+
+    Args:
+        source (str|iterable): The text, or an iterable of pieces of it such as a file object. Pieces are joined as
+            they are, and bytes are decoded as UTF-8.
+        max_length (int): The longest line to hold on to, longer ones are cut into pieces of this length.
+
+    Returns:
+        generator: The lines, with their line endings.
+    """
+    if isinstance(source, str):
+        for line in source.splitlines(True):
+            yield line
+        return
+
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    partial = ''
+    for piece in source:
+        if isinstance(piece, bytes):
+            piece = decoder.decode(piece)
+        lines = (partial + piece).splitlines(True)
+        partial = lines.pop() if lines and not lines[-1].endswith(('\n', '\r')) else ''
+        for line in lines:
+            yield line
+        while len(partial) > max_length:
+            yield partial[:max_length]
+            partial = partial[max_length:]
+    partial += decoder.decode(b'', final=True)
+    if partial:
+        yield partial
+
+
+def _cut(line, room):
+    """Get the start of a line that is too long for a chunk, ending at a space if there is one in its second half.
+
+    Args:
+        line (str): The line.
+        room (int): The most characters to take.
+
+    Returns:
+        str:
+    """
+    head = line[:room]
+    space = head.rfind(' ')
+    return head[:space + 1] if space >= room // 2 else head
+
+
+def _chunks(source, max_length):
+    """Split text into chunks, without labels.
+
+    Args:
+        source (str|iterable): The text, or an iterable of pieces of it.
+        max_length (int): The longest chunk.
+
+    Returns:
+        generator: The chunks.
+    """
+    current = []
+    length = 0
+    # The line that opened the code block the text is in, if it is in one.
+    fence = None
+    has_text = False
+    for line in _lines(source, max_length):
+        while line:
+            after = fence
+            if line.lstrip().startswith(FENCE):
+                after = None if fence else line.strip()
+            if length + len(line) + (len(CLOSING_FENCE) if after else 0) <= max_length:
+                current.append(line)
+                length += len(line)
+                fence = after
+                has_text = True
+                break
+            if has_text:
+                yield _close(current, fence)
+                current, length, has_text = _reopen(fence)
+                continue
+            room = max_length - length - (len(CLOSING_FENCE) if fence else 0)
+            if room <= 0:
+                raise ValueError('A chunk of {0} characters is too short to hold any text'.format(max_length))
+            head = _cut(line, room)
+            current.append(head)
+            length += len(head)
+            has_text = True
+            line = line[len(head):]
+    if has_text:
+        yield _close(current, fence)
+
+
+def _close(lines, fence):
+    text = ''.join(lines).rstrip('\r\n')
+    return text + CLOSING_FENCE if fence else text
+
+
+def _reopen(fence):
+    if fence is None:
+        return [], 0, False
+    header = fence + '\n'
+    return [header], len(header), False
+
+
+def split(source, max_length, numbered=True):
+    """Split text into chunks that each fit in a post.
+
+    Args:
+        source (str|iterable): The text, or an iterable of pieces of it, such as a file object or a generator of
+            command output, which is read as the chunks are consumed.
+        max_length (int): The longest chunk, labels and code fences included.
+        numbered (bool): Whether to start every chunk with its number, such as `(2/5)`, when there is more than one.
+            Chunks of an iterable are numbered without the total, except for the last one, since the total isn't
+            known until the whole text has been read.
+
+    Returns:
+        generator: The chunks, in order.
+    """
+    if not numbered:
+        for chunk in _chunks(source, max_length):
+            yield chunk
+        return
+
+    if isinstance(source, str) and len(source) <= max_length:
+        yield source
+        return
+
+    chunks = _chunks(source, max_length - LABEL_RESERVE)
+    if isinstance(source, str):
+        chunks = list(chunks)
+        if len(chunks) == 1:
+            yield chunks[0]
+            return
+        for index, chunk in enumerate(chunks, 1):
+            yield LABEL_TEMPLATE.format(index=index, total=len(chunks)) + chunk
+        return
+
+    # Held back by one, to know whether each chunk is the last.
+    previous = next(chunks, None)
+    if previous is None:
+        return
+    index = 0
+    for chunk in chunks:
+        index += 1
+        yield OPEN_LABEL_TEMPLATE.format(index=index) + previous
+        previous = chunk
+    yield previous if not index else LABEL_TEMPLATE.format(index=index + 1, total=index + 1) + previous
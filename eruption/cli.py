@@ -1,5 +1,15 @@
+# import built-in modules
+import os
+import time
+
+# import 3rd party modules
 import click
-import eruption
+
+# import local modules
+from eruption import config
+from eruption import outbox as outboxes
+from eruption import sessions
+from eruption import streaming
 
 
 # Configuration key will be base for everything, unless given an explicit argument which will be treated as an
@@ -26,15 +36,24 @@ USER_NAME_KEY = __name__ + '.user_name'
 # TODO (Alex): Needed?
 OVERRIDES_KEY = __name__ + '.overrides'
 
+STREAM_KEY = __name__ + '.stream'
+FORMAT_KEY = __name__ + '.format'
+CONCURRENCY_KEY = __name__ + '.concurrency'
+
+OUTBOX_KEY = __name__ + '.outbox'
+
 
 @click.group(
     name='eruption',
     invoke_without_command=False)
+@click.option(
+    '--config', 'config_path',
+    type=click.Path(dir_okay=False),
+    envvar=config.ENVIRONMENT_VARIABLE,
+    help='The configuration file. Defaults to {0}.'.format(config.DEFAULT_PATH))
 @click.pass_context
-def cli(context):
-    print('Going to load the configuration information here')
-    # context.meta['GET_ME'] = 'information'
-    print('running cli')
+def cli(context, config_path):
+    context.meta[CONFIGURATION_KEY] = config.get_section(config.load(config_path), context.invoked_subcommand)
 
 
 def set_message(context, parameters, value):
@@ -132,28 +151,228 @@ def set_user_name(context, parameters, value):
 #     if value:
 
 
+def set_stream(context, parameters, value):
+    """Set stdin as the stream of messages to post on the Click Context, unless a file was given.
+
+    Args:
+        context (click.Context): The Click Context to use.
+        parameters (click.ParamType): The Parameter being inspected (ignored).
+        value (bool): Whether to stream messages.
+    """
+    if value:
+        context.meta.setdefault(STREAM_KEY, click.open_file('-'))
+
+
+def set_input(context, parameters, value):
+    """Set the file to stream messages from on the Click Context.
+
+    Args:
+        context (click.Context): The Click Context to use.
+        parameters (click.ParamType): The Parameter being inspected (ignored).
+        value (file): The file to read messages from.
+    """
+    if value:
+        context.meta[STREAM_KEY] = value
+
+
+def set_format(context, parameters, value):
+    """Set the format of the streamed messages on the Click Context.
+
+    Args:
+        context (click.Context): The Click Context to use.
+        parameters (click.ParamType): The Parameter being inspected (ignored).
+        value (str): Either 'plain' or 'ndjson'.
+    """
+    if value:
+        context.meta[FORMAT_KEY] = value
+
+
+def set_concurrency(context, parameters, value):
+    """Set the most posts in flight at once on the Click Context.
+
+    Args:
+        context (click.Context): The Click Context to use.
+        parameters (click.ParamType): The Parameter being inspected (ignored).
+        value (int): The most posts in flight at once.
+    """
+    if value:
+        context.meta[CONCURRENCY_KEY] = value
+
+
+def message_options(command):
+    """Add the options for what to post, shared by every service's command.
+
+    Args:
+        command (callable): The command function.
+
+    Returns:
+        callable:
+    """
+    options = [
+        click.option(
+            '-m', '--message',
+            expose_value=False,
+            callback=set_message,
+            help='The message to post.'),
+        click.option(
+            '-s', '--stream',
+            is_flag=True,
+            expose_value=False,
+            callback=set_stream,
+            help='Post every line read from stdin until it ends.'),
+        click.option(
+            '--input',
+            type=click.File('r', lazy=True),
+            expose_value=False,
+            callback=set_input,
+            is_eager=True,
+            help='Post every line read from this file instead of stdin.'),
+        click.option(
+            '-f', '--format',
+            type=click.Choice(streaming.FORMATS),
+            expose_value=False,
+            callback=set_format,
+            help='The format of the streamed lines: plain text, or JSON records with the message under "text" and '
+                 'any other keys as payload overrides. Defaults to plain.'),
+        click.option(
+            '--concurrency',
+            type=click.IntRange(min=1),
+            expose_value=False,
+            callback=set_concurrency,
+            help='The most posts in flight at once while streaming. Defaults to {0}.'.format(
+                streaming.DEFAULT_CONCURRENCY)),
+        click.option(
+            '-u', '--user_name',
+            expose_value=False,
+            callback=set_user_name,
+            required=False),
+        click.option(
+            '-i', '--icon-emoji',
+            expose_value=False,
+            callback=set_icon,
+            required=False)
+    ]
+    for option in reversed(options):
+        command = option(command)
+    return command
+
+
+def get_setting(context, key, name, required=True):
+    """Get a setting from the command line, falling back to the configuration.
+
+    Args:
+        context (click.Context): The Click Context to use.
+        key (str): The key the command line value was set under on the context.
+        name (str): The name of the setting in the configuration.
+        required (bool): Whether to fail when the setting is missing.
+
+    Returns:
+        str:
+    """
+    configuration = context.meta.get(CONFIGURATION_KEY) or {}
+    value = context.meta.get(key) or configuration.get(name)
+    if required and not value:
+        raise click.UsageError('Missing the {0}, give it as an option or in the configuration.'.format(
+            name.replace('_', ' ')))
+    return value
+
+
+def post(context, instance, channel_override=True):
+    """Post the message, or the stream of messages, from the command line with the given instance.
+
+    Args:
+        context (click.Context): The Click Context to use.
+        instance (eruption.eruption.Messenger): The Messenger instance to post with.
+        channel_override (bool): Whether the channel setting overrides the payload's channel, rather than being part
+            of the instance's url.
+    """
+    overrides = {}
+    user_name = get_setting(context, USER_NAME_KEY, CONFIGURATION_USER_NAME, required=False)
+    if user_name:
+        overrides['user_name'] = user_name
+    icon = get_setting(context, ICON_KEY, CONFIGURATION_ICON, required=False)
+    if icon:
+        overrides['icon_emoji'] = icon
+    if channel_override:
+        channel = get_setting(context, CHANNEL_KEY, CONFIGURATION_CHANNEL, required=False)
+        if channel:
+            overrides['channel'] = channel
+
+    message = context.meta.get(MESSAGE_KEY)
+    stream = context.meta.get(STREAM_KEY)
+    if message is None and stream is None:
+        raise click.UsageError('Give a message to post with --message, or stream messages with --stream.')
+
+    if message is not None:
+        result = instance.post(message, **overrides)
+        if result is not None and result.status_code >= 400:
+            raise click.ClickException('Posting failed with {0} {1}: {2}'.format(
+                result.status_code, result.reason, result.text))
+
+    if stream is not None:
+        summary = streaming.post_stream(
+            instance,
+            stream,
+            format=context.meta.get(FORMAT_KEY, 'plain'),
+            concurrency=context.meta.get(CONCURRENCY_KEY, streaming.DEFAULT_CONCURRENCY),
+            overrides=overrides)
+        click.echo(str(summary), err=True)
+        if summary.failed:
+            context.exit(1)
+
+
 @cli.command(
     name='discord',
     short_help='Post the given message to Discord')
+@message_options
 @click.option(
-    '-m', '--message',
+    '-r', '--room-id',
     expose_value=False,
-    callback=set_message)
+    callback=set_room_id,
+    required=False)
+@click.option(
+    '-t', '--token',
+    expose_value=False,
+    callback=set_token,
+    required=False)
 @click.pass_context
 def discord(context):
-    print('ran discord')
-    print('Received {}'.format(context))
-    print('And it contains {}'.format(context.meta.get('GET_ME')))
-    print('Obviously still need to finish this.')
+    from eruption import eruption
+
+    instance = eruption.Discord(
+        room_id=get_setting(context, ROOM_ID_KEY, CONFIGURATION_ROOM_ID),
+        token=get_setting(context, TOKEN_KEY, CONFIGURATION_TOKEN))
+    post(context, instance, channel_override=False)
 
 
 @cli.command(
-    name='rocketchat',
-    short_help='Post the given message to Rocketchat')
+    name='hipchat',
+    short_help='Post the given message to HipChat')
+@message_options
+@click.option(
+    '-r', '--room-id',
+    expose_value=False,
+    callback=set_room_id,
+    required=False)
 @click.option(
-    '-m', '--message',
+    '-t', '--token',
     expose_value=False,
-    callback=set_message)
+    callback=set_token,
+    required=False)
+@click.pass_context
+def hipchat(context):
+    from eruption import eruption
+
+    instance = eruption.HipChat(
+        room_id=get_setting(context, ROOM_ID_KEY, CONFIGURATION_ROOM_ID),
+        token=get_setting(context, TOKEN_KEY, CONFIGURATION_TOKEN))
+    post(context, instance, channel_override=False)
+
+
+@cli.command(
+    name='mattermost',
+    short_help='Post the given message to Mattermost')
+@message_options
 @click.option(
     '-b', '--base-url',
     expose_value=False,
@@ -169,23 +388,162 @@ def discord(context):
     expose_value=False,
     callback=set_channel,
     required=False)
+@click.pass_context
+def mattermost(context):
+    from eruption import eruption
+
+    instance = eruption.Mattermost(
+        token=get_setting(context, TOKEN_KEY, CONFIGURATION_TOKEN),
+        base_url=get_setting(context, BASE_URL_KEY, CONFIGURATION_BASE_URL))
+    post(context, instance)
+
+
+@cli.command(
+    name='rocketchat',
+    short_help='Post the given message to Rocketchat')
+@message_options
 @click.option(
-    '-u', '--user_name',
+    '-b', '--base-url',
     expose_value=False,
-    callback=set_user_name,
+    callback=set_base_url,
     required=False)
 @click.option(
-    '-i', '--icon-emoji',
+    '-t', '--token',
     expose_value=False,
-    callback=set_icon,
+    callback=set_token,
+    required=False)
+@click.option(
+    '-c', '--channel',
+    expose_value=False,
+    callback=set_channel,
     required=False)
 @click.pass_context
 def rocketchat(context):
-    message = context.meta.get(MESSAGE_KEY)
-    configuration = context.meta.get(CONFIGURATION_KEY)
-    base_url = context.meta.get(BASE_URL_KEY) or configuration.get('base_url')
+    from eruption import eruption
+
+    instance = eruption.RocketChat(
+        base_url=get_setting(context, BASE_URL_KEY, CONFIGURATION_BASE_URL),
+        token=get_setting(context, TOKEN_KEY, CONFIGURATION_TOKEN))
+    post(context, instance)
 
 
+@cli.command(
+    name='slack',
+    short_help='Post the given message to Slack')
+@message_options
+@click.option(
+    '-r', '--room-id',
+    expose_value=False,
+    callback=set_room_id,
+    required=False)
+@click.option(
+    '-t', '--token',
+    expose_value=False,
+    callback=set_token,
+    required=False)
+@click.option(
+    '-c', '--channel',
+    expose_value=False,
+    callback=set_channel,
+    required=False)
+@click.pass_context
+def slack(context):
+    from eruption import eruption
+
+    instance = eruption.Slack(
+        room_id=get_setting(context, ROOM_ID_KEY, CONFIGURATION_ROOM_ID),
+        token=get_setting(context, TOKEN_KEY, CONFIGURATION_TOKEN),
+        channel=get_setting(context, CHANNEL_KEY, CONFIGURATION_CHANNEL))
+    post(context, instance, channel_override=False)
+
+
+@cli.group(
+    name='outbox',
+    short_help='Inspect and drain the outbox of undelivered messages')
+@click.option(
+    '-p', '--path',
+    default=outboxes.DEFAULT_PATH,
+    show_default=True,
+    type=click.Path(dir_okay=False),
+    help='The outbox database.')
+@click.pass_context
+def outbox(context, path):
+    context.meta[OUTBOX_KEY] = outboxes.Outbox(path)
+    context.call_on_close(context.meta[OUTBOX_KEY].close)
+
+
+@outbox.command(
+    name='show',
+    short_help='Show the messages waiting in the outbox')
+@click.pass_context
+def show_outbox(context):
+    summary = context.meta[OUTBOX_KEY].summary()
+    dead_letters = context.meta[OUTBOX_KEY].dead_letters()
+    if not summary and not dead_letters:
+        click.echo('The outbox is empty.')
+        return
+    now = time.time()
+    for url, count, oldest, last_error in summary:
+        click.echo('{0}: {1} message(s), oldest {2:.0f}s ago{3}'.format(
+            outboxes.redact(url),
+            count,
+            now - oldest,
+            ', last error: {0}'.format(last_error) if last_error else ''))
+    for url, count, last_error in dead_letters:
+        click.echo('{0}: {1} message(s) given up on, last error: {2}'.format(outboxes.redact(url), count, last_error))
+
+
+@outbox.command(
+    name='drain',
+    short_help='Post the messages waiting in the outbox')
+@click.option(
+    '-l', '--limit',
+    type=int,
+    default=None,
+    help='The most messages to post.')
+@click.pass_context
+def drain_outbox(context, limit):
+    result = context.meta[OUTBOX_KEY].drain(limit=limit)
+    click.echo('Sent {0} message(s), {1} remaining.'.format(result.sent, result.remaining))
+    if result.failed:
+        raise click.ClickException('Could not deliver to {0} endpoint(s).'.format(result.failed))
+
+
+@cli.command(
+    name='relay',
+    short_help='Forward the posts of messengers in relay mode')
+@click.option(
+    '-s', '--socket', 'path',
+    type=click.Path(dir_okay=False),
+    help='The Unix domain socket to listen on. Defaults to the ERUPTION_RELAY environment variable, and then to a '
+         'socket in the user\'s runtime directory.')
+@click.option(
+    '--pool-size',
+    type=int,
+    default=sessions.DEFAULT_POOL_SIZE,
+    show_default=True,
+    help='The most connections kept open per chat server.')
+@click.option(
+    '-a', '--allow-host', 'allowed_hosts',
+    multiple=True,
+    help='A host to forward posts to besides the hosted services, such as a Mattermost server, as host or host:port. '
+         'Can be given more than once.')
+def relay(path, pool_size, allowed_hosts):
+    from eruption import relay as relays
+
+    path = path or os.environ.get(relays.ENVIRONMENT_VARIABLE) or relays.DEFAULT_PATH
+    daemon = relays.Relay(
+        path,
+        session_pool=sessions.SessionPool(pool_size=pool_size),
+        allowed_hosts=relays.DEFAULT_ALLOWED_HOSTS.union(allowed_hosts))
+    click.echo('Relaying posts from {0}'.format(path))
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if not daemon.stop(timeout=relays.STOP_TIMEOUT):
+            click.echo('Stopped with {0} post(s) not forwarded.'.format(daemon.pending), err=True)
 
 
 if __name__ == '__main__':
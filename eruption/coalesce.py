@@ -0,0 +1,151 @@
+"""Coalescing of message bursts. Messages posted to the same target within a time window are merged into as few
+payloads as the platform's length limit allows, so that a storm of alerts costs a handful of webhook calls instead of
+one call per alert.
+"""
+
+
+# import built-in modules
+import atexit
+import json
+import logging
+import threading
+import weakref
+
+# import local modules
+from eruption import forking
+
+__all__ = [
+    'Coalescer'
+]
+
+
+DEFAULT_WINDOW = 1.0
+DEFAULT_MAX_MESSAGES = 100
+DEFAULT_SEPARATOR = '\n'
+
+LOGGER = logging.getLogger(__name__)
+
+_coalescers = weakref.WeakSet()
+
+
+def _overrides_key(overrides):
+    """Get a hashable key for a dict of payload overrides, so that only messages with the same overrides are merged.
+
+    Args:
+        overrides (dict): The payload overrides.
+
+    Returns:
+        str:
+    """
+    return json.dumps(overrides, sort_keys=True, default=repr) if overrides else ''
+
+
+class _Batch(object):
+
+    def __init__(self, overrides):
+        self.overrides = overrides
+        self.messages = []
+        self.length = 0
+        self.timer = None
+
+
+class Coalescer(object):
+    """Gathers messages and sends them merged once their window closes, or as soon as a merged payload is full.
+
+    Args:
+        send (callable): Called with the merged text and the payload overrides to post it.
+        max_length (int): The longest text the platform accepts in one payload, or None for no limit.
+        window (float): The number of seconds a window stays open after its first message.
+        max_messages (int): The most messages merged into one payload.
+        separator (str): What the merged messages are joined with.
+    """
+
+    def __init__(self, send, max_length=None, window=DEFAULT_WINDOW, max_messages=DEFAULT_MAX_MESSAGES,
+                 separator=DEFAULT_SEPARATOR):
+        self.send = send
+        self.max_length = max_length
+        self.window = window
+        self.max_messages = max_messages
+        self.separator = separator
+        self._batches = {}
+        self._lock = threading.Lock()
+        _coalescers.add(self)
+
+    def add(self, message, overrides=None):
+        """Add a message to the window of the payload overrides it is posted with.
+
+        Args:
+            message (str): The message to post.
+            overrides (dict): The payload overrides to post it with.
+        """
+        key = _overrides_key(overrides)
+        ready = []
+        with self._lock:
+            batch = self._batches.get(key)
+            if batch is not None and not self._fits(batch, message):
+                ready.append(self._take(key))
+                batch = None
+            if batch is None:
+                batch = self._batches[key] = _Batch(dict(overrides or {}))
+                batch.timer = threading.Timer(self.window, self._expire, args=(key, batch))
+                batch.timer.daemon = True
+                batch.timer.start()
+            batch.messages.append(message)
+            batch.length += len(message) + (len(self.separator) if len(batch.messages) > 1 else 0)
+            if len(batch.messages) >= self.max_messages:
+                ready.append(self._take(key))
+        for batch in ready:
+            self._send(batch)
+
+    def _fits(self, batch, message):
+        if self.max_length is None:
+            return True
+        return batch.length + len(self.separator) + len(message) <= self.max_length
+
+    def _take(self, key):
+        batch = self._batches.pop(key)
+        batch.timer.cancel()
+        return batch
+
+    def _expire(self, key, batch):
+        with self._lock:
+            if self._batches.get(key) is not batch:
+                return
+            del self._batches[key]
+        self._send(batch)
+
+    def _send(self, batch):
+        try:
+            self.send(self.separator.join(batch.messages), batch.overrides)
+        except Exception as error:
+            LOGGER.warning('Failed to post %s coalesced messages: %s', len(batch.messages), error, exc_info=True)
+
+    @property
+    def pending(self):
+        """int: The number of messages waiting for their window to close."""
+        with self._lock:
+            return sum(len(batch.messages) for batch in self._batches.values())
+
+    def _reset_after_fork(self):
+        # The open windows are the parent's to send, and their timers didn't survive the fork.
+        self._batches = {}
+        self._lock = threading.Lock()
+
+    def flush(self):
+        """Send every open window right away."""
+        with self._lock:
+            batches = [self._take(key) for key in list(self._batches)]
+        for batch in batches:
+            self._send(batch)
+
+
+@forking.after_fork
+def _reset_after_fork():
+    for coalescer in list(_coalescers):
+        coalescer._reset_after_fork()
+
+
+@atexit.register
+def _flush_at_exit():
+    for coalescer in list(_coalescers):
+        coalescer.flush()
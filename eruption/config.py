@@ -0,0 +1,132 @@
+"""Configuration file loading for the command line. The configuration is an INI file with an `[eruption]` section of
+defaults and a section per service, such as `[slack]`, whose values take precedence over the defaults:
+
+    [eruption]
+    user_name = deploy-bot
+
+    [rocketchat]
+    base_url = chat.example.com
+    token = abc123
+
+Parsing INI files is slow next to the rest of a one-shot post, so the parsed configuration is cached in a compiled
+form next to the other user caches, and only parsed again once the file's modification time or size changes.
+"""
+
+
+# import built-in modules
+import marshal
+import os
+import zlib
+
+__all__ = [
+    'DEFAULT_PATH',
+    'DEFAULT_SECTION',
+    'ENVIRONMENT_VARIABLE',
+    'load',
+    'get_section'
+]
+
+
+DEFAULT_PATH = os.path.join(os.path.expanduser('~'), '.eruption.cfg')
+DEFAULT_SECTION = 'eruption'
+ENVIRONMENT_VARIABLE = 'ERUPTION_CONFIG'
+CACHE_DIRECTORY = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'),
+    'eruption')
+
+# Bumped whenever the compiled form changes, so that stale caches are parsed again.
+_CACHE_VERSION = 1
+
+
+def _cache_path(path):
+    return os.path.join(CACHE_DIRECTORY, 'config-{0:08x}.marshal'.format(zlib.crc32(path.encode('utf-8'))))
+
+
+def _parse(path):
+    """Parse a configuration file.
+
+    Args:
+        path (str): The path of the file.
+
+    Returns:
+        dict: The values of each section, by section name.
+    """
+    from configparser import RawConfigParser
+
+    parser = RawConfigParser()
+    parser.read(path)
+    return dict((section, dict(parser.items(section))) for section in parser.sections())
+
+
+def _read_cache(cache_path, path, signature):
+    try:
+        with open(cache_path, 'rb') as cache:
+            version, cached_path, cached_signature, sections = marshal.load(cache)
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+        return None
+    if (version, cached_path, cached_signature) != (_CACHE_VERSION, path, signature):
+        return None
+    return sections
+
+
+def _write_cache(cache_path, path, signature, sections):
+    # The cache holds the tokens of the configuration, so only its owner may read it.
+    temporary_path = '{0}.{1}.tmp'.format(cache_path, os.getpid())
+    try:
+        if not os.path.isdir(CACHE_DIRECTORY):
+            os.makedirs(CACHE_DIRECTORY, 0o700)
+        try:
+            # Left behind by a process with the same id that died while writing it.
+            os.unlink(temporary_path)
+        except OSError:
+            pass
+        descriptor = os.open(temporary_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(descriptor, 'wb') as cache:
+            marshal.dump((_CACHE_VERSION, path, signature, sections), cache)
+        os.replace(temporary_path, cache_path)
+    except (IOError, OSError):
+        # Not being able to cache only costs the next run a parse.
+        pass
+
+
+def load(path=None, use_cache=True):
+    """Load the configuration.
+
+    Args:
+        path (str): The configuration file, defaults to the ERUPTION_CONFIG environment variable and then
+            `~/.eruption.cfg`.
+        use_cache (bool): Whether to use, and keep up to date, the compiled cache of the file.
+
+    Returns:
+        dict: The values of each section, by section name. Empty if there is no configuration file.
+    """
+    path = os.path.abspath(path or os.environ.get(ENVIRONMENT_VARIABLE) or DEFAULT_PATH)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return {}
+    signature = (stat.st_mtime_ns, stat.st_size)
+
+    if not use_cache:
+        return _parse(path)
+    cache_path = _cache_path(path)
+    sections = _read_cache(cache_path, path, signature)
+    if sections is None:
+        sections = _parse(path)
+        _write_cache(cache_path, path, signature, sections)
+    return sections
+
+
+def get_section(sections, name):
+    """Get the configuration of a service, with the defaults filled in.
+
+    Args:
+        sections (dict): The configuration, as returned by `load`.
+        name (str): The name of the service's section.
+
+    Returns:
+        dict:
+    """
+    values = dict(sections.get(DEFAULT_SECTION, {}))
+    values.update(sections.get(name, {}) if name else {})
+    return values
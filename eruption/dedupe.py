@@ -0,0 +1,214 @@
+"""Deduplication of repeated messages. The first post of a message to a target goes through, and identical posts to
+the same target within a time window after it are dropped. When the window closes, a single summary of how many
+were dropped is posted in their place, so that a hot code path firing the same alert thousands of times costs two
+webhook calls instead of thousands.
+"""
+
+
+# import built-in modules
+import atexit
+import collections
+import hashlib
+import json
+import logging
+import threading
+import time
+import weakref
+
+# import local modules
+from eruption import forking
+
+__all__ = [
+    'Deduplicator'
+]
+
+
+try:
+    _clock = time.monotonic
+except AttributeError:  # pragma: no cover
+    _clock = time.time
+
+DEFAULT_WINDOW = 60.0
+DEFAULT_MAX_ENTRIES = 1024
+SUMMARY_TEMPLATE = 'Suppressed {count} identical message(s) in the last {window:g}s: {message}'
+# The longest part of the suppressed message quoted in its summary.
+SUMMARY_PREVIEW_LENGTH = 200
+
+LOGGER = logging.getLogger(__name__)
+
+_deduplicators = weakref.WeakSet()
+
+
+def _key(target, message, overrides):
+    """Hash a post, so that entries take the same small amount of memory however long their message is.
+
+    Args:
+        target (str): The url the message is posted to.
+        message (str): The message.
+        overrides (dict): The payload overrides it is posted with.
+
+    Returns:
+        bytes:
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for part in (target, message, json.dumps(overrides, sort_keys=True, default=repr) if overrides else ''):
+        digest.update(part.encode('utf-8', 'surrogatepass'))
+        digest.update(b'\0')
+    return digest.digest()
+
+
+class _Entry(object):
+
+    __slots__ = ('expires', 'message', 'overrides', 'suppressed')
+
+    def __init__(self, expires, message, overrides):
+        self.expires = expires
+        self.message = message
+        self.overrides = overrides
+        self.suppressed = 0
+
+
+class Deduplicator(object):
+    """Drops posts identical to one sent within the window before them, and sends a summary of what was dropped once
+    the window closes. The summaries are sent by a single daemon thread, which is started when a post is first dropped
+    and ends once no summary is left to send.
+
+    Args:
+        send (callable): Called with the summary text and the payload overrides to post it.
+        window (float): The number of seconds identical posts are dropped for after the first one.
+        max_entries (int): The most posts remembered at once. The oldest ones are forgotten first, after their summary
+            is sent.
+        summary_template (str): The summary, formatted with the `count` of dropped posts, the `window` and the
+            `message` that was dropped.
+    """
+
+    def __init__(self, send, window=DEFAULT_WINDOW, max_entries=DEFAULT_MAX_ENTRIES,
+                 summary_template=SUMMARY_TEMPLATE):
+        self.send = send
+        self.window = window
+        self.max_entries = max(int(max_entries), 1)
+        self.summary_template = summary_template
+        self._entries = collections.OrderedDict()
+        # The number of entries with a summary to send.
+        self._summaries = 0
+        self._sweeper = None
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+        _deduplicators.add(self)
+
+    def suppress(self, target, message, overrides=None):
+        """Check whether a post repeats one sent within the window, and remember it if it doesn't.
+
+        Args:
+            target (str): The url the message is posted to.
+            message (str): The message.
+            overrides (dict): The payload overrides it is posted with.
+
+        Returns:
+            bool: Whether the post should be dropped.
+        """
+        key = _key(target, message, overrides)
+        expired = []
+        with self._lock:
+            now = _clock()
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires > now:
+                if not entry.suppressed:
+                    self._summaries += 1
+                    self._ensure_sweeping()
+                entry.suppressed += 1
+                return True
+            if entry is not None:
+                expired.append(self._take(key))
+            while self._entries and (len(self._entries) >= self.max_entries or self._oldest().expires <= now):
+                expired.append(self._take(next(iter(self._entries))))
+            if len(message) > SUMMARY_PREVIEW_LENGTH:
+                message = message[:SUMMARY_PREVIEW_LENGTH - 3] + '...'
+            self._entries[key] = _Entry(now + self.window, message, dict(overrides or {}))
+        for entry in expired:
+            self._summarize(entry)
+        return False
+
+    def _oldest(self):
+        # The window is the same for every entry, so the oldest entries are the first to expire.
+        return next(iter(self._entries.values()))
+
+    def _take(self, key):
+        # Called with the lock held.
+        entry = self._entries.pop(key)
+        if entry.suppressed:
+            self._summaries -= 1
+            if not self._summaries:
+                # Nothing left for the sweeper to wait for.
+                self._condition.notify()
+        return entry
+
+    def _ensure_sweeping(self):
+        # Called with the lock held.
+        if self._sweeper is None:
+            self._sweeper = threading.Thread(target=self._sweep, name='eruption-dedupe')
+            self._sweeper.daemon = True
+            self._sweeper.start()
+
+    def _sweep(self):
+        while True:
+            expired = []
+            with self._condition:
+                while not expired:
+                    if not self._summaries:
+                        self._sweeper = None
+                        return
+                    now = _clock()
+                    while self._entries and self._oldest().expires <= now:
+                        expired.append(self._take(next(iter(self._entries))))
+                    if not expired:
+                        self._condition.wait(self._oldest().expires - now)
+            for entry in expired:
+                self._summarize(entry)
+
+    def _summarize(self, entry):
+        if not entry.suppressed:
+            return
+        try:
+            self.send(
+                self.summary_template.format(count=entry.suppressed, window=self.window, message=entry.message),
+                entry.overrides)
+        except Exception as error:
+            LOGGER.warning('Failed to post the summary of %s suppressed messages: %s', entry.suppressed, error,
+                           exc_info=True)
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def suppressed(self):
+        """int: The number of posts dropped whose summary hasn't been sent yet."""
+        with self._lock:
+            return sum(entry.suppressed for entry in self._entries.values())
+
+    def _reset_after_fork(self):
+        # The summaries of the open windows are the parent's to send.
+        self._entries = collections.OrderedDict()
+        self._summaries = 0
+        self._sweeper = None
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+
+    def flush(self):
+        """Send the summary of every open window right away, and forget every post."""
+        with self._lock:
+            entries = [self._take(key) for key in list(self._entries)]
+        for entry in entries:
+            self._summarize(entry)
+
+
+@forking.after_fork
+def _reset_after_fork():
+    for deduplicator in list(_deduplicators):
+        deduplicator._reset_after_fork()
+
+
+@atexit.register
+def _flush_at_exit():
+    for deduplicator in list(_deduplicators):
+        deduplicator.flush()
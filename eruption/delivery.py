@@ -0,0 +1,547 @@
+"""Background delivery of posts. Posts handed to the BackgroundSender are put on an in-memory queue and sent by a pool
+of worker threads, so that the caller doesn't wait on the webhook's round trip. The queue has a lane per priority, so
+that urgent posts go out first. Whatever is still queued when the interpreter exits is drained by an atexit hook.
+"""
+
+
+# import built-in modules
+import atexit
+import collections
+import itertools
+import logging
+import sys
+import threading
+import time
+import weakref
+from concurrent.futures import Future
+
+# import local modules
+from eruption import exceptions
+from eruption import forking
+from eruption import metrics
+
+__all__ = [
+    'BackgroundSender',
+    'LaneStats',
+    'OVERFLOW_POLICIES',
+    'PRIORITIES',
+    'get_sender',
+    'set_sender',
+    'submit',
+    'schedule',
+    'flush'
+]
+
+
+DEFAULT_WORKERS = 4
+
+HIGH = 'high'
+NORMAL = 'normal'
+LOW = 'low'
+# From the lane that is drained first to the one drained last.
+PRIORITIES = (HIGH, NORMAL, LOW)
+# How long a call waits before it is taken ahead of the calls of higher priority lanes.
+DEFAULT_STARVATION_TIMEOUT = 2.0
+# Bucket bounds of the lanes' wait times, from ten microseconds to ten minutes, 25% apart.
+WAIT_BUCKETS = (1e-05, 1.25, 81)
+
+BLOCK = 'block'
+DROP_NEWEST = 'drop-newest'
+DROP_OLDEST = 'drop-oldest'
+SPILL = 'spill'
+OVERFLOW_POLICIES = (BLOCK, DROP_NEWEST, DROP_OLDEST, SPILL)
+DEFAULT_BLOCK_TIMEOUT = 1.0
+# The error spilled posts are recorded with in the outbox.
+SPILLED_ERROR = 'Spilled from a full background queue'
+
+# How long the atexit hook waits for queued posts before giving up on them.
+EXIT_FLUSH_TIMEOUT = 5.0
+
+LOGGER = logging.getLogger(__name__)
+
+_senders = weakref.WeakSet()
+
+
+def _lane_index(priority):
+    """Get the index of the lane of a priority.
+
+    Args:
+        priority (str): One of PRIORITIES.
+
+    Returns:
+        int:
+
+    Raises:
+        ValueError: If the priority isn't one of PRIORITIES.
+    """
+    try:
+        return PRIORITIES.index(priority)
+    except ValueError:
+        raise ValueError('Unknown priority {0!r}, expected one of {1}'.format(priority, ', '.join(PRIORITIES)))
+
+
+def _text_size(value):
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    if isinstance(value, (list, tuple)):
+        return sum(_text_size(item) for item in value)
+    return 0
+
+
+def _size(args, kwargs):
+    """Estimate the memory a queued call holds on to, from the text and bytes it was given, lists of pieces of text
+    included. Iterables that are read as they are posted, such as file objects, don't hold on to their text and aren't
+    counted.
+
+    Args:
+        args (tuple): The positional arguments of the call.
+        kwargs (dict): The keyword arguments of the call.
+
+    Returns:
+        int:
+    """
+    return sum(_text_size(value) for value in itertools.chain(args, kwargs.values()))
+
+
+def _on_event_loop():
+    """Check whether the calling thread is running an asyncio event loop.
+
+    Returns:
+        bool:
+    """
+    # No loop can be running before asyncio is imported, which is left to the programs that use it.
+    asyncio = sys.modules.get('asyncio')
+    if asyncio is None:
+        return False
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+class LaneStats(collections.namedtuple('LaneStats', ['depth', 'sent', 'wait_p50', 'wait_p99', 'wait_max'])):
+    """The state of a priority lane of a BackgroundSender.
+
+    Args:
+        depth (int): The number of calls waiting in the lane.
+        sent (int): The number of calls taken from the lane so far.
+        wait_p50 (float): The median seconds calls waited in the lane.
+        wait_p99 (float): The 99th percentile of the seconds calls waited in the lane.
+        wait_max (float): The longest any call waited in the lane.
+    """
+
+    __slots__ = ()
+
+
+class _Lane(object):
+
+    __slots__ = ('items', 'waits')
+
+    def __init__(self):
+        self.items = collections.deque()
+        self.waits = metrics.Histogram.exponential(*WAIT_BUCKETS)
+
+
+class BackgroundSender(object):
+    """Sends posts from a pool of daemon worker threads that are started on first use.
+
+    Calls are queued in a lane per priority, and the workers always take from the highest priority lane that has
+    calls waiting, so that an alert isn't stuck behind a flood of notices. A call that has waited longer than
+    `starvation_timeout` is taken before the calls of higher priority lanes, so that lower lanes still make progress
+    under a steady stream of high priority calls. Starved calls only get every other take though, so that a backlog
+    of them doesn't hold up the higher priority lanes in turn.
+
+    The queue can be bounded by the number of calls waiting and by the size of the text and bytes they were given,
+    so that a chat server being down doesn't pile up posts until the process runs out of memory. What happens to a
+    call that finds the queue full depends on the overflow policy:
+
+    - `block` waits up to `block_timeout` seconds for room, then drops the call. Calls queued from a running event
+      loop, which waiting would stall, are spilled like `spill` does instead.
+    - `drop-newest` drops the call.
+    - `drop-oldest` drops the oldest call of the lowest priority lane that has calls waiting, as many times as it
+      takes to make room. Calls of a higher priority than the newcomer are kept, and the newcomer is dropped instead
+      when only they are left.
+    - `spill` writes the payload of a Messenger's post to an outbox, to be drained once the server is back. Calls
+      that aren't posts, or whose Messenger has no outbox when the sender has none either, are dropped.
+
+    The future of a dropped call fails with QueueFullError, and the future of a spilled post resolves to None.
+
+    Args:
+        workers (int): The number of worker threads.
+        starvation_timeout (float): The most seconds a call waits before it is taken regardless of its priority.
+        max_pending (int): The most calls waiting in the queue, or None for no limit.
+        max_pending_bytes (int): The most bytes of text the calls waiting in the queue were given, or None for no
+            limit. A call bigger than this is still queued when the queue is empty.
+        overflow (str): What to do with calls that find the queue full, one of OVERFLOW_POLICIES.
+        block_timeout (float): The most seconds the `block` policy waits for room, or None to wait for as long as it
+            takes.
+        outbox (Outbox): Where the `spill` policy writes the posts of Messengers that don't have an outbox.
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS, starvation_timeout=DEFAULT_STARVATION_TIMEOUT, max_pending=None,
+                 max_pending_bytes=None, overflow=BLOCK, block_timeout=DEFAULT_BLOCK_TIMEOUT, outbox=None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('Unknown overflow policy {0!r}, expected one of {1}'.format(
+                overflow, ', '.join(OVERFLOW_POLICIES)))
+        self.workers = workers
+        self.starvation_timeout = starvation_timeout
+        self.max_pending = max_pending
+        self.max_pending_bytes = max_pending_bytes
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self.outbox = outbox
+        self.dropped = 0
+        self.spilled = 0
+        self._lanes = [_Lane() for _ in PRIORITIES]
+        self._queued = 0
+        self._queued_bytes = 0
+        self._blocked = 0
+        self._took_starved = False
+        self._threads = []
+        self._stopping = 0
+        self._pending = 0
+        self._condition = threading.Condition()
+        _senders.add(self)
+
+    def _ensure_started(self):
+        if len(self._threads) >= self.workers:
+            return
+        with self._condition:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(
+                    target=self._work,
+                    name='eruption-sender-{0}'.format(len(self._threads)))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, function, *args, **kwargs):
+        """Queue a call to be made by a worker thread, with the normal priority.
+
+        Args:
+            function (callable): The function to call, usually the `post` of a Messenger.
+            *args: The positional arguments to call it with.
+            **kwargs: The keyword arguments to call it with.
+
+        Returns:
+            concurrent.futures.Future: Resolves to what the call returned, or the exception it raised.
+        """
+        return self.schedule(NORMAL, function, *args, **kwargs)
+
+    def schedule(self, priority, function, *args, **kwargs):
+        """Queue a call to be made by a worker thread.
+
+        Args:
+            priority (str): The lane to queue the call in, one of PRIORITIES.
+            function (callable): The function to call, usually the `post` of a Messenger.
+            *args: The positional arguments to call it with.
+            **kwargs: The keyword arguments to call it with.
+
+        Returns:
+            concurrent.futures.Future: Resolves to what the call returned, or the exception it raised.
+        """
+        index = _lane_index(priority)
+        lane = self._lanes[index]
+        size = _size(args, kwargs)
+        self._ensure_started()
+        future = Future()
+        evicted = []
+        spill = self.overflow == SPILL
+        with self._condition:
+            if not self._has_room(size):
+                if self.overflow == BLOCK and _on_event_loop():
+                    spill = True
+                elif self.overflow == BLOCK:
+                    self._wait_for_room(size)
+                elif self.overflow == DROP_OLDEST:
+                    while not self._has_room(size):
+                        item = self._evict(index)
+                        if item is None:
+                            break
+                        evicted.append(item)
+            queued = self._has_room(size)
+            if queued:
+                self._pending += 1
+                self._queued += 1
+                self._queued_bytes += size
+                lane.items.append((future, function, args, kwargs, time.time(), size))
+                self._condition.notify()
+        for item in evicted:
+            self._drop(item[0], item[1])
+        if not queued and not (spill and self._spill(future, function, args, kwargs)):
+            self._drop(future, function)
+        return future
+
+    def _has_room(self, size):
+        if self.max_pending is not None and self._queued >= self.max_pending:
+            return False
+        if self.max_pending_bytes is not None and self._queued and self._queued_bytes + size > self.max_pending_bytes:
+            return False
+        return True
+
+    def _wait_for_room(self, size):
+        # Called with the condition held.
+        deadline = None if self.block_timeout is None else time.time() + self.block_timeout
+        self._blocked += 1
+        try:
+            while not self._has_room(size):
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return
+                self._condition.wait(remaining)
+        finally:
+            self._blocked -= 1
+
+    def _evict(self, index):
+        # Called with the condition held. Only calls that aren't of a higher priority than the newcomer make room.
+        lane = next((lane for lane in reversed(self._lanes[index:]) if lane.items), None)
+        if lane is None:
+            return None
+        item = lane.items.popleft()
+        self._dequeued(item)
+        self._pending -= 1
+        return item
+
+    def _dequeued(self, item):
+        self._queued -= 1
+        self._queued_bytes -= item[5]
+        if self._blocked:
+            self._condition.notify_all()
+
+    def _drop(self, future, function):
+        with self._condition:
+            self.dropped += 1
+            if not self._pending:
+                self._condition.notify_all()
+        if metrics.enabled:
+            metrics.increment('dropped_total', metrics.labels(getattr(function, '__self__', None)))
+        future.set_exception(exceptions.QueueFullError())
+
+    def _spill(self, future, function, args, kwargs):
+        """Write the payload of a post to an outbox instead of queueing it.
+
+        Returns:
+            bool: Whether the post was spilled.
+        """
+        instance = getattr(function, '__self__', None)
+        outbox = getattr(instance, 'outbox', None) or self.outbox
+        if outbox is None or getattr(function, '__name__', None) != 'post' or not hasattr(instance, '_process_data'):
+            return False
+        try:
+            data = instance._process_data(*args, **kwargs)
+            outbox.release(outbox.put(instance.room_url, instance.headers, data), SPILLED_ERROR)
+        except Exception as error:
+            LOGGER.warning('Failed to spill a post to the outbox: %s', error, exc_info=True)
+            return False
+        with self._condition:
+            self.spilled += 1
+        if metrics.enabled:
+            metrics.increment('spilled_total', metrics.labels(instance))
+        future.set_result(None)
+        return True
+
+    def _take(self):
+        # Called with the condition held and at least one call waiting.
+        now = time.time()
+        starved = None
+        if not self._took_starved:
+            for lane in self._lanes[1:]:
+                if lane.items and now - lane.items[0][4] >= self.starvation_timeout:
+                    if starved is None or lane.items[0][4] < starved.items[0][4]:
+                        starved = lane
+        self._took_starved = starved is not None
+        lane = starved or next(lane for lane in self._lanes if lane.items)
+        item = lane.items.popleft()
+        self._dequeued(item)
+        lane.waits.observe(now - item[4])
+        return item
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while not self._stopping and not any(lane.items for lane in self._lanes):
+                    self._condition.wait()
+                if not any(lane.items for lane in self._lanes):
+                    self._stopping -= 1
+                    return
+                item = self._take()
+            future, function, args, kwargs, queued_at, _ = item
+            if metrics.enabled:
+                metrics.observe(
+                    'queue_wait_seconds',
+                    metrics.labels(getattr(function, '__self__', None)),
+                    time.time() - queued_at)
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(function(*args, **kwargs))
+                    except Exception as error:
+                        LOGGER.warning('Background post failed: %s', error, exc_info=True)
+                        future.set_exception(error)
+            finally:
+                with self._condition:
+                    self._pending -= 1
+                    if not self._pending:
+                        self._condition.notify_all()
+
+    def stats(self):
+        """Get the state of every priority lane.
+
+        Returns:
+            dict: The LaneStats of every priority.
+        """
+        with self._condition:
+            return dict((priority, LaneStats(
+                depth=len(lane.items),
+                sent=lane.waits.count,
+                wait_p50=lane.waits.quantile(0.5),
+                wait_p99=lane.waits.quantile(0.99),
+                wait_max=lane.waits.max)) for priority, lane in zip(PRIORITIES, self._lanes))
+
+    @property
+    def pending(self):
+        """int: The number of queued or in-flight posts."""
+        return self._pending
+
+    @property
+    def pending_bytes(self):
+        """int: The bytes of text the queued calls were given."""
+        return self._queued_bytes
+
+    def flush(self, timeout=None):
+        """Wait for every queued post to be sent.
+
+        Args:
+            timeout (float): The most seconds to wait, or None to wait for as long as it takes.
+
+        Returns:
+            bool: Whether everything was sent before the timeout.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while self._pending:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def shutdown(self, timeout=None):
+        """Flush the queue, then stop the worker threads.
+
+        Args:
+            timeout (float): The most seconds to wait for the flush.
+
+        Returns:
+            bool: Whether everything was sent before the timeout.
+        """
+        flushed = self.flush(timeout)
+        with self._condition:
+            threads, self._threads = self._threads, []
+            self._stopping += len(threads)
+            self._condition.notify_all()
+        return flushed
+
+    def _reset_after_fork(self):
+        # The worker threads didn't survive the fork, and whatever was queued is the parent's to send, so that it is
+        # neither sent twice nor lost.
+        self._lanes = [_Lane() for _ in PRIORITIES]
+        self._queued = 0
+        self._queued_bytes = 0
+        self._blocked = 0
+        self._took_starved = False
+        self._threads = []
+        self._stopping = 0
+        self._pending = 0
+        self._condition = threading.Condition()
+
+
+_default_sender = None
+_default_sender_lock = threading.Lock()
+
+
+def get_sender():
+    """Get the process-wide BackgroundSender, creating it on first use.
+
+    Returns:
+        BackgroundSender:
+    """
+    global _default_sender
+    if _default_sender is None:
+        with _default_sender_lock:
+            if _default_sender is None:
+                _default_sender = BackgroundSender()
+    return _default_sender
+
+
+def set_sender(sender):
+    """Replace the process-wide BackgroundSender.
+
+    Args:
+        sender (BackgroundSender): The sender to use, or None to go back to a default sender created on next use.
+
+    Returns:
+        BackgroundSender: The previous sender, if any. It is not shut down.
+    """
+    global _default_sender
+    with _default_sender_lock:
+        previous, _default_sender = _default_sender, sender
+    return previous
+
+
+def submit(function, *args, **kwargs):
+    """Queue a call on the process-wide BackgroundSender.
+
+    Args:
+        function (callable): The function to call, usually the `post` of a Messenger.
+        *args: The positional arguments to call it with.
+        **kwargs: The keyword arguments to call it with.
+
+    Returns:
+        concurrent.futures.Future:
+    """
+    return get_sender().submit(function, *args, **kwargs)
+
+
+def schedule(priority, function, *args, **kwargs):
+    """Queue a call on the process-wide BackgroundSender, in the lane of a priority.
+
+    Args:
+        priority (str): The lane to queue the call in, one of PRIORITIES.
+        function (callable): The function to call, usually the `post` of a Messenger.
+        *args: The positional arguments to call it with.
+        **kwargs: The keyword arguments to call it with.
+
+    Returns:
+        concurrent.futures.Future:
+    """
+    return get_sender().schedule(priority, function, *args, **kwargs)
+
+
+def flush(timeout=None):
+    """Wait for every post queued on the process-wide BackgroundSender to be sent.
+
+    Args:
+        timeout (float): The most seconds to wait, or None to wait for as long as it takes.
+
+    Returns:
+        bool: Whether everything was sent before the timeout.
+    """
+    if _default_sender is None:
+        return True
+    return _default_sender.flush(timeout)
+
+
+@forking.after_fork
+def _reset_after_fork():
+    global _default_sender_lock
+    _default_sender_lock = threading.Lock()
+    for sender in list(_senders):
+        sender._reset_after_fork()
+
+
+@atexit.register
+def _flush_at_exit():
+    if not flush(EXIT_FLUSH_TIMEOUT):
+        LOGGER.warning('Exited with %s posts still queued', _default_sender.pending)
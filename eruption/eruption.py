@@ -6,10 +6,34 @@ run from the command line.
 
 
 # import built-in modules
-import json
-
-# import 3rd party modules
-import requests
+import functools
+import importlib
+import inspect
+import logging
+import sys
+import time
+
+# import local modules
+from eruption import chunking
+from eruption import coalesce
+from eruption import dedupe
+from eruption import delivery
+from eruption import exceptions
+from eruption import metrics
+from eruption import payload
+from eruption import ratelimit
+from eruption import retry
+from eruption import sessions
+from eruption import template
+from eruption import timing
+from eruption import upload
+from eruption.broadcast import Broadcaster, BroadcastResult
+from eruption.cache import InstanceCache
+from eruption.delivery import BackgroundSender, flush
+from eruption.exceptions import CircuitOpenError, EruptionError, QueueFullError, UploadError
+from eruption.handlers import MessengerHandler
+from eruption.sessions import SessionPool, configure_sessions, get_session_pool, set_session_pool
+from eruption.template import Template
 
 __all__ = [
     'Discord',
@@ -27,43 +51,404 @@ __all__ = [
     'hipchat',
     'slack',
     'rocketchat',
-    'mattermost'
+    'mattermost',
+    'timed',
+    'BackgroundSender',
+    'Broadcaster',
+    'BroadcastResult',
+    'CircuitOpenError',
+    'EruptionError',
+    'flush',
+    'flush_async',
+    'InstanceCache',
+    'instance_cache',
+    'MessengerHandler',
+    'Outbox',
+    'QueueFullError',
+    'SessionPool',
+    'configure_sessions',
+    'get_session_pool',
+    'set_session_pool',
+    'Template',
+    'UploadError'
 ]
 
 
+LOGGER = logging.getLogger(__name__)
+
+# Public names imported on first access, so that importing eruption doesn't pay for what isn't used.
+_LAZY_ATTRIBUTES = {
+    'Outbox': 'eruption.outbox'
+}
+
+
+def __getattr__(name):
+    module_name = _LAZY_ATTRIBUTES.get(name)
+    if module_name is None:
+        raise AttributeError('module {0!r} has no attribute {1!r}'.format(__name__, name))
+    value = getattr(importlib.import_module(module_name), name)
+    globals()[name] = value
+    return value
+
+
 class Messenger(object):
+    """Base class for posting to a chat service's webhook.
+
+    Args:
+        room_id (str): The id of the room to post to.
+        token (str): The authorization token to use.
+        url_template (str): Overrides the class's url template.
+        session (requests.Session): A session to post with, instead of one from the session pool.
+        session_pool (SessionPool): The pool to take sessions from, instead of the process-wide one.
+        rate_limit (tuple): Overrides the class's rate limit, as the number of posts allowed per second and how many
+            can be sent in a burst. None turns rate limiting off.
+        rate_limit_retries (int): Overrides how many times a post refused for going over the rate limit is resent.
+        retries (int): Overrides how many times a post that failed to connect, timed out connecting or got a 502,
+            503 or 504 is resent. Posts that timed out waiting for the response aren't, since they may have been
+            posted.
+        retry_backoff (tuple): Overrides the most seconds to wait before the first retry, doubled for every retry
+            after it, and the most seconds to ever wait between retries.
+        circuit_breaker (tuple): Overrides the number of consecutive failures that opens the circuit breaker of the
+            room url, and the seconds it stays open. None turns circuit breaking off.
+        timeout (float): Overrides the seconds to wait for the chat server to answer.
+        coalesce (float): Merge the messages posted within a window of this many seconds into as few payloads as
+            `max_text_length` allows. Off by default.
+        coalesce_max_messages (int): The most messages merged into one payload.
+        dedupe (float): Drop posts identical to one sent within this many seconds before them, and post a summary of
+            how many were dropped once the window closes. Off by default.
+        dedupe_max_entries (int): The most posts remembered for deduplication at once.
+        outbox (Outbox): Record every payload in this outbox before posting it, so that it can be drained later if
+            the post fails.
+        relay (str): Hand payloads to the `eruption relay` daemon listening on this socket instead of posting them,
+            True for its default socket. Posts return None, and are only sent directly if the relay can't be reached.
+        payload_defaults (dict): Replaces some of the class's payload defaults for every post of this instance.
+    """
 
     url_template = ''
     room_url = ''
+    # The payload key of the message text, and the key and default value of every other field, in payload order.
+    text_key = 'text'
+    payload_defaults = ()
+    # Alternative names that overrides can use for payload keys.
+    payload_aliases = {'user_name': 'username'}
+    rate_limit = None
+    rate_limit_retries = 3
+    retries = 2
+    retry_backoff = (0.5, 8.0)
+    # While open, posts raise CircuitOpenError right away instead of waiting on a server that is down.
+    circuit_breaker = (5, 30.0)
+    timeout = 10.0
+    # The longest message the platform accepts in one payload.
+    max_text_length = None
 
     def __init__(self, room_id, token, **kwargs):
         self.room_id = room_id
         self.token = token
+        self.session = kwargs.get('session')
+        self.session_pool = kwargs.get('session_pool')
+        self.outbox = kwargs.get('outbox')
+
+        self.relay = None
+        if kwargs.get('relay'):
+            from eruption import relay as relays
+            self.relay = relays.get_client(None if kwargs.get('relay') is True else kwargs.get('relay'))
+
+        if 'rate_limit' in kwargs:
+            self.rate_limit = kwargs.get('rate_limit')
+
+        if kwargs.get('rate_limit_retries') is not None:
+            self.rate_limit_retries = kwargs.get('rate_limit_retries')
+
+        for setting in ('retries', 'retry_backoff', 'timeout'):
+            if kwargs.get(setting) is not None:
+                setattr(self, setting, kwargs.get(setting))
+
+        if 'circuit_breaker' in kwargs:
+            self.circuit_breaker = kwargs.get('circuit_breaker')
 
         if kwargs.get('url_template'):
             self.url_template = kwargs.get('url_template')
 
+        self.coalescer = None
+        if kwargs.get('coalesce'):
+            self.coalescer = coalesce.Coalescer(
+                self._post_coalesced,
+                max_length=self.max_text_length,
+                window=kwargs.get('coalesce'),
+                max_messages=kwargs.get('coalesce_max_messages') or coalesce.DEFAULT_MAX_MESSAGES)
+
+        self.deduplicator = None
+        if kwargs.get('dedupe'):
+            self.deduplicator = dedupe.Deduplicator(
+                self._post_coalesced,
+                window=kwargs.get('dedupe'),
+                max_entries=kwargs.get('dedupe_max_entries') or dedupe.DEFAULT_MAX_ENTRIES)
+
+        self.payload_template = payload.PayloadTemplate(self.text_key, self.payload_defaults, self.payload_aliases)
+        if kwargs.get('payload_defaults'):
+            self.payload_template = self.payload_template.with_defaults(kwargs.get('payload_defaults'))
+
         self.headers = {
             'Authorization': 'Bearer {0}'.format(self.token),
             'Content-type': 'application/json'
         }
 
     def _process_data(self, *args, **kwargs):
-        raise NotImplementedError
+        if not metrics.enabled:
+            return self.payload_template.render(args[0], kwargs)
+        start = metrics.clock()
+        data = self.payload_template.render(args[0], kwargs)
+        metrics.observe('serialize_seconds', metrics.labels(self), metrics.clock() - start)
+        return data
+
+    def get_session(self, url=None):
+        """Get the session to post with.
+
+        Args:
+            url (str): The url that will be posted to, defaults to the room url.
+
+        Returns:
+            requests.Session: The session given to this instance, otherwise the pooled one for the url.
+        """
+        if self.session is not None:
+            return self.session
+        pool = self.session_pool if self.session_pool is not None else sessions.get_session_pool()
+        return pool.get(url or self.room_url)
 
     def post(self, *args, **kwargs):
+        priority = kwargs.pop('priority', None)
+        if priority is not None:
+            # Sent from the priority's lane of the background sender rather than right away.
+            return delivery.schedule(priority, self.post, *args, **kwargs)
+        if self._hold(args[0], kwargs):
+            return None
+        if self._is_too_long(args[0]):
+            return self.post_chunks(args[0], **kwargs)[-1]
         data = self._process_data(*args, **kwargs)
-        result = requests.post(
-            url=self.room_url,
-            data=data,
-            headers=self.headers
-        )
+        return self._send(data)
+
+    def _hold(self, message, overrides):
+        """Check whether a message is dropped by the deduplicator or taken by the coalescer, instead of being posted
+        right away.
+
+        Args:
+            message (str): The message.
+            overrides (dict): The payload overrides it is posted with.
+
+        Returns:
+            bool: Whether the message was dropped or taken.
+        """
+        if self.deduplicator is not None and self.deduplicator.suppress(self.room_url, message, overrides):
+            if metrics.enabled:
+                metrics.increment('suppressed_total', metrics.labels(self))
+            return True
+        if self.coalescer is not None:
+            self.coalescer.add(message, overrides)
+            return True
+        return False
+
+    def _is_too_long(self, message):
+        # Posted whole, it would only be refused after a round trip. Messages that aren't text are posted as they are.
+        return isinstance(message, str) and self.max_text_length is not None and len(message) > self.max_text_length
+
+    def _post_coalesced(self, message, overrides):
+        if self._is_too_long(message):
+            return self.post_chunks(message, **overrides)[-1]
+        return self._send(self._process_data(message, **overrides))
+
+    def post_chunks(self, source, **kwargs):
+        """Post text that may be too long for one post, split into numbered chunks of at most `max_text_length`
+        characters at line and code block boundaries. The chunks are posted one after the other, in order, over the
+        pooled connection to the chat server, and posting stops at the first chunk that is refused. `post` does this
+        by itself for text that is too long.
+
+        Args:
+            source (str|iterable): The text, or an iterable of pieces of it such as a file object, which is read as
+                the chunks are posted.
+            **kwargs: Any overriding information for the payloads.
+
+        Returns:
+            list: The response of every chunk posted.
+        """
+        results = []
+        for chunk in chunking.split(source, self.max_text_length or sys.maxsize):
+            result = self._send(self._process_data(chunk, **kwargs))
+            results.append(result)
+            if result is not None and result.status_code >= 400:
+                break
+        return results
+
+    def _send(self, data):
+        """Post an already processed payload.
+
+        Args:
+            data (bytes): The payload, as returned by `_process_data`.
+
+        Returns:
+            requests.Response: None if the payload was handed to a relay.
+        """
+        if self.relay is not None:
+            try:
+                self.relay.post(self, data)
+                return None
+            except (IOError, OSError) as error:
+                LOGGER.warning('Posting directly, the relay at %s is unreachable: %s', self.relay.path, error)
+
+        if self.outbox is None:
+            return self._post_data(data)
+
+        record_id = self.outbox.put(self.room_url, self.headers, data)
+        try:
+            result = self._post_data(data)
+        except Exception as error:
+            self.outbox.release(record_id, str(error))
+            raise
+        self.outbox.settle(record_id, result.status_code)
+        return result
+
+    def _post_data(self, data):
+        breaker = self.get_circuit_breaker()
+        if breaker is not None and not breaker.allow():
+            if metrics.enabled:
+                metrics.increment('circuit_open_total', metrics.labels(self))
+            raise exceptions.CircuitOpenError(self.room_url, breaker.retry_after())
+
+        bucket = self.get_rate_limiter()
+        session = self.get_session()
+        retries = rate_limited = 0
+        while True:
+            if bucket is not None:
+                bucket.acquire()
+            if metrics.enabled:
+                start = metrics.clock()
+            try:
+                result = session.post(
+                    url=self.room_url,
+                    data=data,
+                    headers=self.headers,
+                    timeout=self.timeout
+                )
+            except Exception as error:
+                if metrics.enabled:
+                    metrics.increment('errors_total', metrics.labels(self))
+                if breaker is not None:
+                    breaker.record_failure()
+                if not retry.is_transient(error) or not self._should_retry(retries, breaker):
+                    raise
+                retries += 1
+                time.sleep(retry.backoff(retries, *self.retry_backoff))
+                continue
+
+            if bucket is not None and bucket.observe(result) and rate_limited < self.rate_limit_retries:
+                rate_limited += 1
+                continue
+            if breaker is not None:
+                if result.status_code >= 500:
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
+            if result.status_code in retry.RETRY_STATUSES and self._should_retry(retries, breaker):
+                retries += 1
+                time.sleep(retry.backoff(retries, *self.retry_backoff))
+                continue
+            if metrics.enabled:
+                metrics.record_response(
+                    metrics.labels(self), result, metrics.clock() - start, len(data), retries + rate_limited)
+            return result
+
+    def _should_retry(self, retries, breaker):
+        return retries < self.retries and (breaker is None or breaker.allow())
+
+    def _post_stream(self, body, url=None, headers=None):
+        """Post a streamed body. It is only sent once, since it can only be read once.
+
+        Args:
+            body (upload.MultipartBody): The body.
+            url (str): The url to post to, defaults to the room url, whose rate limit and circuit breaker then apply.
+            headers (dict): The headers to post with, defaults to this instance's.
+
+        Returns:
+            requests.Response:
+        """
+        url = url or self.room_url
+        breaker = bucket = None
+        if url == self.room_url:
+            breaker = self.get_circuit_breaker()
+            bucket = self.get_rate_limiter()
+        if breaker is not None and not breaker.allow():
+            raise exceptions.CircuitOpenError(url, breaker.retry_after())
+        if bucket is not None:
+            bucket.acquire()
+
+        headers = dict(self.headers if headers is None else headers)
+        headers['Content-type'] = body.content_type
+        if metrics.enabled:
+            start = metrics.clock()
+        try:
+            result = self.get_session(url).post(url=url, data=body.stream(), headers=headers, timeout=self.timeout)
+        except Exception:
+            if metrics.enabled:
+                metrics.increment('errors_total', metrics.labels(self, url))
+            if breaker is not None:
+                breaker.record_failure()
+            raise
+
+        if breaker is not None:
+            if result.status_code >= 500:
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+        if bucket is not None:
+            bucket.observe(result)
+        if metrics.enabled:
+            metrics.record_response(metrics.labels(self, url), result, metrics.clock() - start, body.length or 0, 0)
         return result
 
+    def get_rate_limiter(self):
+        """Get the token bucket that posts to this instance's room url take from.
+
+        Returns:
+            ratelimit.TokenBucket: The bucket, or None if this instance isn't rate limited.
+        """
+        if not self.rate_limit:
+            return None
+        return ratelimit.get_bucket(self.room_url, *self.rate_limit)
+
+    def get_circuit_breaker(self):
+        """Get the circuit breaker of this instance's room url.
+
+        Returns:
+            retry.CircuitBreaker: The breaker, or None if this instance doesn't use one.
+        """
+        if not self.circuit_breaker:
+            return None
+        return retry.get_breaker(self.room_url, *self.circuit_breaker)
+
+    def submit(self, *args, **kwargs):
+        """Queue a post to be sent by the background sender instead of waiting for it. Takes the same arguments as
+        `post`, where `priority` is the lane of the background sender to queue it in, normal by default.
+
+        Returns:
+            concurrent.futures.Future: Resolves to the result of the post.
+        """
+        priority = kwargs.pop('priority', None) or delivery.NORMAL
+        return delivery.schedule(priority, self.post, *args, **kwargs)
+
 
 class Slack(Messenger):
 
     url_template = 'https://hooks.slack.com/services/{channel}/{room_id}/{token}'
+    # Slack allows one message per second per webhook, with short bursts over that.
+    rate_limit = (1.0, 4)
+    max_text_length = 4000
+    payload_defaults = (
+        ('channel', '#general'),
+        ('username', 'David Bowie'),
+        ('icon_emoji', ':ghost:'))
+
+    # Files can't be uploaded through a webhook, only through the Web API with a bot token, which is given to the
+    # instance as `bot_token`, along with the `channel_id` to share files in.
+    api_url = 'https://slack.com/api/'
 
     def __init__(self, room_id, token, channel, **kwargs):
         super(Slack, self).__init__(room_id=None, token=token, **kwargs)
@@ -74,36 +459,93 @@ class Slack(Messenger):
             room_id=self.room_id,
             token=self.token,
             channel=self.channel)
-
-    def _process_data(self, *args, **kwargs):
-        data = {
-            'text': args[0],
-            'channel': kwargs.get('channel', '#general'),
-            'username': kwargs.get('user_name', 'David Bowie'),
-            'icon_emoji': kwargs.get('icon_emoji', ':ghost:')
-        }
-
-        return json.dumps(data.update(**kwargs) if kwargs else data)
+        self.bot_token = kwargs.get('bot_token')
+        self.channel_id = kwargs.get('channel_id')
+        if kwargs.get('api_url'):
+            self.api_url = kwargs.get('api_url')
+
+    def _call_api(self, method, **kwargs):
+        result = self.get_session(self.api_url).post(
+            url=self.api_url + method,
+            headers={'Authorization': 'Bearer {0}'.format(self.bot_token)},
+            timeout=self.timeout,
+            **kwargs)
+        try:
+            data = result.json()
+        except ValueError:
+            data = {'ok': False, 'error': 'HTTP {0}'.format(result.status_code)}
+        if not data.get('ok'):
+            raise exceptions.UploadError(method, data.get('error'))
+        return result, data
+
+    def post_file(self, file, message=None, filename=None, title=None, channel_id=None, gzip=False):
+        """Upload a file and share it in a channel, streamed from disk in chunks. Uses Slack's external upload flow,
+        which needs the instance's `bot_token`.
+
+        Args:
+            file (str|file): The path of the file, or a file object opened in binary mode, such as an `mmap.mmap`.
+            message (str): The message to share the file with.
+            filename (str): The name to upload the file as, defaults to the name of the file.
+            title (str): The title of the file, defaults to its name.
+            channel_id (str): The id of the channel to share the file in, defaults to the instance's `channel_id`.
+            gzip (bool): Whether to gzip the file on the way, for text logs.
+
+        Returns:
+            requests.Response: The response of completing the upload.
+        """
+        if not self.bot_token:
+            raise ValueError('Uploading files to Slack needs a bot_token.')
+        source = upload.FileSource(file, filename)
+        try:
+            if gzip:
+                source = source.gzip()
+            if source.size is None:
+                raise ValueError('Slack needs the size of the file before it is uploaded.')
+            _, ticket = self._call_api(
+                'files.getUploadURLExternal',
+                data={'filename': source.filename, 'length': source.size})
+            result = self._post_stream(
+                upload.MultipartBody(files=[('file', source)]),
+                url=ticket['upload_url'],
+                headers={})
+            if result.status_code >= 400:
+                raise exceptions.UploadError('upload', 'HTTP {0}'.format(result.status_code))
+            completion = {
+                'files': [{'id': ticket['file_id'], 'title': title or source.filename}],
+                'channel_id': channel_id or self.channel_id
+            }
+            if message:
+                completion['initial_comment'] = message
+            result, _ = self._call_api('files.completeUploadExternal', json=completion)
+            return result
+        finally:
+            source.close()
 
 
 class HipChat(Messenger):
 
-    url_template = ''
-
-    def _process_data(self, *args, **kwargs):
-        data = {
-            'message': args[0],
-            'notify': kwargs.get('notify', True),
-            'color': kwargs.get('color', 'blue'),
-            'message_format': kwargs.get('message_format', 'text')
-        }
+    url_template = 'https://api.hipchat.com/v2/room/{room_id}/notification'
+    max_text_length = 10000
+    text_key = 'message'
+    payload_defaults = (
+        ('notify', True),
+        ('color', 'blue'),
+        ('message_format', 'text'))
 
-        return json.dumps(data.update(**kwargs) if kwargs else data)
+    def __init__(self, room_id, token, **kwargs):
+        super(HipChat, self).__init__(room_id=room_id, token=token, **kwargs)
+        self.room_url = self.url_template.format(
+            room_id=self.room_id,
+            token=self.token)
 
 
 class Mattermost(Messenger):
 
     url_template = 'http://{base_url}/hooks/{token}'
+    max_text_length = 16383
+    payload_defaults = (
+        ('username', 'David Bowie'),
+        ('channel', 'town-square'))
 
     def __init__(self, token, base_url, **kwargs):
         super(Mattermost, self).__init__(room_id=None, token=token, **kwargs)
@@ -111,18 +553,14 @@ class Mattermost(Messenger):
         self.base_url = base_url
         self.room_url = self.url_template.format(token=self.token, base_url=self.base_url)
 
-    def _process_data(self, *args, **kwargs):
-        data = {
-            'text': args[0],
-            'username': kwargs.get('user_name', 'David Bowie'),
-            'channel': kwargs.get('channel', 'town-square')
-        }
-
-        return json.dumps(data.update(**kwargs) if kwargs else data)
-
 
 class RocketChat(Messenger):
     url_template = 'http://{base_url}/hooks/{token}'
+    max_text_length = 5000
+    payload_defaults = (
+        ('channel', '#general'),
+        ('username', 'monkey-bot'),
+        ('icon_emoji', ':monkey_face:'))
 
     def __init__(self, base_url, token, **kwargs):
         super(RocketChat, self).__init__(room_id=None, token=token, **kwargs)
@@ -132,227 +570,532 @@ class RocketChat(Messenger):
             base_url=self.base_url,
             token=self.token)
 
-    def _process_data(self, *args, **kwargs):
-        data = {
-            'text': args[0],
-            "channel": kwargs.get('channel', "#general"),
-            "username": kwargs.get('user_name', 'monkey-bot'),
-            "icon_emoji": kwargs.get('icon_emoji', ':monkey_face:')
-        }
-
-        return json.dumps(data.update(**kwargs) if kwargs else data)
-
 
 class Discord(Messenger):
     url_template = 'https://discordapp.com/api/webhooks/{room_id}/{token}'
+    # Discord allows five requests every two seconds per webhook.
+    rate_limit = (2.5, 5)
+    max_text_length = 2000
+    text_key = 'content'
+    payload_defaults = (
+        ('username', 'David Bowie'),)
 
-    def _process_data(self, *args, **kwargs):
-        data = {
-            'content': args[0],
-            'username': kwargs.get('user_name', 'David Bowie'),
+    def __init__(self, room_id, token, **kwargs):
+        super(Discord, self).__init__(room_id=room_id, token=token, **kwargs)
+        self.room_url = self.url_template.format(
+            room_id=self.room_id,
+            token=self.token)
+
+    def post_file(self, file, message=None, filename=None, gzip=False, **kwargs):
+        """Post a file as an attachment, streamed from disk in chunks.
+
+        Args:
+            file (str|file): The path of the file, or a file object opened in binary mode, such as an `mmap.mmap`.
+            message (str): The message to post with the file.
+            filename (str): The name to upload the file as, defaults to the name of the file.
+            gzip (bool): Whether to gzip the file on the way, for text logs.
+            **kwargs: Payload overrides, as for `post`.
+
+        Returns:
+            requests.Response:
+        """
+        source = upload.FileSource(file, filename)
+        try:
+            if gzip:
+                source = source.gzip()
+            body = upload.MultipartBody(
+                fields=[('payload_json', self._process_data(message or '', **kwargs), 'application/json')],
+                files=[('files[0]', source)])
+            return self._post_stream(body)
+        finally:
+            source.close()
+
+
+# Instances built by the post_to_* decorators, shared between every decorated function.
+instance_cache = InstanceCache()
+
+
+def _deliver(instance, background, priority, *args, **kwargs):
+    """Post with the given instance on behalf of a decorator.
+
+    Args:
+        instance (Messenger): The Messenger instance to post with.
+        background (bool): Whether to queue the post on the background sender instead of waiting for it.
+        priority (str): The lane of the background sender to queue the post in, which implies background.
+        *args: The positional arguments for the post.
+        **kwargs: The keyword arguments for the post.
+
+    Returns:
+        requests.Response|concurrent.futures.Future: The result of the post, or the future of it when in background.
+    """
+    if background or priority is not None:
+        return instance.submit(*args, priority=priority, **kwargs)
+    return instance.post(*args, **kwargs)
+
+
+# The posts scheduled by decorated coroutine functions that haven't finished yet.
+_async_posts = set()
+
+
+async def _post_async(post):
+    try:
+        return await post
+    except Exception as error:
+        LOGGER.warning('Post failed: %s', error, exc_info=True)
+        raise
+
+
+def _forget_async_post(post):
+    _async_posts.discard(post)
+    if not post.cancelled():
+        # Failures are already logged, this keeps asyncio from warning about them again.
+        post.exception()
+
+
+def _track(post):
+    """Keep hold of a post scheduled on the running event loop until it finishes, for `flush_async` to wait on.
+
+    Args:
+        post (asyncio.Future): The post.
+
+    Returns:
+        asyncio.Future: The post.
+    """
+    _async_posts.add(post)
+    post.add_done_callback(_forget_async_post)
+    return post
+
+
+def _schedule(instance, priority, *args, **kwargs):
+    """Post on behalf of a decorated coroutine function, without blocking the running event loop. AsyncMessenger
+    instances post as a task on the loop, and the others post from the background sender.
+
+    Args:
+        instance (Messenger): The Messenger instance to post with.
+        priority (str): The lane of the background sender to queue the post in. AsyncMessenger instances don't use
+            the background sender, and post right away regardless.
+        *args: The positional arguments for the post.
+        **kwargs: The keyword arguments for the post.
+
+    Returns:
+        asyncio.Future: Resolves to the result of the post.
+    """
+    import asyncio
+
+    if inspect.iscoroutinefunction(instance.post):
+        return _track(asyncio.ensure_future(_post_async(instance.post(*args, **kwargs))))
+    return _track(asyncio.wrap_future(instance.submit(*args, priority=priority, **kwargs)))
+
+
+async def flush_async(timeout=None):
+    """Wait for the posts that decorated coroutine functions scheduled on the running event loop. Should be awaited
+    before the loop shuts down, since the posts still pending then are lost.
+
+    Args:
+        timeout (float): The most seconds to wait, or None to wait for as long as it takes.
+
+    Returns:
+        bool: Whether every post was finished before the timeout.
+    """
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    posts = [post for post in _async_posts if post.get_loop() is loop]
+    if not posts:
+        return True
+    _, pending = await asyncio.wait(posts, timeout=timeout)
+    return not pending
+
+
+def _message_builder(func, message):
+    """Get what builds the message posted for each call of a decorated function.
+
+    Args:
+        func (callable): The decorated function.
+        message (str|Template): The message to post.
+
+    Returns:
+        tuple: A function that takes the args, kwargs, result, exception and elapsed seconds of a call and returns its
+            message, whether calls have to be timed, and whether calls that raise are posted too.
+    """
+    if not isinstance(message, template.Template):
+        return (lambda *call: message), False, False
+
+    signature = message.parameters(func)
+    name = getattr(func, '__qualname__', func.__name__)
+
+    def build(args, kwargs, result, exception, elapsed):
+        # Only called when there's a post to make, which is then given the text rather than what it's formatted from,
+        # so that neither the post nor a queued call holds on to the arguments the caller may change.
+        context = {
+            template.NAME: name,
+            template.ARGS: args,
+            template.KWARGS: kwargs,
+            template.RESULT: result,
+            template.EXCEPTION: exception,
+            template.ELAPSED: elapsed
         }
-        return json.dumps(data.update(**kwargs) if kwargs else data)
+        if signature is not None:
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            context = dict(bound.arguments, **context)
+        return message.render(context)
+    return build, template.ELAPSED in message.fields, template.EXCEPTION in message.fields
+
+
+def _decorate(func, get_instance, message, data, background, priority):
+    """Wrap a function so that a message is posted every time it returns. Coroutine functions get a coroutine
+    function wrapper, which awaits them and then schedules the post without waiting for it.
+
+    Args:
+        func (callable): The function to wrap.
+        get_instance (callable): Returns the Messenger instance to post with.
+        message (str|Template): The message to post.
+        data (dict): Any extra data to include in the payload.
+        background (bool): Whether to post from the background sender instead of waiting for the post.
+        priority (str): The lane of the background sender to queue the posts in, which implies background.
+
+    Returns:
+        callable:
+    """
+    build, timed_calls, post_failures = _message_builder(func, message)
+
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            start = metrics.clock() if timed_calls else None
+            try:
+                result = await func(*args, **kwargs)
+            except Exception as error:
+                if post_failures:
+                    elapsed = metrics.clock() - start if timed_calls else None
+                    _schedule(get_instance(), priority, build(args, kwargs, None, error, elapsed), **(data or {}))
+                raise
+            elapsed = metrics.clock() - start if timed_calls else None
+            _schedule(get_instance(), priority, build(args, kwargs, result, None, elapsed), **(data or {}))
+            return result
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = metrics.clock() if timed_calls else None
+        try:
+            result = func(*args, **kwargs)
+        except Exception as error:
+            if post_failures:
+                elapsed = metrics.clock() - start if timed_calls else None
+                failure = build(args, kwargs, None, error, elapsed)
+                try:
+                    _deliver(get_instance(), background, priority, failure, **(data or {}))
+                except Exception as post_error:
+                    # The function's own exception matters more than the post about it.
+                    LOGGER.warning('Post failed: %s', post_error, exc_info=True)
+            raise
+        elapsed = metrics.clock() - start if timed_calls else None
+        _deliver(get_instance(), background, priority, build(args, kwargs, result, None, elapsed), **(data or {}))
+        return result
+    return wrapper
 
 
-def post_to_mattermost(message, token, base_url='localhost:8065', data=None):
+def post_to_mattermost(message, token, base_url='localhost:8065', data=None, background=False, priority=None):
     """Decorator for posting to Mattermost.
 
     Args:
-        message (str): The message to post.
+        message (str|Template): The message to post.
         token (str): The authorization token to use.
         base_url (str): The base URL to use, default is 'localhost:8065'.
         data (dict): Any extra data to include in the payload.
+        background (bool): Whether to post from the background sender instead of waiting for the post.
+        priority (str): Post from this lane of the background sender, one of 'high', 'normal' and 'low'.
 
     Returns:
 
     """
     def process(func):
-        def wrapper(*args, **kwargs):
-            func(*args, **kwargs)
-            instance = Mattermost(
-                token=token,
-                base_url=base_url)
-            instance.post(message, kwargs.update(data) if data else kwargs)
-        return wrapper
+        def get_instance():
+            return instance_cache.get(Mattermost, token=token, base_url=base_url)
+        return _decorate(func, get_instance, message, data, background, priority)
     return process
 
 
-def mattermost(message, instance, data=None):
+def mattermost(message, instance, data=None, background=False, priority=None):
     """Decorator for posting to a Mattermost instance.
 
     Args:
-        message (str): The message to post.
+        message (str|Template): The message to post.
         instance (Mattermost): The Mattermost instance to use.
         data (dict): Any extra data to include in the payload.
+        background (bool): Whether to post from the background sender instead of waiting for the post.
+        priority (str): Post from this lane of the background sender, one of 'high', 'normal' and 'low'.
 
     Returns:
         callable:
     """
-    return messenger(message, instance, data)
+    return messenger(message, instance, data, background, priority)
 
 
-def post_to_discord(message, room_id, token, data=None):
+def post_to_discord(message, room_id, token, data=None, background=False, priority=None):
     """Decorator for posting to Discord.
 
     Args:
-        message (str): The message to post.
+        message (str|Template): The message to post.
         room_id (str):
         token (str): The authorization token to use.
         data (dict): Any extra data to include in the payload.
+        background (bool): Whether to post from the background sender instead of waiting for the post.
+        priority (str): Post from this lane of the background sender, one of 'high', 'normal' and 'low'.
 
     Returns:
 
     """
     def process(func):
-        def wrapper(*args, **kwargs):
-            func(*args, **kwargs)
-            instance = Discord(
-                room_id=room_id,
-                token=token)
-            instance.post(message, kwargs.update(data) if data else kwargs)
-        return wrapper
+        def get_instance():
+            return instance_cache.get(Discord, room_id=room_id, token=token)
+        return _decorate(func, get_instance, message, data, background, priority)
     return process
 
 
-def messenger(message, instance, data):
+def messenger(message, instance, data=None, background=False, priority=None):
     """Generic method called by
 
     Args:
-        message (str): The message to post.
+        message (str|Template): The message to post.
+        instance (Messenger): The Messenger instance to use.
+        data (dict): Any extra data to include in the payload.
+        background (bool): Whether to post from the background sender instead of waiting for the post.
+        priority (str): Post from this lane of the background sender, one of 'high', 'normal' and 'low'.
+
+    Returns:
+
+    Raises:
+        TypeError: If the instance is an AsyncMessenger and the decorated function isn't a coroutine function, since
+            nothing would await its posts.
+    """
+    def process(func):
+        if inspect.iscoroutinefunction(instance.post) and not inspect.iscoroutinefunction(func):
+            raise TypeError('An AsyncMessenger can only post for coroutine functions, not {0}'.format(
+                getattr(func, '__qualname__', func.__name__)))
+        return _decorate(func, lambda: instance, message, data, background, priority)
+    return process
+
+
+class _LoopSender(object):
+    """Posts with an AsyncMessenger from any thread, such as a timer's, by scheduling the post on the event loop the
+    instance was last used from.
+
+    Args:
+        instance (AsyncMessenger): The instance to post with.
+        data (dict): Any extra data to include in the payload.
+    """
+
+    def __init__(self, instance, data=None):
+        self.instance = instance
+        self.data = data
+        self.loop = None
+
+    def __call__(self, message):
+        loop = self.loop
+        if loop is None or loop.is_closed():
+            LOGGER.warning('Dropped a post of %s, the event loop it was posted from is closed.',
+                           type(self.instance).__name__)
+            return
+        loop.call_soon_threadsafe(functools.partial(_schedule, self.instance, None, message, **(self.data or {})))
+
+
+def timed(instance, interval=timing.DEFAULT_INTERVAL, every=None, slow=None, max_error_rate=None, name=None,
+          data=None):
+    """Decorator for monitoring a function, which posts a summary of its calls' count, error rate and p50/p95/p99
+    durations once per window, instead of a message per call. Recording a call only costs a couple of clock reads
+    and a histogram update.
+
+    Args:
         instance (Messenger): The Messenger instance to use.
+        interval (float): The most seconds a window stays open after its first call.
+        every (int): The most calls in a window, or None for no limit.
+        slow (float): Only post summaries whose p95 takes longer than this many seconds.
+        max_error_rate (float): Only post summaries whose fraction of failed calls is over this, between 0 and 1.
+        name (str): The name to start the summary with, defaults to the function's qualified name.
         data (dict): Any extra data to include in the payload.
 
     Returns:
+        callable: The decorator. The functions it decorates have the TimingAggregator recording them as `timing`.
 
+    Raises:
+        TypeError: If the instance is an AsyncMessenger and the decorated function isn't a coroutine function. Its
+            summaries are posted on the event loop of the last call, so `timing.flush()` and then `flush_async`
+            should be awaited before that loop closes.
     """
     def process(func):
+        loop_sender = None
+        if inspect.iscoroutinefunction(instance.post):
+            if not inspect.iscoroutinefunction(func):
+                raise TypeError('An AsyncMessenger can only post the timing of coroutine functions, not {0}'.format(
+                    getattr(func, '__qualname__', func.__name__)))
+            loop_sender = _LoopSender(instance, data)
+        aggregator = timing.TimingAggregator(
+            loop_sender or (lambda summary: instance.post(summary, **(data or {}))),
+            name=name or getattr(func, '__qualname__', func.__name__),
+            interval=interval,
+            every=every,
+            slow=slow,
+            max_error_rate=max_error_rate)
+
+        if inspect.iscoroutinefunction(func):
+            import asyncio
+
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                if loop_sender is not None:
+                    loop_sender.loop = asyncio.get_running_loop()
+                start = metrics.clock()
+                try:
+                    result = await func(*args, **kwargs)
+                except Exception as error:
+                    aggregator.record(metrics.clock() - start, error)
+                    raise
+                aggregator.record(metrics.clock() - start)
+                return result
+            async_wrapper.timing = aggregator
+            return async_wrapper
+
+        @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            func(*args, **kwargs)
-            instance.post(message, kwargs.update(data) if data else kwargs)
+            start = metrics.clock()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as error:
+                aggregator.record(metrics.clock() - start, error)
+                raise
+            aggregator.record(metrics.clock() - start)
+            return result
+        wrapper.timing = aggregator
         return wrapper
     return process
 
 
-def discord(message, instance, data=None):
+def discord(message, instance, data=None, background=False, priority=None):
     """Decorator for posting to a Discord instance.
 
     Args:
-        message (str): The message to post.
+        message (str|Template): The message to post.
         instance (Messenger): The Discord instance to use.
         data (dict): Any extra data to include in the payload.
+        background (bool): Whether to post from the background sender instead of waiting for the post.
+        priority (str): Post from this lane of the background sender, one of 'high', 'normal' and 'low'.
 
     Returns:
 
     """
-    return messenger(message, instance, data)
+    return messenger(message, instance, data, background, priority)
 
 
-def post_to_hipchat(message, room_id, token, data=None):
+def post_to_hipchat(message, room_id, token, data=None, background=False, priority=None):
     """Decorator for posting to Hipchat.
 
     Args:
-        message (str): The message to post.
+        message (str|Template): The message to post.
         room_id (str): The ID of the group to post to.
         token (str): The authorization token to use.
         data (dict): Any extra data to include in the payload.
+        background (bool): Whether to post from the background sender instead of waiting for the post.
+        priority (str): Post from this lane of the background sender, one of 'high', 'normal' and 'low'.
 
     Returns:
         callable:
     """
     def process(func):
-        def wrapper(*args, **kwargs):
-            func(*args, **kwargs)
-            instance = HipChat(room_id=room_id, token=token)
-            instance.post(message, kwargs.update(data) if data else kwargs)
-        return wrapper
+        def get_instance():
+            return instance_cache.get(HipChat, room_id=room_id, token=token)
+        return _decorate(func, get_instance, message, data, background, priority)
     return process
 
 
-def hipchat(message, instance, data=None):
+def hipchat(message, instance, data=None, background=False, priority=None):
     """Decorator to post a message to a Hipchat instance.
 
     Args:
-        message (str): The message to post.
+        message (str|Template): The message to post.
         instance (HipChat): The Hipchat instance to use.
         data (dict): Any extra data to include in the payload.
+        background (bool): Whether to post from the background sender instead of waiting for the post.
+        priority (str): Post from this lane of the background sender, one of 'high', 'normal' and 'low'.
 
     Returns:
 
     """
-    return messenger(message, instance, data)
+    return messenger(message, instance, data, background, priority)
 
 
-def post_to_slack(message, room_id, channel, token, data=None):
+def post_to_slack(message, room_id, channel, token, data=None, background=False, priority=None):
     """Decorator for posting to Slack.
 
     Args:
-        message (str): The message to post.
+        message (str|Template): The message to post.
         room_id (str): The id of the group.
         channel (str): The channel to post to.
         token (str): The authorization token to use.
         data (dict): Any extra data to include in the payload.
+        background (bool): Whether to post from the background sender instead of waiting for the post.
+        priority (str): Post from this lane of the background sender, one of 'high', 'normal' and 'low'.
 
     Returns:
 
     """
     def process(func):
-        def wrapper(*args, **kwargs):
-            func(*args, **kwargs)
-            instance = Slack(
-                room_id=room_id,
-                channel=channel,
-                token=token)
-            instance.post(message, kwargs.update(data) if data else kwargs)
-        return wrapper
+        def get_instance():
+            return instance_cache.get(Slack, room_id=room_id, channel=channel, token=token)
+        return _decorate(func, get_instance, message, data, background, priority)
     return process
 
 
-def slack(message, instance, data=None):
+def slack(message, instance, data=None, background=False, priority=None):
     """Decorator for posting a Slack instance.
 
     Args:
-        message (str): The message to post.
+        message (str|Template): The message to post.
         instance (Slack): The Slack instance to use.
         data (dict): Any overriding information for the payload.
+        background (bool): Whether to post from the background sender instead of waiting for the post.
+        priority (str): Post from this lane of the background sender, one of 'high', 'normal' and 'low'.
 
     Returns:
 
     """
-    return messenger(message, instance, data)
+    return messenger(message, instance, data, background, priority)
 
 
-def post_to_rocketchat(message, base_url, token, data=None):
+def post_to_rocketchat(message, base_url, token, data=None, background=False, priority=None):
     """Decorator for posting to Rocketchat.
 
     Args:
-        message (str): The message to post.
+        message (str|Template): The message to post.
         base_url (str): The base url to post to.
         token (str): The token to use.
         data (dict): Any overriding information for the payload.
+        background (bool): Whether to post from the background sender instead of waiting for the post.
+        priority (str): Post from this lane of the background sender, one of 'high', 'normal' and 'low'.
 
     Returns:
 
     """
     def process(func):
-        def wrapper(*args, **kwargs):
-            func(*args, **kwargs)
-            instance = RocketChat(
-                base_url=base_url,
-                token=token)
-            instance.post(message, kwargs.update(data) if data else kwargs)
-        return wrapper
+        def get_instance():
+            return instance_cache.get(RocketChat, base_url=base_url, token=token)
+        return _decorate(func, get_instance, message, data, background, priority)
     return process
 
 
-def rocketchat(message, instance, data=None):
+def rocketchat(message, instance, data=None, background=False, priority=None):
     """Decorator for posting to Rocketchat.
 
     Args:
-        message (str): The message to post.
+        message (str|Template): The message to post.
         instance (Messenger):
         data (dict): Any overriding information for the payload.
+        background (bool): Whether to post from the background sender instead of waiting for the post.
+        priority (str): Post from this lane of the background sender, one of 'high', 'normal' and 'low'.
 
     Returns:
 
     """
-    return messenger(message, instance, data)
+    return messenger(message, instance, data, background, priority)
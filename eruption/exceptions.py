@@ -0,0 +1,51 @@
+"""Exceptions raised by eruption itself, as opposed to the ones of the HTTP libraries it posts with."""
+
+
+__all__ = [
+    'EruptionError',
+    'CircuitOpenError',
+    'UploadError',
+    'QueueFullError'
+]
+
+
+class EruptionError(Exception):
+    """Base class of every exception raised by eruption."""
+
+
+class CircuitOpenError(EruptionError, IOError):
+    """Raised instead of posting while the circuit breaker of the room url is open, because the chat server kept
+    failing. It is an IOError, like the connection errors of requests, so that code catching those catches it too.
+
+    Args:
+        url (str): The room url that wasn't posted to.
+        retry_after (float): The seconds until the breaker lets a post through again.
+    """
+
+    def __init__(self, url, retry_after):
+        super(CircuitOpenError, self).__init__(
+            'Not posting, the circuit breaker is open after repeated failures. Retrying in {0:.1f}s.'.format(
+                retry_after))
+        self.url = url
+        self.retry_after = retry_after
+
+
+class UploadError(EruptionError):
+    """Raised when the chat service's API refuses a step of a file upload.
+
+    Args:
+        step (str): The API method that failed.
+        error (str): The error the API gave.
+    """
+
+    def __init__(self, step, error):
+        super(UploadError, self).__init__('Uploading failed at {0}: {1}'.format(step, error))
+        self.step = step
+        self.error = error
+
+
+class QueueFullError(EruptionError):
+    """Set on the future of a background post that was dropped because the queue of the background sender was full."""
+
+    def __init__(self):
+        super(QueueFullError, self).__init__('Dropped the post, the background queue is full')
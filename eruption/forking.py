@@ -0,0 +1,28 @@
+"""Fork safety for pre-forking servers such as gunicorn and uWSGI, and for multiprocessing. A forked child inherits
+the parent's connections, locks that may have been held by one of the parent's threads at the time, and queues that
+the parent's threads, which don't exist in the child, were working through. Every module with such state registers a
+function with `after_fork` to give the child its own: new locks, empty pools that connect again on first use, and
+empty queues, since what was queued before the fork is the parent's to send.
+"""
+
+
+# import built-in modules
+import os
+
+__all__ = [
+    'after_fork'
+]
+
+
+def after_fork(function):
+    """Decorator registering a function to be called in the child process after every fork.
+
+    Args:
+        function (callable): Called without arguments. It should only replace state, and must not raise.
+
+    Returns:
+        callable: The function, unchanged.
+    """
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=function)
+    return function
@@ -0,0 +1,218 @@
+"""A logging handler that posts records through a Messenger. Records are formatted by the thread that logs them and
+put on a bounded queue, which a listener thread drains by joining the records that come in together into as few
+posts as the platform's length limit allows, so that logging never waits on a chat server.
+"""
+
+
+# import built-in modules
+import logging
+import threading
+import time
+import weakref
+
+try:
+    import queue
+except ImportError:  # pragma: no cover
+    import Queue as queue
+
+# import local modules
+from eruption import forking
+from eruption import ratelimit
+
+__all__ = [
+    'MessengerHandler'
+]
+
+
+DEFAULT_CAPACITY = 10000
+DEFAULT_BATCH_WINDOW = 1.0
+DEFAULT_MAX_RECORDS = 50
+# How long flushing and closing the handler, which `logging.shutdown` does at exit, wait for the queued records to be
+# posted by default.
+FLUSH_TIMEOUT = 5.0
+SEPARATOR = '\n'
+DROPPED_TEMPLATE = '({0} log record(s) dropped)'
+
+_FLUSH = object()
+_STOP = object()
+
+_handlers = weakref.WeakSet()
+
+
+class MessengerHandler(logging.Handler):
+    """Posts log records through a Messenger from a listener thread.
+
+    The listener waits up to `batch_window` seconds after a record for more to come in, and posts them joined with
+    newlines, splitting the batch where the joined text would go over the Messenger's `max_text_length`. Records that
+    go over the rate limit, or that find the queue full, are dropped and counted, and the next post says how many
+    were dropped.
+
+    Args:
+        instance (Messenger): The Messenger instance to post with. Its posts are sent from the listener thread, so it
+            should be a blocking Messenger rather than an AsyncMessenger.
+        level (int): The lowest level of the records to post.
+        rate_limit (tuple): The number of records posted per second and how many can be posted in a burst. None
+            posts every record.
+        batch_window (float): The most seconds to wait for more records before posting.
+        max_records (int): The most records joined into one post.
+        capacity (int): The most records waiting to be posted.
+    """
+
+    def __init__(self, instance, level=logging.ERROR, rate_limit=None, batch_window=DEFAULT_BATCH_WINDOW,
+                 max_records=DEFAULT_MAX_RECORDS, capacity=DEFAULT_CAPACITY):
+        super(MessengerHandler, self).__init__(level)
+        self.instance = instance
+        self.batch_window = batch_window
+        self.max_records = max_records
+        self.capacity = capacity
+        self.bucket = ratelimit.TokenBucket(*rate_limit) if rate_limit else None
+        self.dropped = 0
+        self._unreported = 0
+        self._queue = queue.Queue(capacity)
+        self._thread = None
+        self._pending = 0
+        self._condition = threading.Condition()
+        _handlers.add(self)
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._listen, name='eruption-log-handler')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def emit(self, record):
+        if threading.current_thread() is self._thread:
+            # Logged while posting, most likely about the post itself, which would feed back into the handler.
+            return
+        if self.bucket is not None and not self.bucket.try_acquire():
+            self._drop()
+            return
+        try:
+            text = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+        self._ensure_started()
+        with self._condition:
+            self._pending += 1
+        try:
+            self._queue.put_nowait((record, text))
+        except queue.Full:
+            self._done(1)
+            self._drop()
+
+    def _drop(self):
+        with self._condition:
+            self.dropped += 1
+            self._unreported += 1
+
+    def _done(self, count):
+        with self._condition:
+            self._pending -= count
+            if not self._pending:
+                self._condition.notify_all()
+
+    def _listen(self):
+        item = None
+        while True:
+            if item is None:
+                item = self._queue.get()
+            if item is _STOP:
+                return
+            if item is _FLUSH:
+                item = None
+                self._done(1)
+                continue
+            batch = [item]
+            length = len(item[1])
+            item = None
+            deadline = time.time() + self.batch_window
+            while len(batch) < self.max_records:
+                try:
+                    item = self._queue.get(timeout=max(deadline - time.time(), 0))
+                except queue.Empty:
+                    item = None
+                    break
+                if item is _FLUSH or item is _STOP or not self._fits(length, item[1]):
+                    break
+                batch.append(item)
+                length += len(SEPARATOR) + len(item[1])
+                item = None
+            self._post(batch)
+
+    def _fits(self, length, text):
+        limit = getattr(self.instance, 'max_text_length', None)
+        return limit is None or length + len(SEPARATOR) + len(text) <= limit
+
+    def _post(self, batch):
+        texts = [text for _, text in batch]
+        with self._condition:
+            unreported, self._unreported = self._unreported, 0
+        if unreported:
+            texts.append(DROPPED_TEMPLATE.format(unreported))
+        try:
+            self.instance.post(SEPARATOR.join(texts))
+        except Exception:
+            self.handleError(batch[0][0])
+        finally:
+            self._done(len(batch))
+
+    @property
+    def pending(self):
+        """int: The number of records queued or being posted."""
+        return self._pending
+
+    def flush(self, timeout=FLUSH_TIMEOUT):
+        """Post the queued records right away, and wait for them to be posted.
+
+        Args:
+            timeout (float): The most seconds to wait, or None to wait for as long as it takes.
+
+        Returns:
+            bool: Whether every record was posted before the timeout.
+        """
+        if self._thread is None:
+            return True
+        with self._condition:
+            self._pending += 1
+        try:
+            self._queue.put_nowait(_FLUSH)
+        except queue.Full:
+            # The listener is already busy with a full queue, and will get to the end of it without a nudge.
+            self._done(1)
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while self._pending:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def close(self):
+        """Post the queued records, waiting up to FLUSH_TIMEOUT seconds, then stop the listener."""
+        try:
+            if self.flush() and self._thread is not None:
+                self._queue.put(_STOP)
+                self._thread = None
+        finally:
+            super(MessengerHandler, self).close()
+
+    def _reset_after_fork(self):
+        # The listener didn't survive the fork, and the queued records are the parent's to post.
+        self._queue = queue.Queue(self.capacity)
+        self._thread = None
+        self._pending = 0
+        self._unreported = 0
+        self._condition = threading.Condition()
+        if self.bucket is not None:
+            self.bucket._lock = threading.Lock()
+
+
+@forking.after_fork
+def _reset_after_fork():
+    for handler in list(_handlers):
+        handler._reset_after_fork()
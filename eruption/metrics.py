@@ -0,0 +1,446 @@
+"""Delivery instrumentation. While enabled, every post records how long its payload took to serialize, how long the
+request took, the response's status, the payload's size, how many times it was retried and how long it waited in the
+background queue. The measurements are labeled by messenger class and endpoint host, kept in an in-process registry
+that can be exported as Prometheus text or logged periodically, and handed to any hooks that were added, such as one
+forwarding them to statsd.
+
+Instrumentation is off by default, and costs a single flag check per post while it is:
+
+    from eruption import metrics
+
+    metrics.enable()
+    metrics.start_reporter(interval=60)
+"""
+
+
+# import built-in modules
+import bisect
+import logging
+import threading
+import time
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:  # pragma: no cover
+    from urlparse import urlsplit
+
+# import local modules
+from eruption import forking
+
+__all__ = [
+    'Histogram',
+    'MetricsRegistry',
+    'enable',
+    'disable',
+    'add_hook',
+    'remove_hook',
+    'get_registry',
+    'to_prometheus',
+    'start_reporter',
+    'stop_reporter'
+]
+
+
+try:
+    clock = time.perf_counter
+except AttributeError:  # pragma: no cover
+    clock = time.time
+
+# Checked by the instrumented code before measuring anything.
+enabled = False
+
+NAMESPACE = 'eruption'
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Histogram(object):
+    """A streaming histogram with fixed bucket bounds. It keeps a count per bucket rather than the observations
+    themselves, so its memory doesn't grow with the number of observations, and estimates quantiles by interpolating
+    within the bucket they fall in.
+
+    Args:
+        bounds (list): The upper bound of every bucket, in ascending order. Observations above the last bound go in
+            an overflow bucket.
+    """
+
+    __slots__ = ('bounds', 'counts', 'count', 'sum', 'min', 'max')
+
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    @classmethod
+    def exponential(cls, start, factor, count):
+        """Create a histogram whose bucket bounds grow by a constant factor, which keeps the relative error of its
+        quantile estimates constant.
+
+        Args:
+            start (float): The upper bound of the first bucket.
+            factor (float): How much bigger each bound is than the one before.
+            count (int): The number of buckets.
+
+        Returns:
+            Histogram:
+        """
+        return cls([start * factor ** index for index in range(count)])
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def quantile(self, fraction):
+        """Estimate a quantile of the observations.
+
+        Args:
+            fraction (float): The quantile, between 0 and 1, such as 0.99 for the 99th percentile.
+
+        Returns:
+            float: The estimate, or None if nothing was observed.
+        """
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            if not bucket_count or seen + bucket_count < rank:
+                seen += bucket_count
+                continue
+            lower = self.bounds[index - 1] if index else self.min
+            upper = self.bounds[index] if index < len(self.bounds) else self.max
+            lower, upper = max(lower, self.min), min(upper, self.max)
+            return lower + (upper - lower) * (rank - seen) / bucket_count
+        return self.max
+
+    def cumulative_counts(self):
+        """Get the number of observations at or below every bound, as Prometheus buckets are.
+
+        Returns:
+            list: Pairs of a bound and a count, ending with an infinite bound counting every observation.
+        """
+        total = 0
+        pairs = []
+        for bound, bucket_count in zip(self.bounds + (float('inf'),), self.counts):
+            total += bucket_count
+            pairs.append((bound, total))
+        return pairs
+
+
+# The buckets of each histogram that is recorded, by metric name.
+HISTOGRAMS = {
+    'serialize_seconds': (1e-06, 2.0, 16),
+    'request_seconds': (0.001, 2.0, 15),
+    'queue_wait_seconds': (0.001, 2.0, 15),
+    'payload_bytes': (64, 2.0, 14)
+}
+
+# What every metric measures, for the Prometheus HELP lines.
+DESCRIPTIONS = {
+    'serialize_seconds': 'Seconds spent building the JSON payload of a post.',
+    'request_seconds': 'Seconds spent on each webhook request.',
+    'queue_wait_seconds': 'Seconds a background post waited in the queue before being sent.',
+    'payload_bytes': 'Size of the payload of each post.',
+    'responses_total': 'Webhook responses, by status code.',
+    'retries_total': 'Posts resent after a transient error or being refused for going over the rate limit.',
+    'errors_total': 'Webhook requests that raised instead of getting a response.',
+    'circuit_open_total': 'Posts refused because the circuit breaker of their endpoint was open.',
+    'suppressed_total': 'Posts dropped for repeating one sent within the deduplication window.',
+    'dropped_total': 'Background posts dropped because the queue of the background sender was full.',
+    'spilled_total': 'Background posts written to an outbox because the queue of the background sender was full.'
+}
+
+
+class MetricsRegistry(object):
+    """Thread-safe store of every counter and histogram, by metric name and labels."""
+
+    def __init__(self):
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name, labels, amount=1):
+        """Add to a counter.
+
+        Args:
+            name (str): The name of the counter.
+            labels (tuple): Pairs of a label name and value.
+            amount (int): How much to add.
+        """
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, labels, value):
+        """Record an observation in a histogram, creating it with the buckets in HISTOGRAMS on first use.
+
+        Args:
+            name (str): The name of the histogram.
+            labels (tuple): Pairs of a label name and value.
+            value (float): The observation.
+        """
+        key = (name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram.exponential(*HISTOGRAMS.get(name, (0.001, 2.0, 15)))
+            histogram.observe(value)
+
+    def counters(self):
+        """dict: A copy of every counter, by name and labels."""
+        with self._lock:
+            return dict(self._counters)
+
+    def histograms(self):
+        """dict: Every histogram, by name and labels."""
+        with self._lock:
+            return dict(self._histograms)
+
+    def clear(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def _reset_after_fork(self):
+        # The child starts from zero, so that the metrics of every process add up to the totals.
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+
+_registry = MetricsRegistry()
+_hooks = []
+
+
+def enable():
+    """Start recording the metrics of every post."""
+    global enabled
+    enabled = True
+
+
+def disable():
+    """Stop recording metrics. What was recorded so far is kept."""
+    global enabled
+    enabled = False
+
+
+def add_hook(hook):
+    """Add a function that is called with every measurement, as `hook(name, labels, value)`, where labels is a tuple
+    of pairs of a label name and value. Counters pass the amount they were incremented by as the value.
+
+    Args:
+        hook (callable): The function. It is called from whichever thread posted, and must not raise.
+    """
+    _hooks.append(hook)
+
+
+def remove_hook(hook):
+    _hooks.remove(hook)
+
+
+def get_registry():
+    """Get the in-process registry the metrics are recorded in.
+
+    Returns:
+        MetricsRegistry:
+    """
+    return _registry
+
+
+def labels(instance, url=None):
+    """Get the labels of the metrics of a messenger's posts.
+
+    Args:
+        instance (Messenger): The messenger.
+        url (str): The url posted to, defaults to the messenger's room url.
+
+    Returns:
+        tuple: Pairs of a label name and value. The endpoint is only the host of the url, which keeps tokens that
+            are part of the path out of the metrics.
+    """
+    url = url or getattr(instance, 'room_url', '')
+    cached = getattr(instance, '_metric_labels', None)
+    if cached is not None and cached[0] == url:
+        return cached[1]
+    result = (('messenger', type(instance).__name__), ('endpoint', urlsplit(url).netloc.lower()))
+    try:
+        instance._metric_labels = (url, result)
+    except AttributeError:
+        pass
+    return result
+
+
+def _dispatch(name, label_pairs, value):
+    for hook in _hooks:
+        try:
+            hook(name, label_pairs, value)
+        except Exception:
+            LOGGER.exception('Metrics hook %r failed', hook)
+
+
+def increment(name, label_pairs, amount=1):
+    _registry.increment(name, label_pairs, amount)
+    if _hooks:
+        _dispatch(name, label_pairs, amount)
+
+
+def observe(name, label_pairs, value):
+    _registry.observe(name, label_pairs, value)
+    if _hooks:
+        _dispatch(name, label_pairs, value)
+
+
+def record_response(label_pairs, response, elapsed, size, retries):
+    """Record the measurements of a post that got a response.
+
+    Args:
+        label_pairs (tuple): The labels of the messenger that posted.
+        response (requests.Response): The final response.
+        elapsed (float): The seconds the final request took.
+        size (int): The size of the payload in bytes.
+        retries (int): The number of times the post was resent.
+    """
+    observe('request_seconds', label_pairs, elapsed)
+    observe('payload_bytes', label_pairs, size)
+    status = getattr(response, 'status_code', None) or getattr(response, 'status', 0)
+    increment('responses_total', label_pairs + (('status', str(status)),))
+    if retries:
+        increment('retries_total', label_pairs, retries)
+
+
+def _format_labels(label_pairs, extra=()):
+    pairs = label_pairs + tuple(extra)
+    if not pairs:
+        return ''
+    return '{{{0}}}'.format(','.join(
+        '{0}="{1}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs))
+
+
+def _format_bound(bound):
+    return '+Inf' if bound == float('inf') else repr(float(bound))
+
+
+def to_prometheus(registry=None):
+    """Export the metrics in the Prometheus text exposition format.
+
+    Args:
+        registry (MetricsRegistry): The registry to export, defaults to the in-process one.
+
+    Returns:
+        str:
+    """
+    registry = registry or _registry
+    lines = []
+    by_name = {}
+    for (name, label_pairs), value in registry.counters().items():
+        by_name.setdefault(name, ('counter', []))[1].append((label_pairs, value))
+    for (name, label_pairs), histogram in registry.histograms().items():
+        by_name.setdefault(name, ('histogram', []))[1].append((label_pairs, histogram))
+
+    for name in sorted(by_name):
+        kind, series = by_name[name]
+        full_name = '{0}_{1}'.format(NAMESPACE, name)
+        if name in DESCRIPTIONS:
+            lines.append('# HELP {0} {1}'.format(full_name, DESCRIPTIONS[name]))
+        lines.append('# TYPE {0} {1}'.format(full_name, kind))
+        for label_pairs, value in sorted(series, key=lambda pair: pair[0]):
+            if kind == 'counter':
+                lines.append('{0}{1} {2}'.format(full_name, _format_labels(label_pairs), value))
+                continue
+            for bound, count in value.cumulative_counts():
+                lines.append('{0}_bucket{1} {2}'.format(
+                    full_name, _format_labels(label_pairs, [('le', _format_bound(bound))]), count))
+            lines.append('{0}_sum{1} {2!r}'.format(full_name, _format_labels(label_pairs), value.sum))
+            lines.append('{0}_count{1} {2}'.format(full_name, _format_labels(label_pairs), value.count))
+    return '\n'.join(lines) + '\n' if lines else ''
+
+
+def summary(registry=None):
+    """Summarize the posts of every messenger and endpoint on one line each.
+
+    Args:
+        registry (MetricsRegistry): The registry to summarize, defaults to the in-process one.
+
+    Returns:
+        list: The lines, such as `Slack hooks.slack.com: 120 posts, 2 failed, p50 85.1ms, p99 310.0ms, 41.3KiB`.
+    """
+    registry = registry or _registry
+    failures = {}
+    for (name, label_pairs), value in registry.counters().items():
+        if name == 'errors_total' or (name == 'responses_total' and int(label_pairs[-1][1]) >= 400):
+            key = label_pairs[:2]
+            failures[key] = failures.get(key, 0) + value
+
+    histograms = registry.histograms()
+    lines = []
+    for (name, label_pairs), latency in sorted(histograms.items(), key=lambda pair: pair[0]):
+        if name != 'request_seconds':
+            continue
+        payload_bytes = histograms.get(('payload_bytes', label_pairs))
+        lines.append('{0} {1}: {2} posts, {3} failed, p50 {4:.1f}ms, p99 {5:.1f}ms, {6:.1f}KiB'.format(
+            dict(label_pairs).get('messenger'),
+            dict(label_pairs).get('endpoint'),
+            latency.count,
+            failures.get(label_pairs, 0),
+            latency.quantile(0.5) * 1000,
+            latency.quantile(0.99) * 1000,
+            (payload_bytes.sum if payload_bytes is not None else 0) / 1024.0))
+    return lines
+
+
+class _Reporter(threading.Thread):
+
+    def __init__(self, interval, logger):
+        super(_Reporter, self).__init__(name='eruption-metrics')
+        self.daemon = True
+        self.interval = interval
+        self.logger = logger
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            for line in summary():
+                self.logger.info(line)
+
+
+_reporter = None
+
+
+def start_reporter(interval=60.0, logger=None):
+    """Log a summary line per messenger and endpoint periodically, from a daemon thread. Replaces the reporter
+    started before, if any.
+
+    Args:
+        interval (float): The seconds between summaries.
+        logger (logging.Logger): The logger to log them with, defaults to this module's.
+    """
+    global _reporter
+    stop_reporter()
+    _reporter = _Reporter(interval, logger or LOGGER)
+    _reporter.start()
+
+
+def stop_reporter():
+    global _reporter
+    if _reporter is not None:
+        _reporter.stopped.set()
+        _reporter = None
+
+
+@forking.after_fork
+def _reset_after_fork():
+    global _reporter
+    _registry._reset_after_fork()
+    reporter, _reporter = _reporter, None
+    if reporter is not None:
+        # The reporter thread didn't survive the fork.
+        start_reporter(reporter.interval, reporter.logger)
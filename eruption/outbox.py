@@ -0,0 +1,383 @@
+"""Durable on-disk outbox. Payloads are written to a SQLite database before they are posted and removed once the post
+has succeeded, so that whatever couldn't be delivered, because the chat server was down or the process died, can be
+drained later. Writes are group committed: posts that are recorded at the same time share a single commit, and so a
+single fsync, instead of paying one each.
+
+Delivery from the outbox is at-least-once, since a post that succeeded just before a crash may not have been removed.
+"""
+
+
+# import built-in modules
+import collections
+import json
+import logging
+import os
+import threading
+import time
+import weakref
+from concurrent import futures
+
+try:
+    from urllib.parse import urlsplit, urlunsplit
+except ImportError:  # pragma: no cover
+    from urlparse import urlsplit, urlunsplit
+
+# import local modules
+from eruption import exceptions
+from eruption import forking
+from eruption import ratelimit
+
+__all__ = [
+    'Outbox',
+    'DrainResult',
+    'DEFAULT_PATH'
+]
+
+
+DEFAULT_PATH = os.path.join(os.path.expanduser('~'), '.eruption', 'outbox.sqlite3')
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_DRAIN_WORKERS = 4
+# The client error statuses that may not come back if the post is sent again later.
+RETRYABLE_STATUSES = frozenset([408, 429])
+
+LOGGER = logging.getLogger(__name__)
+
+_outboxes = weakref.WeakSet()
+# Connections inherited from the parent, which must be neither used nor closed by the child, and so are kept from
+# being garbage collected.
+_inherited_connections = []
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    url TEXT NOT NULL,
+    headers TEXT NOT NULL,
+    body BLOB NOT NULL,
+    created REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT
+)
+"""
+
+# The payloads that were given up on, because their post was refused in a way that sending it again won't change.
+_DEAD_LETTER_SCHEMA = """
+CREATE TABLE IF NOT EXISTS dead_letters (
+    id INTEGER PRIMARY KEY,
+    url TEXT NOT NULL,
+    headers TEXT NOT NULL,
+    body BLOB NOT NULL,
+    created REAL NOT NULL,
+    attempts INTEGER NOT NULL,
+    last_error TEXT
+)
+"""
+
+
+DrainResult = collections.namedtuple('DrainResult', ['sent', 'failed', 'remaining'])
+DrainResult.__doc__ = """The outcome of draining an outbox.
+
+Args:
+    sent (int): The number of messages posted and removed.
+    failed (int): The number of urls that were given up on because a post to them failed.
+    remaining (int): The number of messages left in the outbox.
+"""
+
+
+def redact(url):
+    """Hide the token at the end of a webhook url, for display.
+
+    Args:
+        url (str): The url to redact.
+
+    Returns:
+        str:
+    """
+    parts = urlsplit(url)
+    path, _, _ = parts.path.rpartition('/')
+    return urlunsplit((parts.scheme, parts.netloc, path + '/...', '', ''))
+
+
+def is_permanent(status):
+    """Check whether a post refused with a status would be refused again however often it is sent, such as with a
+    revoked webhook or a payload the chat server doesn't accept.
+
+    Args:
+        status (int): The HTTP status of the response.
+
+    Returns:
+        bool:
+    """
+    return 400 <= status < 500 and status not in RETRYABLE_STATUSES
+
+
+class Outbox(object):
+    """Persistent store of the payloads that have yet to be delivered.
+
+    Args:
+        path (str): The path of the SQLite database, created if it doesn't exist.
+    """
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._lock = threading.Lock()
+        self._commit_lock = threading.Lock()
+        self._written = 0
+        self._committed = 0
+        self._inflight = set()
+        self._drainer = None
+        self._stop = threading.Event()
+        self._connection = self._connect()
+        _outboxes.add(self)
+
+    def _connect(self):
+        import sqlite3
+
+        connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level='DEFERRED')
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=FULL')
+        connection.execute(_SCHEMA)
+        connection.execute(_DEAD_LETTER_SCHEMA)
+        connection.commit()
+        return connection
+
+    def put(self, url, headers, body):
+        """Durably record a payload that is about to be posted.
+
+        Args:
+            url (str): The url it will be posted to.
+            headers (dict): The headers it will be posted with.
+            body (str|bytes): The payload.
+
+        Returns:
+            int: The id of the record, to `ack` once the post succeeded.
+        """
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        with self._lock:
+            cursor = self._connection.execute(
+                'INSERT INTO messages (url, headers, body, created) VALUES (?, ?, ?, ?)',
+                (url, json.dumps(headers), body, time.time()))
+            record_id = cursor.lastrowid
+            self._inflight.add(record_id)
+            self._written += 1
+            written = self._written
+        self._sync(written)
+        return record_id
+
+    def _sync(self, written):
+        # Whoever gets the commit lock first commits every write made so far, and the writers that queued up behind
+        # it find their write already committed.
+        with self._commit_lock:
+            if self._committed >= written:
+                return
+            with self._lock:
+                target = self._written
+                self._connection.commit()
+            self._committed = target
+
+    def _finish(self, record_id, *statements):
+        # Committed right away, like the writes of `put`, so that no transaction, and with it the database's write
+        # lock, is held between calls.
+        with self._lock:
+            for statement, parameters in statements:
+                self._connection.execute(statement, parameters)
+            self._inflight.discard(record_id)
+            self._written += 1
+            written = self._written
+        self._sync(written)
+
+    def ack(self, record_id):
+        """Remove a record whose post succeeded.
+
+        Args:
+            record_id (int): The id returned by `put`.
+        """
+        self._finish(record_id, ('DELETE FROM messages WHERE id = ?', (record_id,)))
+
+    def release(self, record_id, error=None):
+        """Leave a record whose post failed in the outbox, to be drained later.
+
+        Args:
+            record_id (int): The id returned by `put`.
+            error (str): What went wrong.
+        """
+        self._finish(record_id, ('UPDATE messages SET attempts = attempts + 1, last_error = ? WHERE id = ?',
+                                 (error, record_id)))
+
+    def bury(self, record_id, error=None):
+        """Move a record whose post was refused for good to the dead letters, where it no longer holds up the
+        records behind it.
+
+        Args:
+            record_id (int): The id returned by `put`.
+            error (str): What went wrong.
+        """
+        self._finish(
+            record_id,
+            ('INSERT INTO dead_letters SELECT id, url, headers, body, created, attempts + 1, ? '
+             'FROM messages WHERE id = ?', (error, record_id)),
+            ('DELETE FROM messages WHERE id = ?', (record_id,)))
+
+    def settle(self, record_id, status):
+        """Remove, release or bury a record by the status its post got.
+
+        Args:
+            record_id (int): The id returned by `put`.
+            status (int): The HTTP status of the response.
+        """
+        if status < 400:
+            self.ack(record_id)
+        elif is_permanent(status):
+            self.bury(record_id, 'HTTP {0}'.format(status))
+        else:
+            self.release(record_id, 'HTTP {0}'.format(status))
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+
+    def summary(self):
+        """Summarize the outbox by url.
+
+        Returns:
+            list: A tuple of the url, the number of messages, the creation time of the oldest one, and the last error
+                for each url with messages waiting.
+        """
+        with self._lock:
+            return self._connection.execute(
+                'SELECT url, COUNT(*), MIN(created), '
+                '(SELECT last_error FROM messages AS m WHERE m.url = messages.url ORDER BY id DESC LIMIT 1) '
+                'FROM messages GROUP BY url ORDER BY MIN(created)').fetchall()
+
+    def dead_letters(self):
+        """Summarize the records that were given up on by url.
+
+        Returns:
+            list: A tuple of the url, the number of records and the last error for each url with dead letters.
+        """
+        with self._lock:
+            return self._connection.execute(
+                'SELECT url, COUNT(*), '
+                '(SELECT last_error FROM dead_letters AS d WHERE d.url = dead_letters.url ORDER BY id DESC LIMIT 1) '
+                'FROM dead_letters GROUP BY url ORDER BY MIN(created)').fetchall()
+
+    def _pending(self, limit, skip_urls):
+        query = 'SELECT id, url, headers, body FROM messages'
+        if skip_urls:
+            query += ' WHERE url NOT IN ({0})'.format(', '.join('?' * len(skip_urls)))
+        query += ' ORDER BY id LIMIT ?'
+        with self._lock:
+            rows = self._connection.execute(query, tuple(skip_urls) + (limit + len(self._inflight),)).fetchall()
+            return [row for row in rows if row[0] not in self._inflight][:limit]
+
+    def drain(self, limit=None, batch_size=DEFAULT_BATCH_SIZE, workers=DEFAULT_DRAIN_WORKERS):
+        """Post the recorded payloads in order, removing each one that is delivered. Urls are drained in parallel over
+        pooled connections, with the rate limit and circuit breaker of the url, and a url is left alone for the rest of
+        the drain as soon as one of its posts fails in a way that may not last. Posts refused for good, with a client
+        error other than 408 or 429, are moved to the dead letters instead, so that they don't hold up every drain.
+
+        Args:
+            limit (int): The most messages to post, or None to drain everything.
+            batch_size (int): How many messages are read from disk at once.
+            workers (int): How many urls are drained at once.
+
+        Returns:
+            DrainResult:
+        """
+        sent = failed = 0
+        failed_urls = set()
+        with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            while limit is None or sent < limit:
+                size = batch_size if limit is None else min(batch_size, limit - sent)
+                rows = self._pending(size, failed_urls)
+                if not rows:
+                    break
+                by_url = collections.OrderedDict()
+                for row in rows:
+                    by_url.setdefault(row[1], []).append(row)
+                for url, (url_sent, url_failed) in zip(by_url, executor.map(self._drain_url, by_url.values())):
+                    sent += url_sent
+                    if url_failed:
+                        failed += 1
+                        failed_urls.add(url)
+        return DrainResult(sent, failed, len(self))
+
+    def _drain_url(self, rows):
+        from eruption import eruption
+
+        url = rows[0][1]
+        # Posted like a messenger would, without retries since the record is tried again by the next drain, and with
+        # the rate limit of the url if this process has posted to it.
+        bucket = ratelimit.find_bucket(url)
+        target = eruption.Messenger(room_id=None, token=None, retries=0,
+                                    rate_limit=(bucket.rate, bucket.burst) if bucket is not None else None)
+        target.room_url = url
+        sent = 0
+        for record_id, _, headers, body in rows:
+            target.headers = json.loads(headers)
+            try:
+                response = target._post_data(bytes(body))
+            except exceptions.CircuitOpenError:
+                # Not an attempt, the record is left alone until the breaker lets posts through again.
+                return sent, True
+            except Exception as exception:
+                self.release(record_id, str(exception))
+                return sent, True
+            self.settle(record_id, response.status_code)
+            if response.status_code < 400:
+                sent += 1
+            elif not is_permanent(response.status_code):
+                return sent, True
+        return sent, False
+
+    def start_drainer(self, interval=30.0):
+        """Start a daemon thread that drains the outbox periodically.
+
+        Args:
+            interval (float): The number of seconds between drains.
+        """
+        if self._drainer is not None:
+            return
+        self._stop.clear()
+        self._drainer = threading.Thread(target=self._drain_periodically, args=(interval,), name='eruption-outbox')
+        self._drainer.daemon = True
+        self._drainer.start()
+
+    def _drain_periodically(self, interval):
+        while not self._stop.wait(interval):
+            try:
+                self.drain()
+            except Exception as error:
+                LOGGER.warning('Failed to drain the outbox: %s', error, exc_info=True)
+
+    def _reset_after_fork(self):
+        # SQLite connections can't be carried across a fork, so the child opens its own. Draining is left to the
+        # parent, which knows which of the records are its posts in flight.
+        _inherited_connections.append(self._connection)
+        self._lock = threading.Lock()
+        self._commit_lock = threading.Lock()
+        self._committed = self._written
+        self._drainer = None
+        self._stop = threading.Event()
+        self._connection = self._connect()
+
+    def close(self):
+        """Stop the drainer, commit and close the database."""
+        self._stop.set()
+        drainer, self._drainer = self._drainer, None
+        if drainer is not None:
+            drainer.join()
+        with self._lock:
+            self._connection.close()
+
+
+@forking.after_fork
+def _reset_after_fork():
+    for outbox in list(_outboxes):
+        try:
+            outbox._reset_after_fork()
+        except Exception as error:
+            LOGGER.warning('Failed to reopen the outbox %s after a fork: %s', outbox.path, error)
@@ -0,0 +1,84 @@
+"""Precompiled payload templates. The static fields of a payload are encoded once, when the Messenger is created, and
+only the message text is encoded and spliced in for each post. The result is byte-identical to encoding the whole
+payload with `json.dumps`.
+"""
+
+
+# import built-in modules
+import json
+
+__all__ = [
+    'PayloadTemplate'
+]
+
+
+# Stands in for the message text while the static fields are encoded.
+_PLACEHOLDER = '\x00eruption-text\x00'
+
+
+class PayloadTemplate(object):
+    """The pre-encoded JSON payload of a Messenger, with a hole for the message text.
+
+    Args:
+        text_key (str): The key the message text goes under.
+        defaults (list): Pairs of the key and default value of every other field, in payload order.
+        aliases (dict): Alternative names that overrides can use for keys, such as `user_name` for `username`.
+    """
+
+    __slots__ = ('text_key', 'defaults', 'aliases', '_prefix', '_suffix')
+
+    def __init__(self, text_key, defaults=(), aliases=None):
+        self.text_key = text_key
+        self.defaults = [(key, value) for key, value in defaults if key != text_key]
+        self.aliases = dict(aliases or {})
+        encoded = json.dumps(dict([(text_key, _PLACEHOLDER)] + self.defaults))
+        prefix, suffix = encoded.split(json.dumps(_PLACEHOLDER), 1)
+        self._prefix = prefix.encode('utf-8')
+        self._suffix = suffix.encode('utf-8')
+
+    def with_defaults(self, overrides):
+        """Get a template with some of the defaults replaced.
+
+        Args:
+            overrides (dict): The new defaults, by key or alias. Keys that aren't defaults yet are added at the end.
+
+        Returns:
+            PayloadTemplate:
+        """
+        defaults = dict(self.defaults)
+        order = [key for key, _ in self.defaults]
+        for key, value in overrides.items():
+            key = self.aliases.get(key, key)
+            if key not in defaults:
+                order.append(key)
+            defaults[key] = value
+        return PayloadTemplate(self.text_key, [(key, defaults[key]) for key in order], self.aliases)
+
+    def render(self, text, overrides=None):
+        """Encode a payload.
+
+        Args:
+            text (str): The message text.
+            overrides (dict): Values that replace the defaults for this payload only, by key or alias. Keys that
+                aren't defaults are added to the payload.
+
+        Returns:
+            bytes: The JSON payload.
+        """
+        if not overrides:
+            return self._prefix + json.dumps(text).encode('utf-8') + self._suffix
+        data = dict([(self.text_key, text)] + self.defaults)
+        for key, value in overrides.items():
+            data[self.aliases.get(key, key)] = value
+        return json.dumps(data).encode('utf-8')
+
+    def __eq__(self, other):
+        if not isinstance(other, PayloadTemplate):
+            return NotImplemented
+        return (self._prefix, self._suffix, self.aliases) == (other._prefix, other._suffix, other.aliases)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self._prefix, self._suffix))
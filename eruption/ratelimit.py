@@ -0,0 +1,214 @@
+"""Per-endpoint rate limiting. Every room url gets its own token bucket, which posts take a token from before they
+are sent. Posts that find the bucket empty wait their turn instead of being sent just to be refused, and the bucket
+follows the `Retry-After` and rate limit headers of the responses, so that it settles on the rate the provider
+actually allows.
+"""
+
+
+# import built-in modules
+import threading
+import time
+
+# import local modules
+from eruption import forking
+
+__all__ = [
+    'TokenBucket',
+    'find_bucket',
+    'get_bucket'
+]
+
+
+try:
+    _clock = time.monotonic
+except AttributeError:  # pragma: no cover
+    _clock = time.time
+
+
+def _parse_seconds(value):
+    """Parse a header value that is either a number of seconds or an HTTP date.
+
+    Args:
+        value (str): The header value.
+
+    Returns:
+        float: The number of seconds from now, or None if the value couldn't be parsed.
+    """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    import email.utils
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is None:
+        return None
+    return max(email.utils.mktime_tz(parsed) - time.time(), 0.0)
+
+
+class TokenBucket(object):
+    """A token bucket that hands out reservations, so that waiting posts are spread out at the bucket's rate instead
+    of all retrying at once when a token frees up.
+
+    Args:
+        rate (float): The number of posts allowed per second.
+        burst (int): The number of posts that can be sent at once after a quiet period.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = max(int(burst), 1)
+        self._tokens = float(self.burst)
+        self._updated = _clock()
+        self._resume_at = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        if now > self._updated:
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+    def reserve(self):
+        """Take a token, going into debt if there isn't one.
+
+        Returns:
+            float: The number of seconds to wait before the token may be used.
+        """
+        with self._lock:
+            now = _clock()
+            self._refill(now)
+            self._tokens -= 1
+            return (self._updated - now) + max(-self._tokens, 0) / self.rate
+
+    def try_acquire(self):
+        """Take a token if there is one to use right away, without waiting or going into debt.
+
+        Returns:
+            bool: Whether a token was taken.
+        """
+        with self._lock:
+            now = _clock()
+            self._refill(now)
+            if self._tokens < 1 or now < self._resume_at:
+                return False
+            self._tokens -= 1
+            return True
+
+    def acquire(self):
+        """Take a token, waiting until it may be used.
+
+        Returns:
+            float: The number of seconds waited.
+        """
+        start = _clock()
+        delay = self.reserve()
+        while delay > 0:
+            time.sleep(delay)
+            # A pause may have come in while waiting.
+            delay = self._resume_at - _clock()
+        return _clock() - start
+
+    async def acquire_async(self):
+        """Take a token, waiting on the running event loop until it may be used.
+
+        Returns:
+            float: The number of seconds waited.
+        """
+        import asyncio
+
+        start = _clock()
+        delay = self.reserve()
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = self._resume_at - _clock()
+        return _clock() - start
+
+    def pause(self, seconds):
+        """Stop handing out tokens for a while, such as when the provider asks to retry later.
+
+        Args:
+            seconds (float): How long to pause for.
+        """
+        with self._lock:
+            now = _clock()
+            self._refill(now)
+            resume_at = now + seconds
+            if resume_at > self._updated:
+                self._tokens = min(self._tokens, 0)
+                self._updated = resume_at
+            self._resume_at = max(self._resume_at, resume_at)
+
+    def observe(self, response):
+        """Adjust the bucket to the rate limit information of a response.
+
+        Args:
+            response (requests.Response|aiohttp.ClientResponse): The response of a post that used a token from this
+                bucket.
+
+        Returns:
+            bool: Whether the post was refused for going over the rate limit, and so should be sent again.
+        """
+        headers = response.headers
+        limited = (getattr(response, 'status_code', None) or getattr(response, 'status', 0)) == 429
+        if limited:
+            retry_after = _parse_seconds(headers.get('Retry-After'))
+            self.pause(retry_after if retry_after is not None else 1.0 / self.rate)
+        remaining = headers.get('X-RateLimit-Remaining')
+        if remaining is not None and remaining.strip() == '0':
+            reset_after = _parse_seconds(headers.get('X-RateLimit-Reset-After'))
+            if reset_after is None:
+                reset = _parse_seconds(headers.get('X-RateLimit-Reset'))
+                reset_after = reset - time.time() if reset is not None else None
+            if reset_after is not None and reset_after > 0:
+                self.pause(reset_after)
+        return limited
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def get_bucket(url, rate, burst=1):
+    """Get the token bucket of a room url and rate limit, creating it on first use. Instances that post to the same
+    url with the same limits share a bucket, and an instance given other limits for the url gets a bucket of its own.
+
+    Args:
+        url (str): The room url.
+        rate (float): The number of posts allowed per second.
+        burst (int): The number of posts that can be sent at once.
+
+    Returns:
+        TokenBucket:
+    """
+    key = (url, float(rate), max(int(burst), 1))
+    bucket = _buckets.get(key)
+    if bucket is None:
+        with _buckets_lock:
+            bucket = _buckets.get(key)
+            if bucket is None:
+                bucket = _buckets[key] = TokenBucket(rate, burst)
+    return bucket
+
+
+def find_bucket(url):
+    """Get a token bucket that posts to a room url take from, for posting to it without knowing its limits.
+
+    Args:
+        url (str): The room url.
+
+    Returns:
+        TokenBucket: The bucket, or None if nothing in this process posted to the url with rate limiting.
+    """
+    for (bucket_url, _, _), bucket in list(_buckets.items()):
+        if bucket_url == url:
+            return bucket
+    return None
+
+
+@forking.after_fork
+def _reset_after_fork():
+    global _buckets_lock
+    _buckets_lock = threading.Lock()
+    for bucket in list(_buckets.values()):
+        bucket._lock = threading.Lock()
@@ -0,0 +1,559 @@
+"""Local relay for hosts running many processes that post. Messengers in relay mode write their rendered payloads to
+a Unix domain socket instead of posting them, which costs a local write instead of a webhook round trip, and the
+`eruption relay` daemon listening on it forwards them over a small shared pool of keep-alive connections. Rate
+limiting, retries and circuit breaking then happen in one place for the whole host, instead of once per process.
+
+Every message is a frame of two big-endian 32-bit lengths, followed by that many bytes of a JSON envelope with the
+url, headers and rate limit to post with, and that many bytes of payload.
+
+The payloads carry webhook tokens, so the relay is private to the user running it: its socket is kept in a directory
+only that user can open, clients only hand payloads to a relay run by the same user, the relay only accepts
+connections from that user, and it only forwards to the chat servers it is allowed to post to.
+"""
+
+
+# import built-in modules
+import errno
+import json
+import logging
+import os
+import socket
+import stat
+import struct
+import tempfile
+import threading
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:  # pragma: no cover
+    from urlparse import urlsplit
+
+try:
+    import queue
+except ImportError:  # pragma: no cover
+    import Queue as queue
+
+# import local modules
+from eruption import forking
+from eruption import sessions
+
+__all__ = [
+    'DEFAULT_PATH',
+    'Relay',
+    'RelayClient',
+    'get_client'
+]
+
+
+def _runtime_directory():
+    if os.environ.get('XDG_RUNTIME_DIR'):
+        return os.environ['XDG_RUNTIME_DIR']
+    if not hasattr(os, 'getuid'):
+        # Platforms without user ids, such as Windows, give every user a temporary directory of their own.
+        return tempfile.gettempdir()
+    # Anyone can create files in the shared temporary directory, and so bind the socket before the relay does, which
+    # is why the socket goes in a directory of the user's own there instead.
+    return os.path.join(tempfile.gettempdir(), 'eruption-{0}'.format(os.getuid()))
+
+
+DEFAULT_PATH = os.path.join(_runtime_directory(), 'eruption-relay.sock')
+ENVIRONMENT_VARIABLE = 'ERUPTION_RELAY'
+# The hosts of the chat services whose webhook urls don't depend on where they are hosted. Self-hosted services, such
+# as Mattermost and Rocket.Chat, have to be allowed by the relay's `allowed_hosts`.
+DEFAULT_ALLOWED_HOSTS = frozenset([
+    'hooks.slack.com',
+    'discordapp.com',
+    'discord.com',
+    'api.hipchat.com'
+])
+# Frames bigger than this are refused, and the connection that sent them closed.
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+RECEIVE_SIZE = 256 * 1024
+# The most payloads waiting to be forwarded to one url, past which more are dropped, the most urls forwarded to at
+# once, and how long the thread of a url waits for more payloads before stopping.
+MAX_LANE_SIZE = 1000
+MAX_LANES = 64
+LANE_IDLE_TIMEOUT = 60.0
+# How long a stopping relay waits for the posts it already received to be forwarded.
+STOP_TIMEOUT = 10.0
+
+HEADER = struct.Struct('!II')
+# The pid, uid and gid of the other end of a Unix domain socket, where SO_PEERCRED is available.
+PEER_CREDENTIALS = struct.Struct('3i')
+
+LOGGER = logging.getLogger(__name__)
+
+
+def _check_private_directory(directory):
+    """Check that a directory is only open to the user running this process.
+
+    Args:
+        directory (str): The directory.
+
+    Raises:
+        IOError: If it isn't a directory, belongs to another user, or other users can open it.
+    """
+    status = os.lstat(directory)
+    if not stat.S_ISDIR(status.st_mode) or status.st_uid != os.getuid() or status.st_mode & 0o077:
+        raise IOError(errno.EACCES, 'Not a private directory of this user', directory)
+
+
+def _make_private_directory(directory):
+    """Create the directory of the relay's socket if it doesn't exist, only open to the user running this process.
+
+    Args:
+        directory (str): The directory.
+
+    Raises:
+        IOError: If the directory exists but isn't private.
+    """
+    try:
+        os.mkdir(directory, 0o700)
+    except OSError as error:
+        if error.errno != errno.EEXIST:
+            raise
+    _check_private_directory(directory)
+
+
+def _peer_uid(connection):
+    """Get the user id of the process at the other end of a Unix domain socket.
+
+    Args:
+        connection (socket.socket): The connected socket.
+
+    Returns:
+        int: The user id, or None if the platform doesn't tell.
+    """
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return None
+    credentials = connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, PEER_CREDENTIALS.size)
+    return PEER_CREDENTIALS.unpack(credentials)[1]
+
+
+def encode(envelope, data):
+    """Frame a payload for the relay.
+
+    Args:
+        envelope (bytes): The JSON envelope, as returned by `envelope`.
+        data (bytes): The rendered payload.
+
+    Returns:
+        bytes:
+    """
+    return HEADER.pack(len(envelope), len(data)) + envelope + data
+
+
+def decode(buffer):
+    """Take every complete frame off the front of a buffer.
+
+    Args:
+        buffer (bytearray): What was received so far. Complete frames are removed from it.
+
+    Returns:
+        list: Pairs of the decoded envelope and the payload of each frame.
+
+    Raises:
+        ValueError: If a frame is bigger than MAX_FRAME_SIZE.
+    """
+    frames = []
+    offset = 0
+    while len(buffer) - offset >= HEADER.size:
+        envelope_length, data_length = HEADER.unpack_from(buffer, offset)
+        if envelope_length + data_length > MAX_FRAME_SIZE:
+            raise ValueError('Frame of {0} bytes is too big'.format(envelope_length + data_length))
+        start = offset + HEADER.size
+        end = start + envelope_length + data_length
+        if len(buffer) < end:
+            break
+        envelope = json.loads(bytes(buffer[start:start + envelope_length]).decode('utf-8'))
+        frames.append((envelope, bytes(buffer[start + envelope_length:end])))
+        offset = end
+    del buffer[:offset]
+    return frames
+
+
+def envelope(instance):
+    """Get the envelope of a messenger's posts, encoded once per messenger.
+
+    Args:
+        instance (Messenger): The messenger.
+
+    Returns:
+        bytes:
+    """
+    cached = getattr(instance, '_relay_envelope', None)
+    if cached is not None and cached[0] == instance.room_url:
+        return cached[1]
+    encoded = json.dumps({
+        'url': instance.room_url,
+        'headers': instance.headers,
+        'rate_limit': instance.rate_limit
+    }, separators=(',', ':')).encode('utf-8')
+    instance._relay_envelope = (instance.room_url, encoded)
+    return encoded
+
+
+class RelayClient(object):
+    """A connection to a relay, shared by every messenger of a process that posts through it.
+
+    Args:
+        path (str): The relay's socket.
+    """
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self._socket = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        # The payloads carry webhook tokens, so they are only handed to a relay run by the same user.
+        if self.path == DEFAULT_PATH:
+            _check_private_directory(os.path.dirname(self.path))
+        if os.stat(self.path).st_uid != os.getuid():
+            raise IOError(errno.EACCES, 'The relay socket belongs to another user', self.path)
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            connection.connect(self.path)
+            uid = _peer_uid(connection)
+            if uid is not None and uid != os.getuid():
+                raise IOError(errno.EACCES, 'The relay is run by another user', self.path)
+        except Exception:
+            connection.close()
+            raise
+        return connection
+
+    def send(self, envelope, data):
+        """Hand a payload to the relay, reconnecting once if the relay was restarted since the last one.
+
+        Args:
+            envelope (bytes): The JSON envelope, as returned by `envelope`.
+            data (bytes): The rendered payload.
+
+        Raises:
+            socket.error: If the relay can't be reached.
+        """
+        frame = encode(envelope, data)
+        with self._lock:
+            for attempt in range(2):
+                if self._socket is None:
+                    self._socket = self._connect()
+                try:
+                    self._socket.sendall(frame)
+                    return
+                except socket.error:
+                    self._close()
+                    if attempt:
+                        raise
+
+    def post(self, instance, data):
+        """Hand a messenger's payload to the relay.
+
+        Args:
+            instance (Messenger): The messenger posting.
+            data (bytes): The rendered payload.
+
+        Raises:
+            socket.error: If the relay can't be reached.
+        """
+        self.send(envelope(instance), data)
+
+    def _close(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def _reset_after_fork(self):
+        # Closing the inherited socket in the child leaves the parent's open, and the child connects on its own, so
+        # that their frames don't interleave on one connection.
+        self._lock = threading.Lock()
+        self._close()
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(path=None):
+    """Get the process-wide client of a relay, creating it on first use.
+
+    Args:
+        path (str): The relay's socket, defaults to the ERUPTION_RELAY environment variable and then DEFAULT_PATH.
+
+    Returns:
+        RelayClient:
+    """
+    path = path or os.environ.get(ENVIRONMENT_VARIABLE) or DEFAULT_PATH
+    client = _clients.get(path)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(path)
+            if client is None:
+                client = _clients[path] = RelayClient(path)
+    return client
+
+
+@forking.after_fork
+def _reset_after_fork():
+    global _clients_lock
+    _clients_lock = threading.Lock()
+    for client in list(_clients.values()):
+        client._reset_after_fork()
+
+
+class _Lane(object):
+    """Forwards the payloads of one url in order, from its own thread, with the url's rate limit, retries and circuit
+    breaker. The thread stops once no payload has come in for LANE_IDLE_TIMEOUT seconds.
+    """
+
+    def __init__(self, relay, url, rate_limit):
+        from eruption import eruption
+
+        self.relay = relay
+        self.url = url
+        self.target = eruption.Messenger(room_id=None, token=None, session_pool=relay.session_pool,
+                                         rate_limit=tuple(rate_limit) if rate_limit else None)
+        self.target.room_url = url
+        self.queue = queue.Queue(MAX_LANE_SIZE)
+        self.thread = threading.Thread(target=self._work, name='eruption-relay-lane')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _work(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=LANE_IDLE_TIMEOUT)
+            except queue.Empty:
+                if self.relay._retire(self):
+                    return
+                continue
+            if item is None:
+                return
+            headers, data = item
+            self.target.headers = headers
+            try:
+                result = self.target._post_data(data)
+                if result.status_code >= 400:
+                    LOGGER.warning('Relayed post failed with %s %s', result.status_code, result.reason)
+            except Exception as error:
+                LOGGER.warning('Relayed post failed: %s', error)
+            finally:
+                self.relay._done()
+
+
+class Relay(object):
+    """Listens on a Unix domain socket for payloads from messengers in relay mode, and forwards them.
+
+    Only connections from processes of the user running the relay are accepted, where the platform tells who is
+    connecting, and payloads are only forwarded over http or https to the allowed hosts.
+
+    Args:
+        path (str): The socket to listen on. A stale socket of this user, left by a relay that didn't stop cleanly,
+            is replaced.
+        session_pool (SessionPool): The pool of keep-alive sessions to forward over, defaults to a new one.
+        allowed_hosts (iterable): The hosts payloads may be forwarded to, as a host name or as a host name and port
+            such as `chat.example.com:8065`. Defaults to DEFAULT_ALLOWED_HOSTS.
+    """
+
+    def __init__(self, path=DEFAULT_PATH, session_pool=None, allowed_hosts=None):
+        self.path = path
+        self.session_pool = session_pool if session_pool is not None else sessions.SessionPool()
+        self.allowed_hosts = frozenset(
+            host.lower() for host in (DEFAULT_ALLOWED_HOSTS if allowed_hosts is None else allowed_hosts))
+        self.dropped = 0
+        self._listener = None
+        self._lanes = {}
+        self._pending = 0
+        self._condition = threading.Condition()
+        self._stopped = threading.Event()
+
+    def start(self):
+        """Start listening, and accepting connections from a daemon thread.
+
+        Returns:
+            Relay: This relay.
+
+        Raises:
+            IOError: If the socket's directory isn't private, or something other than a stale socket of this user is
+                in the socket's place, such as a relay that is still running.
+        """
+        if self.path == DEFAULT_PATH:
+            _make_private_directory(os.path.dirname(self.path))
+        self._remove_stale_socket()
+        self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._listener.bind(self.path)
+        os.chmod(self.path, 0o600)
+        self._listener.listen(socket.SOMAXCONN)
+        thread = threading.Thread(target=self._accept, args=(self._listener,), name='eruption-relay')
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def _remove_stale_socket(self):
+        try:
+            status = os.lstat(self.path)
+        except OSError as error:
+            if error.errno == errno.ENOENT:
+                return
+            raise
+        if not stat.S_ISSOCK(status.st_mode) or status.st_uid != os.getuid():
+            raise IOError(errno.EEXIST, 'Not a relay socket of this user', self.path)
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.path)
+        except (socket.error, OSError) as error:
+            if error.errno != errno.ECONNREFUSED:
+                raise
+            # Nothing listens on it anymore.
+            os.unlink(self.path)
+            return
+        finally:
+            probe.close()
+        raise IOError(errno.EADDRINUSE, 'A relay is already listening', self.path)
+
+    def serve_forever(self):
+        """Start the relay, and block until it is stopped."""
+        self.start()
+        while not self._stopped.wait(1.0):
+            pass
+
+    def _accept(self, listener):
+        while not self._stopped.is_set():
+            try:
+                connection, _ = listener.accept()
+            except (socket.error, OSError):
+                return
+            try:
+                uid = _peer_uid(connection)
+            except (socket.error, OSError) as error:
+                LOGGER.warning('Refused a relay connection whose user is unknown: %s', error)
+                connection.close()
+                continue
+            if uid is not None and uid != os.getuid():
+                LOGGER.warning('Refused a relay connection from user %s', uid)
+                connection.close()
+                continue
+            thread = threading.Thread(target=self._read, args=(connection,), name='eruption-relay-connection')
+            thread.daemon = True
+            thread.start()
+
+    def _read(self, connection):
+        # Clients write frames back to back, so every read takes as many of them off the socket as have arrived.
+        buffer = bytearray()
+        try:
+            while True:
+                chunk = connection.recv(RECEIVE_SIZE)
+                if not chunk:
+                    return
+                buffer.extend(chunk)
+                for frame_envelope, data in decode(buffer):
+                    self._enqueue(frame_envelope, data)
+        except (socket.error, ValueError) as error:
+            LOGGER.warning('Dropped a relay connection: %s', error)
+        finally:
+            connection.close()
+
+    def _allows(self, url):
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            return False
+        return (parts.hostname or '') in self.allowed_hosts or parts.netloc.lower() in self.allowed_hosts
+
+    def _enqueue(self, frame_envelope, data):
+        url = frame_envelope.get('url') or ''
+        if not self._allows(url):
+            self._drop('Dropped a relayed post to a host that isn\'t allowed: %s', urlsplit(url).netloc)
+            return
+        with self._condition:
+            lane = self._lanes.get(url)
+            if lane is None:
+                if len(self._lanes) >= MAX_LANES:
+                    self._drop('Dropped a relayed post, already forwarding to %s urls', MAX_LANES)
+                    return
+                lane = self._lanes[url] = _Lane(self, url, frame_envelope.get('rate_limit'))
+            try:
+                # Put while holding the condition, so that the lane can't retire in between.
+                lane.queue.put_nowait((frame_envelope.get('headers') or {}, data))
+            except queue.Full:
+                self._drop('Dropped a relayed post, %s are already waiting for its url', MAX_LANE_SIZE)
+                return
+            self._pending += 1
+
+    def _drop(self, message, *args):
+        self.dropped += 1
+        LOGGER.warning(message, *args)
+
+    def _retire(self, lane):
+        """Stop forwarding to the url of an idle lane.
+
+        Args:
+            lane (_Lane): The lane.
+
+        Returns:
+            bool: Whether the lane was retired, rather than given a payload in the meantime.
+        """
+        with self._condition:
+            if not lane.queue.empty():
+                return False
+            if self._lanes.get(lane.url) is lane:
+                del self._lanes[lane.url]
+            return True
+
+    def _done(self):
+        with self._condition:
+            self._pending -= 1
+            if not self._pending:
+                self._condition.notify_all()
+
+    @property
+    def pending(self):
+        """int: The number of payloads received but not forwarded yet."""
+        return self._pending
+
+    def flush(self, timeout=None):
+        """Wait for every payload received so far to be forwarded.
+
+        Args:
+            timeout (float): The most seconds to wait, or None to wait for as long as it takes.
+
+        Returns:
+            bool: Whether everything was forwarded before the timeout.
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: not self._pending, timeout)
+
+    def stop(self, timeout=None):
+        """Stop accepting payloads, forward the ones already received, and remove the socket.
+
+        Args:
+            timeout (float): The most seconds to wait for the forwarding.
+
+        Returns:
+            bool: Whether everything was forwarded before the timeout.
+        """
+        self._stopped.set()
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+        flushed = self.flush(timeout)
+        with self._condition:
+            lanes, self._lanes = list(self._lanes.values()), {}
+        for lane in lanes:
+            try:
+                lane.queue.put_nowait(None)
+            except queue.Full:
+                # Still busy after the timeout, the lane's daemon thread ends with the process.
+                pass
+        self.session_pool.close()
+        return flushed
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
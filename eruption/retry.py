@@ -0,0 +1,163 @@
+"""Retries and circuit breaking for unreliable chat servers. Posts that fail with a transient error are resent after an
+exponential backoff with full jitter, so that many posts failing at once don't all come back at the same moment.
+Every room url also gets a circuit breaker, which opens after repeated failures so that posts fail fast instead of
+each waiting out its own timeout against a server that is down, and lets a single probe through once its reset
+timeout has passed to find out whether the server is back.
+"""
+
+
+# import built-in modules
+import random
+import threading
+import time
+
+# import local modules
+from eruption import forking
+
+__all__ = [
+    'CircuitBreaker',
+    'backoff',
+    'is_transient',
+    'get_breaker'
+]
+
+
+try:
+    _clock = time.monotonic
+except AttributeError:  # pragma: no cover
+    _clock = time.time
+
+# The response statuses that mean the chat server, or a proxy in front of it, is briefly unavailable.
+RETRY_STATUSES = frozenset([502, 503, 504])
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+def backoff(attempt, base, cap):
+    """Get how long to wait before resending a post, with full jitter.
+
+    Args:
+        attempt (int): The number of the retry, starting at 1.
+        base (float): The most seconds to wait before the first retry, doubled for every retry after it.
+        cap (float): The most seconds to ever wait.
+
+    Returns:
+        float:
+    """
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+
+def is_transient(error):
+    """Check whether a post that raised is worth sending again. Posts aren't idempotent, so one that timed out
+    waiting for the response isn't, since the chat server may have taken the message and would post it twice.
+
+    Args:
+        error (Exception): What the post raised.
+
+    Returns:
+        bool: Whether it failed to connect, or timed out connecting.
+    """
+    from requests import exceptions
+    return isinstance(error, (exceptions.ConnectionError, exceptions.ConnectTimeout))
+
+
+class CircuitBreaker(object):
+    """Tracks the failures of posts to one room url.
+
+    While closed, every post goes through, and enough consecutive failures open it. While open, posts are refused
+    until the reset timeout has passed, when it turns half-open and lets a single probe through. The probe succeeding
+    closes it again, and failing opens it for another reset timeout.
+
+    Args:
+        failure_threshold (int): The number of consecutive failures that opens the breaker.
+        reset_timeout (float): The seconds the breaker stays open before letting a probe through.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = max(int(failure_threshold), 1)
+        self.reset_timeout = float(reset_timeout)
+        self.state = CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._probe_started = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Check whether a post may be sent, claiming the probe if the breaker is turning half-open.
+
+        Returns:
+            bool:
+        """
+        if self.state == CLOSED:
+            return True
+        with self._lock:
+            now = _clock()
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN:
+                if now - self._opened_at < self.reset_timeout:
+                    return False
+                self.state = HALF_OPEN
+            elif self._probe_started is not None and now - self._probe_started < self.reset_timeout:
+                # A probe is already in flight, and hasn't been lost for longer than the reset timeout.
+                return False
+            self._probe_started = now
+            return True
+
+    def retry_after(self):
+        """float: The seconds until the breaker lets a post through again, 0 if it does now."""
+        if self.state == CLOSED:
+            return 0.0
+        return max(self._opened_at + self.reset_timeout - _clock(), 0.0)
+
+    def record_success(self):
+        if self.state == CLOSED and not self.failures:
+            return
+        with self._lock:
+            self.state = CLOSED
+            self.failures = 0
+            self._probe_started = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = OPEN
+                self._opened_at = _clock()
+                self._probe_started = None
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(url, failure_threshold, reset_timeout):
+    """Get the circuit breaker of a room url, creating it with the given settings on first use.
+
+    Args:
+        url (str): The room url.
+        failure_threshold (int): The number of consecutive failures that opens the breaker.
+        reset_timeout (float): The seconds the breaker stays open before letting a probe through.
+
+    Returns:
+        CircuitBreaker:
+    """
+    breaker = _breakers.get(url)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.get(url)
+            if breaker is None:
+                breaker = _breakers[url] = CircuitBreaker(failure_threshold, reset_timeout)
+    return breaker
+
+
+@forking.after_fork
+def _reset_after_fork():
+    global _breakers_lock
+    _breakers_lock = threading.Lock()
+    for breaker in list(_breakers.values()):
+        breaker._lock = threading.Lock()
+        # A probe the parent had in flight will never be recorded in the child.
+        breaker._probe_started = None
@@ -0,0 +1,168 @@
+"""Pooled, keep-alive HTTP sessions shared by every Messenger. Sessions are kept per webhook host so that consecutive
+posts to the same chat server reuse an already open TCP/TLS connection instead of paying a new handshake each time.
+"""
+
+
+# import built-in modules
+import threading
+import weakref
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:  # pragma: no cover
+    from urlparse import urlsplit
+
+# import local modules
+from eruption import forking
+
+__all__ = [
+    'SessionPool',
+    'get_session_pool',
+    'set_session_pool',
+    'configure_sessions'
+]
+
+
+DEFAULT_POOL_SIZE = 10
+
+_pools = weakref.WeakSet()
+
+
+class SessionPool(object):
+    """Thread-safe registry of `requests.Session` objects keyed by webhook host.
+
+    Args:
+        pool_size (int): The maximum number of connections kept open per host.
+        keep_alive (bool): Whether connections should be kept open between posts.
+        pool_block (bool): Whether to block when every pooled connection to a host is in use, instead of opening
+            (and then discarding) an extra one.
+    """
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, keep_alive=True, pool_block=False):
+        self.pool_size = pool_size
+        self.keep_alive = keep_alive
+        self.pool_block = pool_block
+        self._sessions = {}
+        self._lock = threading.Lock()
+        _pools.add(self)
+
+    @staticmethod
+    def key(url):
+        """Get the key a url is pooled under.
+
+        Args:
+            url (str): The url that will be posted to.
+
+        Returns:
+            tuple: The scheme and host of the url.
+        """
+        parts = urlsplit(url)
+        return parts.scheme.lower(), parts.netloc.lower()
+
+    def get(self, url):
+        """Get the session to use for posting to the given url, creating it on first use.
+
+        Args:
+            url (str): The url that will be posted to.
+
+        Returns:
+            requests.Session:
+        """
+        key = self.key(url)
+        session = self._sessions.get(key)
+        if session is None:
+            with self._lock:
+                session = self._sessions.get(key)
+                if session is None:
+                    session = self._sessions[key] = self._create_session()
+        return session
+
+    def _create_session(self):
+        # requests is imported on first use, it takes longer to import than everything else put together.
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=self.pool_size,
+            pool_block=self.pool_block)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        if not self.keep_alive:
+            session.headers['Connection'] = 'close'
+        return session
+
+    def close(self):
+        """Close every pooled session and the connections they hold."""
+        with self._lock:
+            sessions, self._sessions = self._sessions, {}
+        for session in sessions.values():
+            session.close()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def _reset_after_fork(self):
+        # The inherited connections are left to the parent, and the child connects again on first use.
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+
+def get_session_pool():
+    """Get the process-wide SessionPool, creating it on first use.
+
+    Returns:
+        SessionPool:
+    """
+    global _default_pool
+    if _default_pool is None:
+        with _default_pool_lock:
+            if _default_pool is None:
+                _default_pool = SessionPool()
+    return _default_pool
+
+
+def set_session_pool(pool):
+    """Replace the process-wide SessionPool used by every Messenger that wasn't given its own.
+
+    Args:
+        pool (SessionPool): The pool to use, or None to go back to a default pool created on next use.
+
+    Returns:
+        SessionPool: The previous pool, if any.
+    """
+    global _default_pool
+    with _default_pool_lock:
+        previous, _default_pool = _default_pool, pool
+    return previous
+
+
+def configure_sessions(pool_size=DEFAULT_POOL_SIZE, keep_alive=True, pool_block=False):
+    """Install a new process-wide SessionPool with the given settings, closing the previous one.
+
+    Args:
+        pool_size (int): The maximum number of connections kept open per host.
+        keep_alive (bool): Whether connections should be kept open between posts.
+        pool_block (bool): Whether to block when every pooled connection to a host is in use.
+
+    Returns:
+        SessionPool: The newly installed pool.
+    """
+    pool = SessionPool(pool_size=pool_size, keep_alive=keep_alive, pool_block=pool_block)
+    previous = set_session_pool(pool)
+    if previous is not None:
+        previous.close()
+    return pool
+
+
+@forking.after_fork
+def _reset_after_fork():
+    global _default_pool_lock
+    _default_pool_lock = threading.Lock()
+    for pool in list(_pools):
+        pool._reset_after_fork()
@@ -0,0 +1,120 @@
+"""Streaming bulk posting. Messages are read lazily from a stream of plain lines or NDJSON records and posted with
+bounded concurrency over the pooled sessions, so that a log-shipping pipeline can feed one long-running process
+instead of starting an interpreter per message.
+"""
+
+
+# import built-in modules
+import collections
+import json
+import logging
+import threading
+import time
+from concurrent import futures
+
+__all__ = [
+    'FORMATS',
+    'StreamSummary',
+    'iter_messages',
+    'post_stream'
+]
+
+
+FORMATS = ('plain', 'ndjson')
+DEFAULT_CONCURRENCY = 4
+
+LOGGER = logging.getLogger(__name__)
+
+
+class StreamSummary(collections.namedtuple('StreamSummary', ['sent', 'failed', 'skipped', 'elapsed'])):
+    """The outcome of posting a stream.
+
+    Args:
+        sent (int): The number of messages posted.
+        failed (int): The number of messages whose post failed or was refused.
+        skipped (int): The number of records that couldn't be read.
+        elapsed (float): How many seconds the stream took.
+    """
+
+    __slots__ = ()
+
+    def __str__(self):
+        rate = '{0:.1f}'.format(self.sent / self.elapsed) if self.elapsed > 0 else 'n/a'
+        return 'Posted {0} message(s) in {1:.2f}s ({2}/s), {3} failed, {4} skipped.'.format(
+            self.sent, self.elapsed, rate, self.failed, self.skipped)
+
+
+def iter_messages(lines, format='plain', on_error=None):
+    """Lazily turn lines into messages.
+
+    Args:
+        lines (iterable): The lines to read, such as an open file or stdin.
+        format (str): Either 'plain', where each line is a message, or 'ndjson', where each line is a JSON object
+            with the message under `text` and any other keys as payload overrides.
+        on_error (callable): Called with the line and the error for each record that couldn't be read.
+
+    Yields:
+        tuple: The message and a dict of payload overrides. Blank lines are skipped.
+    """
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if not line.strip():
+            continue
+        if format == 'plain':
+            yield line, {}
+            continue
+        try:
+            overrides = dict(json.loads(line))
+            text = overrides.pop('text')
+        except (ValueError, TypeError, KeyError) as error:
+            if on_error is not None:
+                on_error(line, error)
+            continue
+        yield text, overrides
+
+
+def post_stream(instance, lines, format='plain', concurrency=DEFAULT_CONCURRENCY, overrides=None):
+    """Post every message of a stream, with at most `concurrency` posts in flight and without reading ahead of them.
+    Reading stops early on a KeyboardInterrupt, after which the posts in flight are finished.
+
+    Args:
+        instance (Messenger): The Messenger instance to post with.
+        lines (iterable): The lines to read, such as an open file or stdin.
+        format (str): The format of the lines, see `iter_messages`.
+        concurrency (int): The most posts in flight at once.
+        overrides (dict): Payload overrides for every message, under those of the message itself.
+
+    Returns:
+        StreamSummary:
+    """
+    start = time.time()
+    counts = {'sent': 0, 'failed': 0, 'skipped': 0}
+    lock = threading.Lock()
+    slots = threading.BoundedSemaphore(concurrency)
+
+    def skip(line, error):
+        LOGGER.warning('Skipped a record that could not be read (%s): %r', error, line)
+        counts['skipped'] += 1
+
+    def post(text, message_overrides):
+        try:
+            payload_overrides = dict(overrides or {})
+            payload_overrides.update(message_overrides)
+            result = instance.post(text, **payload_overrides)
+            ok = result is None or result.status_code < 400
+        except Exception as error:
+            LOGGER.warning('Failed to post a streamed message: %s', error)
+            ok = False
+        finally:
+            slots.release()
+        with lock:
+            counts['sent' if ok else 'failed'] += 1
+
+    with futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        try:
+            for text, message_overrides in iter_messages(lines, format, on_error=skip):
+                slots.acquire()
+                executor.submit(post, text, message_overrides)
+        except KeyboardInterrupt:
+            LOGGER.info('Interrupted, finishing the posts in flight')
+    return StreamSummary(counts['sent'], counts['failed'], counts['skipped'], time.time() - start)
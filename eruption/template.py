@@ -0,0 +1,151 @@
+"""Message templates for the decorators. A template is written like a `str.format` string, which is parsed once when
+it is created and checked against the decorated function once when the decorator is applied, so that a call only
+binds and formats what the template references. The message is formatted when the function returns, and only when
+there is a post to make, so that it shows the arguments and the result as they were then.
+"""
+
+
+# import built-in modules
+import inspect
+import re
+import string
+
+__all__ = [
+    'Template'
+]
+
+
+# The fields every template can reference, besides the arguments of the decorated function by name.
+NAME = 'name'
+ARGS = 'args'
+KWARGS = 'kwargs'
+RESULT = 'result'
+EXCEPTION = 'exception'
+ELAPSED = 'elapsed'
+RESERVED_FIELDS = frozenset([NAME, ARGS, KWARGS, RESULT, EXCEPTION, ELAPSED])
+
+_formatter = string.Formatter()
+
+# The root name of a replacement field, and each of the attribute and item lookups that follow it.
+_ROOT = re.compile(r'[^.[]*')
+_LOOKUP = re.compile(r'\.([^.[]+)|\[([^\]]+)\]')
+
+
+def _key(name):
+    # Like `str.format`, keys that are all digits are indexes.
+    return int(name) if name.isdecimal() else name
+
+
+def _split_field(field_name):
+    """Split a replacement field into its root name and the attribute and item lookups that follow it.
+
+    Args:
+        field_name (str): The field, such as `result.status` or `args[0]`.
+
+    Returns:
+        tuple: The root name, and a tuple of pairs of whether each lookup is an attribute and its key.
+
+    Raises:
+        ValueError: If a lookup is empty, or isn't closed.
+    """
+    root = _ROOT.match(field_name).group()
+    lookups = []
+    position = len(root)
+    while position < len(field_name):
+        match = _LOOKUP.match(field_name, position)
+        if match is None:
+            raise ValueError('Invalid replacement field {0!r} in message template'.format(field_name))
+        attribute, key = match.groups()
+        lookups.append((True, attribute) if attribute is not None else (False, _key(key)))
+        position = match.end()
+    return _key(root), tuple(lookups)
+
+
+class Template(object):
+    """A message that is formatted from a call of the decorated function.
+
+    The fields are `name`, the qualified name of the function, `args` and `kwargs`, the arguments it was called
+    with, `result`, what it returned, `exception`, what it raised, `elapsed`, the seconds it took, and any argument
+    of the function by its parameter name. Attribute and item lookups, conversions and format specs work like they
+    do with `str.format`, for instance `'{name} took {elapsed:.2f}s to copy {source!r}'`.
+
+    Decorators only post when the function raises if the template references `exception`, which is None otherwise.
+
+    Args:
+        source (str): The template.
+    """
+
+    __slots__ = ('source', 'fields', '_parts')
+
+    def __init__(self, source):
+        self.source = source
+        self._parts = []
+        fields = set()
+        for literal, field_name, format_spec, conversion in _formatter.parse(source):
+            if literal:
+                self._parts.append(literal)
+            if field_name is None:
+                continue
+            root, lookups = _split_field(field_name)
+            if not isinstance(root, str) or not root:
+                raise ValueError('Message templates only take named fields: {0!r}'.format(source))
+            if format_spec and '{' in format_spec:
+                raise ValueError('Message templates can\'t nest fields in format specs: {0!r}'.format(source))
+            if conversion not in (None, 's', 'r', 'a'):
+                raise ValueError('Unknown conversion {0!r} in message template {1!r}'.format(conversion, source))
+            fields.add(root)
+            self._parts.append((root, lookups, conversion, format_spec))
+        self.fields = frozenset(fields)
+
+    def __repr__(self):
+        return '{0}({1!r})'.format(type(self).__name__, self.source)
+
+    def parameters(self, func):
+        """Check that every field of the template can be filled in for a function.
+
+        Args:
+            func (callable): The decorated function.
+
+        Returns:
+            inspect.Signature: The signature to bind the arguments of its calls with, or None if the template
+                doesn't reference any argument by name.
+
+        Raises:
+            ValueError: If a field is neither one of the reserved fields nor a parameter of the function.
+        """
+        names = self.fields - RESERVED_FIELDS
+        if not names:
+            return None
+        signature = inspect.signature(func)
+        unknown = names.difference(signature.parameters)
+        if unknown:
+            raise ValueError('The message template {0!r} references {1}, which {2} has no parameter for'.format(
+                self.source, ', '.join(sorted(unknown)), getattr(func, '__qualname__', func.__name__)))
+        return signature
+
+    def render(self, context):
+        """Format the template.
+
+        Args:
+            context (dict): The value of every field.
+
+        Returns:
+            str:
+        """
+        pieces = []
+        for part in self._parts:
+            if isinstance(part, str):
+                pieces.append(part)
+                continue
+            root, lookups, conversion, format_spec = part
+            value = context[root]
+            for is_attribute, key in lookups:
+                value = getattr(value, key) if is_attribute else value[key]
+            if conversion == 'r':
+                value = repr(value)
+            elif conversion == 's':
+                value = str(value)
+            elif conversion == 'a':
+                value = ascii(value)
+            pieces.append(format(value, format_spec))
+        return ''.join(pieces)
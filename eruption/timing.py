@@ -0,0 +1,158 @@
+"""Aggregated timing of decorated functions. Every call's duration and outcome is recorded in a streaming histogram,
+which takes the same small amount of memory however many calls it has seen, and a summary of the calls (count, error
+rate and p50/p95/p99) is posted once per window instead of one message per call.
+"""
+
+
+# import built-in modules
+import atexit
+import logging
+import threading
+import weakref
+
+# import local modules
+from eruption import delivery
+from eruption import forking
+from eruption import metrics
+
+__all__ = [
+    'TimingAggregator'
+]
+
+
+DEFAULT_INTERVAL = 300.0
+# Bucket bounds from a microsecond to over twenty minutes, 10% apart, which keeps quantiles within 10% of the truth.
+HISTOGRAM_BUCKETS = (1e-06, 1.1, 220)
+SUMMARY_TEMPLATE = ('{name}: {count} call(s) in {seconds:.0f}s, {errors} error(s) ({error_rate:.1%}), '
+                    'p50 {p50:.1f}ms, p95 {p95:.1f}ms, p99 {p99:.1f}ms, max {max:.1f}ms')
+
+LOGGER = logging.getLogger(__name__)
+
+_aggregators = weakref.WeakSet()
+
+
+class TimingAggregator(object):
+    """Records the duration and outcome of calls, and sends a summary of them once per window.
+
+    A window closes after `interval` seconds, or after `every` calls if that comes first. With `slow` or
+    `max_error_rate` set, the summary of a window is only sent when its p95 or error rate goes over them, so that a
+    healthy function stays quiet.
+
+    Args:
+        send (callable): Called with the summary text to post it.
+        name (str): The name of what is timed, to start the summary with.
+        interval (float): The most seconds a window stays open after its first call.
+        every (int): The most calls in a window, or None for no limit.
+        slow (float): Only send summaries whose p95 takes longer than this many seconds.
+        max_error_rate (float): Only send summaries whose fraction of failed calls is over this, between 0 and 1.
+        summary_template (str): The summary, formatted with the `name`, `count`, `errors`, `error_rate`, `seconds`,
+            the last `error` and the `p50`, `p95`, `p99` and `max` milliseconds.
+    """
+
+    def __init__(self, send, name, interval=DEFAULT_INTERVAL, every=None, slow=None, max_error_rate=None,
+                 summary_template=SUMMARY_TEMPLATE):
+        self.send = send
+        self.name = name
+        self.interval = interval
+        self.every = every
+        self.slow = slow
+        self.max_error_rate = max_error_rate
+        self.summary_template = summary_template
+        self._histogram = None
+        self._errors = 0
+        self._last_error = None
+        self._started = None
+        self._timer = None
+        self._lock = threading.Lock()
+        _aggregators.add(self)
+
+    def record(self, elapsed, error=None):
+        """Record a call.
+
+        Args:
+            elapsed (float): The seconds the call took.
+            error (Exception): What the call raised, if anything.
+        """
+        with self._lock:
+            if self._histogram is None:
+                self._histogram = metrics.Histogram.exponential(*HISTOGRAM_BUCKETS)
+                self._errors = 0
+                self._last_error = None
+                self._started = metrics.clock()
+                self._timer = threading.Timer(self.interval, self._expire, args=(self._histogram,))
+                self._timer.daemon = True
+                self._timer.start()
+            histogram = self._histogram
+            histogram.observe(elapsed)
+            if error is not None:
+                self._errors += 1
+                self._last_error = error
+            full = self.every is not None and histogram.count >= self.every
+            summary = self._take() if full else None
+        if summary is not None:
+            # Filled up by the caller's thread, which shouldn't wait on the post.
+            delivery.submit(self._send, summary)
+
+    def _take(self):
+        histogram, self._histogram = self._histogram, None
+        self._timer.cancel()
+        error_rate = self._errors / float(histogram.count)
+        if (self.slow is not None or self.max_error_rate is not None) and not (
+                (self.slow is not None and histogram.quantile(0.95) > self.slow) or
+                (self.max_error_rate is not None and error_rate > self.max_error_rate)):
+            return None
+        return self.summary_template.format(
+            name=self.name,
+            count=histogram.count,
+            errors=self._errors,
+            error_rate=error_rate,
+            error=repr(self._last_error) if self._last_error is not None else '',
+            seconds=metrics.clock() - self._started,
+            p50=histogram.quantile(0.5) * 1000,
+            p95=histogram.quantile(0.95) * 1000,
+            p99=histogram.quantile(0.99) * 1000,
+            max=histogram.max * 1000)
+
+    def _expire(self, histogram):
+        with self._lock:
+            if self._histogram is not histogram:
+                return
+            summary = self._take()
+        if summary is not None:
+            self._send(summary)
+
+    def _send(self, summary):
+        try:
+            self.send(summary)
+        except Exception as error:
+            LOGGER.warning('Failed to post the timing summary of %s: %s', self.name, error, exc_info=True)
+
+    @property
+    def pending(self):
+        """int: The number of calls recorded in the open window."""
+        histogram = self._histogram
+        return histogram.count if histogram is not None else 0
+
+    def _reset_after_fork(self):
+        # The open window is the parent's to summarize.
+        self._histogram = None
+        self._lock = threading.Lock()
+
+    def flush(self):
+        """Send the summary of the open window right away."""
+        with self._lock:
+            summary = self._take() if self._histogram is not None else None
+        if summary is not None:
+            self._send(summary)
+
+
+@forking.after_fork
+def _reset_after_fork():
+    for aggregator in list(_aggregators):
+        aggregator._reset_after_fork()
+
+
+@atexit.register
+def _flush_at_exit():
+    for aggregator in list(_aggregators):
+        aggregator.flush()
@@ -0,0 +1,180 @@
+"""Streaming file uploads. Files are read from disk, or from any file object such as a memory-mapped file, in chunks
+as the request body is sent, so that attaching a multi-hundred-megabyte log to an alert never holds more than a chunk
+of it in memory. Text logs can be gzipped on the way, which is done chunk by chunk into a temporary file that stays in
+memory while it is small, so that the compressed size is known up front.
+"""
+
+
+# import built-in modules
+import mimetypes
+import os
+import tempfile
+import uuid
+import zlib
+
+__all__ = [
+    'FileSource',
+    'MultipartBody'
+]
+
+
+CHUNK_SIZE = 64 * 1024
+# Compressed files bigger than this are spooled to disk instead of memory.
+SPOOL_SIZE = 1024 * 1024
+DEFAULT_CONTENT_TYPE = 'application/octet-stream'
+
+
+class FileSource(object):
+    """A file to upload, read in chunks.
+
+    Args:
+        file (str|file): The path of the file, or a file object opened in binary mode, such as an `mmap.mmap`. It is
+            read from its current position.
+        filename (str): The name to upload the file as, defaults to the name of the file.
+        content_type (str): The media type of the file, guessed from its name by default.
+    """
+
+    def __init__(self, file, filename=None, content_type=None):
+        self._owned = not hasattr(file, 'read')
+        self.file = open(file, 'rb') if self._owned else file
+        name = file if self._owned else getattr(file, 'name', None)
+        self.filename = filename or (os.path.basename(name) if isinstance(name, str) else 'file')
+        self.content_type = content_type or mimetypes.guess_type(self.filename)[0] or DEFAULT_CONTENT_TYPE
+        self.size = self._remaining_size()
+
+    def _remaining_size(self):
+        try:
+            position = self.file.tell()
+            end = self.file.seek(0, os.SEEK_END)
+            self.file.seek(position)
+            return (end if end is not None else self.file.tell()) - position
+        except (AttributeError, IOError, OSError, ValueError):
+            return None
+
+    def chunks(self, size=CHUNK_SIZE):
+        """Read the rest of the file.
+
+        Args:
+            size (int): The most bytes read at once.
+
+        Returns:
+            generator: The chunks of the file.
+        """
+        while True:
+            chunk = self.file.read(size)
+            if not chunk:
+                return
+            yield chunk
+
+    def gzip(self, level=6):
+        """Compress the file, chunk by chunk.
+
+        Args:
+            level (int): The compression level, from 1 (fastest) to 9 (smallest).
+
+        Returns:
+            FileSource: The compressed file, named with a `.gz` extension. It is read from the start, and this file
+                is closed.
+        """
+        spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        try:
+            for chunk in self.chunks():
+                spool.write(compressor.compress(chunk))
+            spool.write(compressor.flush())
+        except Exception:
+            spool.close()
+            raise
+        finally:
+            self.close()
+        spool.seek(0)
+        compressed = FileSource(spool, filename=self.filename + '.gz', content_type='application/gzip')
+        compressed._owned = True
+        return compressed
+
+    def close(self):
+        """Close the file, if it was opened from a path or by `gzip`."""
+        if self._owned:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _quote(value):
+    # Quotes and line breaks can't appear in a quoted header parameter, so they are percent-encoded like browsers do.
+    return value.replace('"', '%22').replace('\r', '%0D').replace('\n', '%0A')
+
+
+class MultipartBody(object):
+    """A `multipart/form-data` request body that is generated as it is sent.
+
+    Args:
+        fields (list): Tuples of the name, value and content type of every form field. The content type may be None.
+        files (list): Pairs of the name of every file field and its FileSource.
+        boundary (str): The boundary between the parts, a random one by default.
+    """
+
+    def __init__(self, fields=(), files=(), boundary=None):
+        self.boundary = boundary or uuid.uuid4().hex
+        self._parts = []
+        for name, value, content_type in fields:
+            if not isinstance(value, bytes):
+                value = value.encode('utf-8')
+            self._parts.append((self._header(name, None, content_type), value, None))
+        for name, source in files:
+            self._parts.append((self._header(name, source.filename, source.content_type), None, source))
+        self._closing = '--{0}--\r\n'.format(self.boundary).encode('ascii')
+
+    def _header(self, name, filename, content_type):
+        header = '--{0}\r\nContent-Disposition: form-data; name="{1}"'.format(self.boundary, _quote(name))
+        if filename is not None:
+            header += '; filename="{0}"'.format(_quote(filename))
+        if content_type:
+            header += '\r\nContent-Type: {0}'.format(content_type)
+        return (header + '\r\n\r\n').encode('utf-8')
+
+    @property
+    def content_type(self):
+        """str: The value of the Content-Type header to send the body with."""
+        return 'multipart/form-data; boundary={0}'.format(self.boundary)
+
+    @property
+    def length(self):
+        """int: The size of the body in bytes, or None if the size of one of its files isn't known."""
+        total = len(self._closing)
+        for header, value, source in self._parts:
+            size = len(value) if source is None else source.size
+            if size is None:
+                return None
+            total += len(header) + size + 2
+        return total
+
+    def __len__(self):
+        length = self.length
+        if length is None:
+            raise TypeError('The size of the body is not known')
+        return length
+
+    def __iter__(self):
+        for header, value, source in self._parts:
+            yield header
+            if source is None:
+                yield value
+            else:
+                for chunk in source.chunks():
+                    yield chunk
+            yield b'\r\n'
+        yield self._closing
+
+    def stream(self):
+        """Get what to pass as the body of a request.
+
+        Returns:
+            MultipartBody|generator: This body, which is sent with a Content-Length when its size is known, otherwise
+                a generator of its chunks, which is sent with chunked transfer encoding.
+        """
+        return self if self.length is not None else iter(self)
@@ -7,4 +7,10 @@ setup(
     requires=[
         'requests==2.18',
         'click==6.7'
-    ])
+    ],
+    extras_require={
+        'async': ['aiohttp>=3.0']
+    },
+    entry_points={
+        'console_scripts': ['eruption = eruption.cli:cli']
+    })
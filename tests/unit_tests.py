@@ -0,0 +1,1514 @@
+"""Unit tests for Eruption, run against a local stand-in for the chat services' webhooks. """
+# import built-in modules
+import asyncio
+import email.parser
+import gzip
+import json
+import logging
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import weakref
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:  # pragma: no cover
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+# import 3rd party modules
+from click.testing import CliRunner
+
+# import local modules
+from eruption import chunking
+from eruption import cli
+from eruption import config
+from eruption import dedupe
+from eruption import delivery
+from eruption import eruption
+from eruption import metrics
+from eruption import ratelimit
+from eruption import relay
+from eruption import retry
+from eruption import sessions
+
+try:
+    from eruption import aio
+except ImportError:  # aiohttp isn't installed
+    aio = None
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    """A local webhook endpoint that records every request it receives."""
+
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubHandler)
+        self.requests = []
+        self.ports = set()
+        self.delay = 0
+        self.status = 200
+        self.headers = {}
+        self.responses = []
+        self.bodies = []
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve_forever, kwargs={'poll_interval': 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def base_url(self):
+        return '127.0.0.1:{0}'.format(self.server_address[1])
+
+    @property
+    def url(self):
+        return 'http://{0}'.format(self.base_url)
+
+    def payloads(self):
+        with self.lock:
+            return [json.loads(body.decode('utf-8')) for _, _, body in self.requests]
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        with self.server.lock:
+            self.server.requests.append((self.path, dict(self.headers), body))
+            self.server.ports.add(self.client_address[1])
+            if self.server.responses:
+                status, headers = self.server.responses.pop(0)
+            else:
+                status, headers = self.server.status, dict(self.server.headers)
+            response = self.server.bodies.pop(0) if self.server.bodies else b'{"success":true}'
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *args):
+        pass
+
+
+class ServerTestCase(unittest.TestCase):
+    """Base test case that provides a fresh stand-in server and session pool for every test."""
+
+    def setUp(self):
+        self.server = StubServer()
+        self.previous_pool = sessions.set_session_pool(sessions.SessionPool())
+
+    def tearDown(self):
+        sessions.set_session_pool(self.previous_pool).close()
+        self.server.stop()
+
+    def rocketchat(self, **kwargs):
+        return eruption.RocketChat(base_url=self.server.base_url, token='token', **kwargs)
+
+
+class TestPayload(unittest.TestCase):
+    """Tests for the precompiled payload templates."""
+
+    def setUp(self):
+        self.instances = [
+            eruption.Slack(room_id='room', token='token', channel='channel'),
+            eruption.HipChat(room_id='room', token='token'),
+            eruption.Mattermost(token='token', base_url='localhost'),
+            eruption.RocketChat(base_url='localhost', token='token'),
+            eruption.Discord(room_id='room', token='token')
+        ]
+
+    def test_byte_identical(self):
+        """Ensure that payloads are byte-identical to encoding the whole payload with json.dumps."""
+        for instance in self.instances:
+            for text in ['plain', 'quotes " and \\ slashes', u'unicode \u2603 and \ud83c\udf0b', '\n\t\x00']:
+                expected = dict([(instance.text_key, text)] + list(instance.payload_defaults))
+                self.assertEqual(instance._process_data(text), json.dumps(expected).encode('utf-8'))
+
+    def test_overrides(self):
+        """Ensure that overrides replace defaults, including through aliases, and add new keys."""
+        instance = eruption.Slack(room_id='room', token='token', channel='channel')
+        data = json.loads(instance._process_data('text', channel='#alerts', user_name='bot', attachments=[]).decode())
+        self.assertEqual(data, {'text': 'text', 'channel': '#alerts', 'username': 'bot', 'icon_emoji': ':ghost:',
+                                'attachments': []})
+
+    def test_instance_defaults(self):
+        """Ensure that defaults given to an instance are compiled into its template."""
+        instance = eruption.Discord(room_id='room', token='token', payload_defaults={'user_name': 'bot', 'tts': True})
+        self.assertEqual(instance._process_data('text'), b'{"content": "text", "username": "bot", "tts": true}')
+
+
+class TestSessionPool(ServerTestCase):
+    """Tests for the pooled, keep-alive sessions."""
+
+    def test_posts_reuse_one_connection(self):
+        """Ensure that consecutive posts to the same host go over a single kept-alive connection."""
+        instance = self.rocketchat()
+        for index in range(5):
+            self.assertEqual(instance.post('message {0}'.format(index)).status_code, 200)
+        self.assertEqual(len(self.server.requests), 5)
+        self.assertEqual(len(self.server.ports), 1)
+
+    def test_instances_share_sessions_by_host(self):
+        """Ensure that instances posting to the same host share their session."""
+        first = self.rocketchat()
+        second = eruption.Mattermost(token='other', base_url=self.server.base_url)
+        self.assertIs(first.get_session(), second.get_session())
+        self.assertEqual(len(sessions.get_session_pool()), 1)
+
+    def test_session_injection(self):
+        """Ensure that a session given to an instance is used instead of the pooled one."""
+        session = sessions.SessionPool().get(self.server.url)
+        instance = self.rocketchat(session=session)
+        self.assertIs(instance.get_session(), session)
+        instance.post('injected')
+        self.assertEqual(len(sessions.get_session_pool()), 0)
+
+    def test_no_keep_alive(self):
+        """Ensure that disabling keep-alive opens a new connection for every post."""
+        instance = self.rocketchat(session_pool=sessions.SessionPool(keep_alive=False))
+        instance.post('first')
+        instance.post('second')
+        self.assertEqual(len(self.server.ports), 2)
+
+
+class TestBackgroundDelivery(ServerTestCase):
+    """Tests for posting from the background sender."""
+
+    def setUp(self):
+        super(TestBackgroundDelivery, self).setUp()
+        self.previous_sender = delivery.set_sender(delivery.BackgroundSender(workers=2))
+
+    def tearDown(self):
+        delivery.set_sender(self.previous_sender).shutdown(timeout=5)
+        super(TestBackgroundDelivery, self).tearDown()
+
+    def test_decorator_returns_before_post(self):
+        """Ensure that a background decorator returns the function's result without waiting on the post."""
+        self.server.delay = 0.5
+
+        @eruption.rocketchat(message='background', instance=self.rocketchat(), background=True)
+        def adder():
+            return 1 + 1
+
+        start = time.time()
+        self.assertEqual(adder(), 2)
+        self.assertLess(time.time() - start, 0.5)
+        self.assertTrue(eruption.flush(timeout=5))
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_flush_timeout(self):
+        """Ensure that flush gives up after its timeout while posts are still queued."""
+        self.server.delay = 0.5
+        future = self.rocketchat().submit('slow')
+        self.assertFalse(eruption.flush(timeout=0.1))
+        self.assertTrue(eruption.flush(timeout=5))
+        self.assertEqual(future.result().status_code, 200)
+
+    def blocked_sender(self, **kwargs):
+        """Get a sender with a single worker, which is busy until the returned event is set."""
+        sender = delivery.BackgroundSender(workers=1, **kwargs)
+        self.addCleanup(sender.shutdown, 5)
+        started = threading.Event()
+        release = threading.Event()
+        sender.submit(lambda: started.set() or release.wait(5))
+        started.wait(5)
+        return sender, release
+
+    def test_priorities(self):
+        """Ensure that higher priority lanes are drained first, and that their stats are kept."""
+        sender, release = self.blocked_sender()
+        order = []
+        for index in range(3):
+            sender.schedule('low', order.append, 'low {0}'.format(index))
+        sender.schedule('high', order.append, 'high')
+        self.assertEqual(sender.stats()['low'].depth, 3)
+        release.set()
+        self.assertTrue(sender.flush(timeout=5))
+        self.assertEqual(order, ['high', 'low 0', 'low 1', 'low 2'])
+        stats = sender.stats()
+        self.assertEqual((stats['high'].depth, stats['high'].sent, stats['low'].sent), (0, 1, 3))
+        self.assertGreater(stats['low'].wait_max, 0)
+        with self.assertRaises(ValueError):
+            sender.schedule('urgent', order.append, 'urgent')
+
+    def test_starvation(self):
+        """Ensure that a call that waited too long is taken ahead of higher priority lanes."""
+        sender, release = self.blocked_sender(starvation_timeout=0.1)
+        order = []
+        sender.schedule('low', order.append, 'low')
+        time.sleep(0.15)
+        sender.schedule('high', order.append, 'high')
+        release.set()
+        sender.flush(timeout=5)
+        self.assertEqual(order, ['low', 'high'])
+
+    def test_starved_backlog(self):
+        """Ensure that a backlog of starved calls doesn't hold up a higher priority call behind all of them."""
+        sender, release = self.blocked_sender(starvation_timeout=0.1)
+        order = []
+        for index in range(20):
+            sender.schedule('low', order.append, 'low {0}'.format(index))
+        time.sleep(0.15)
+        sender.schedule('high', order.append, 'high')
+        release.set()
+        self.assertTrue(sender.flush(timeout=5))
+        self.assertEqual(order[:3], ['low 0', 'high', 'low 1'])
+        self.assertEqual(len(order), 21)
+
+    def test_overflow(self):
+        """Ensure that calls that find the queue full are dropped, or make room, as the overflow policy says."""
+        for overflow, expected in (('drop-newest', ['first', 'second']), ('drop-oldest', ['second', 'third'])):
+            sender, release = self.blocked_sender(max_pending=2, overflow=overflow)
+            order = []
+            futures = [sender.submit(order.append, text) for text in ('first', 'second', 'third')]
+            self.assertEqual(sender.dropped, 1)
+            release.set()
+            sender.flush(timeout=5)
+            self.assertEqual(order, expected)
+            dropped = [future for future in futures if future.exception(timeout=5) is not None]
+            self.assertEqual(len(dropped), 1)
+            self.assertIsInstance(dropped[0].exception(), eruption.QueueFullError)
+
+    def test_overflow_keeps_higher_priorities(self):
+        """Ensure that drop-oldest doesn't make room for a call by dropping the calls of higher priority lanes."""
+        sender, release = self.blocked_sender(max_pending=2, overflow='drop-oldest')
+        order = []
+        sender.schedule('high', order.append, 'high 0')
+        sender.schedule('low', order.append, 'low')
+        sender.schedule('high', order.append, 'high 1')
+        self.assertIsInstance(sender.schedule('low', order.append, 'notice').exception(timeout=5),
+                              eruption.QueueFullError)
+        release.set()
+        self.assertTrue(sender.flush(timeout=5))
+        self.assertEqual(order, ['high 0', 'high 1'])
+        self.assertEqual(sender.dropped, 2)
+
+    def test_overflow_bytes(self):
+        """Ensure that the queue is bounded by the size of the text of the calls waiting in it."""
+        sender, release = self.blocked_sender(max_pending_bytes=10, overflow='drop-newest')
+        sender.submit(len, 'a' * 6)
+        self.assertFalse(sender.submit(len, 'b' * 4).done())
+        self.assertEqual(sender.pending_bytes, 10)
+        self.assertIsInstance(sender.submit(len, 'c').exception(timeout=5), eruption.QueueFullError)
+        release.set()
+        self.assertTrue(sender.flush(timeout=5))
+        self.assertEqual(sender.pending_bytes, 0)
+
+    def test_overflow_block(self):
+        """Ensure that the block policy waits for room, and drops the call once its timeout has passed."""
+        sender, release = self.blocked_sender(max_pending=1, block_timeout=0.2)
+        sender.submit(time.sleep, 0)
+        start = time.time()
+        self.assertIsInstance(sender.submit(time.sleep, 0).exception(timeout=5), eruption.QueueFullError)
+        self.assertGreaterEqual(time.time() - start, 0.2)
+        threading.Timer(0.1, release.set).start()
+        future = sender.submit(time.sleep, 0)
+        self.assertIsNone(future.result(timeout=5))
+        self.assertEqual(sender.dropped, 1)
+
+    def test_overflow_block_on_event_loop(self):
+        """Ensure that the block policy doesn't stall a running event loop, and spills or drops the call instead."""
+        sender, release = self.blocked_sender(max_pending=1, block_timeout=None)
+        sender.submit(time.sleep, 0)
+
+        async def submit():
+            return sender.submit(time.sleep, 0)
+
+        self.assertIsInstance(asyncio.run(submit()).exception(timeout=5), eruption.QueueFullError)
+        self.assertEqual(sender.dropped, 1)
+        release.set()
+
+    def test_overflow_bytes_of_lists(self):
+        """Ensure that lists of pieces of text count towards the bytes of the queue."""
+        sender, release = self.blocked_sender(max_pending_bytes=100)
+        sender.submit(len, ['a' * 6, ('b' * 4,)])
+        self.assertEqual(sender.pending_bytes, 10)
+        release.set()
+        self.assertTrue(sender.flush(timeout=5))
+
+    def test_overflow_spill(self):
+        """Ensure that the spill policy writes the posts that find the queue full to the outbox."""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        outbox = eruption.Outbox(os.path.join(directory, 'outbox.sqlite3'))
+        self.addCleanup(outbox.close)
+        sender, release = self.blocked_sender(max_pending=1, overflow='spill', outbox=outbox)
+        instance = self.rocketchat()
+        sender.submit(len, 'queued')
+        self.assertIsNone(sender.submit(instance.post, 'spilled').result(timeout=5))
+        self.assertIsInstance(sender.submit(len, 'not a post').exception(timeout=5), eruption.QueueFullError)
+        self.assertEqual((sender.spilled, sender.dropped), (1, 1))
+        self.assertEqual(len(outbox), 1)
+        release.set()
+        self.assertEqual(outbox.drain().sent, 1)
+        self.assertEqual([payload['text'] for payload in self.server.payloads()], ['spilled'])
+
+    def test_post_priority(self):
+        """Ensure that posts and decorators with a priority are queued in its lane."""
+        self.server.delay = 0.2
+        future = self.rocketchat().post('urgent', priority='high')
+        self.assertEqual(future.result(timeout=5).status_code, 200)
+
+        @eruption.rocketchat('done', self.rocketchat(), priority='low')
+        def adder():
+            return 1 + 1
+
+        start = time.time()
+        self.assertEqual(adder(), 2)
+        self.assertLess(time.time() - start, 0.2)
+        self.assertTrue(eruption.flush(timeout=5))
+        self.assertEqual(delivery.get_sender().stats()['low'].sent, 1)
+        self.assertEqual([payload['text'] for payload in self.server.payloads()], ['urgent', 'done'])
+
+
+class TestInstanceCache(ServerTestCase):
+    """Tests for the instances cached by the post_to_* decorators."""
+
+    def setUp(self):
+        super(TestInstanceCache, self).setUp()
+        eruption.instance_cache.clear()
+
+    def test_decorator_reuses_instance(self):
+        """Ensure that repeated calls of a decorated function post with the same instance."""
+        @eruption.post_to_rocketchat(message='cached', base_url=self.server.base_url, token='token')
+        def adder():
+            return 1 + 1
+
+        for _ in range(3):
+            self.assertEqual(adder(), 2)
+        self.assertEqual(eruption.instance_cache.info(), (2, 1, 128, 1))
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_lru_eviction(self):
+        """Ensure that the least recently used instance is evicted once the cache is full."""
+        instances = eruption.InstanceCache(maxsize=2)
+        first = instances.get(eruption.RocketChat, base_url=self.server.base_url, token='first')
+        instances.get(eruption.RocketChat, base_url=self.server.base_url, token='second')
+        self.assertIs(instances.get(eruption.RocketChat, base_url=self.server.base_url, token='first'), first)
+        instances.get(eruption.RocketChat, base_url=self.server.base_url, token='third')
+        self.assertIs(instances.get(eruption.RocketChat, base_url=self.server.base_url, token='first'), first)
+        self.assertEqual(instances.info(), (2, 3, 2, 2))
+
+
+class TestBroadcaster(ServerTestCase):
+    """Tests for posting one message to many targets."""
+
+    def setUp(self):
+        super(TestBroadcaster, self).setUp()
+        self.slow_server = StubServer()
+        self.slow_server.delay = 1
+
+    def tearDown(self):
+        self.slow_server.stop()
+        super(TestBroadcaster, self).tearDown()
+
+    def test_post_to_every_target(self):
+        """Ensure that every target gets the message, with its payload built once per platform."""
+        targets = [self.rocketchat(), eruption.Mattermost(token='other', base_url=self.server.base_url),
+                   self.rocketchat()]
+        with eruption.Broadcaster(targets) as broadcaster:
+            results = broadcaster.post('broadcast')
+        self.assertEqual([result.messenger for result in results], targets)
+        self.assertEqual([result.response.status_code for result in results], [200] * 3)
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_targets_deduplicate_and_coalesce(self):
+        """Ensure that broadcasts go through the deduplicator and coalescer of the targets that have them."""
+        deduplicating = self.rocketchat(dedupe=10)
+        coalescing = eruption.Mattermost(token='other', base_url=self.server.base_url, coalesce=10)
+        with eruption.Broadcaster([deduplicating, coalescing]) as broadcaster:
+            first = broadcaster.post('broadcast')
+            repeated = broadcaster.post('broadcast')
+        self.assertEqual(first[0].response.status_code, 200)
+        self.assertIsNone(first[1].response)
+        self.assertEqual([(result.response, result.error) for result in repeated], [(None, None)] * 2)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(deduplicating.deduplicator.suppressed, 1)
+        self.assertEqual(coalescing.coalescer.pending, 2)
+        coalescing.coalescer.flush()
+        deduplicating.deduplicator.flush()
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_slow_target_does_not_hold_up_others(self):
+        """Ensure that a target that doesn't answer in time is reported without delaying the others."""
+        slow = eruption.RocketChat(base_url=self.slow_server.base_url, token='token')
+        with eruption.Broadcaster([slow, self.rocketchat()], timeout=0.3) as broadcaster:
+            start = time.time()
+            slow_result, fast_result = broadcaster.post('broadcast')
+            self.assertLess(time.time() - start, 0.9)
+        self.assertIsNone(slow_result.response)
+        self.assertIsNotNone(slow_result.error)
+        self.assertEqual(fast_result.response.status_code, 200)
+        self.assertIsNone(fast_result.error)
+
+
+class TestRateLimit(ServerTestCase):
+    """Tests for the per-endpoint rate limiting."""
+
+    def test_bucket_spreads_out_bursts(self):
+        """Ensure that posts past the burst wait for the bucket to refill."""
+        instance = self.rocketchat(rate_limit=(20, 2))
+        start = time.time()
+        for index in range(6):
+            instance.post('message {0}'.format(index))
+        self.assertGreaterEqual(time.time() - start, 0.19)
+        self.assertEqual(len(self.server.requests), 6)
+
+    def test_buckets_follow_limits(self):
+        """Ensure that instances posting to the same url share a bucket only when they have the same limits."""
+        first = self.rocketchat(rate_limit=(20, 2))
+        self.assertIs(first.get_rate_limiter(), self.rocketchat(rate_limit=(20, 2)).get_rate_limiter())
+        other = self.rocketchat(rate_limit=(5, 1)).get_rate_limiter()
+        self.assertIsNot(first.get_rate_limiter(), other)
+        self.assertEqual((other.rate, other.burst), (5.0, 1))
+
+    def test_retry_after(self):
+        """Ensure that a post refused with a 429 is resent once the Retry-After has passed."""
+        self.server.responses.append((429, {'Retry-After': '0.3'}))
+        instance = self.rocketchat(rate_limit=(100, 10), url_template='http://{base_url}/hooks/retry/{token}')
+        start = time.time()
+        result = instance.post('limited')
+        self.assertGreaterEqual(time.time() - start, 0.3)
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_rate_limit_headers(self):
+        """Ensure that running out of requests according to the headers pauses the bucket until the reset."""
+        bucket = ratelimit.TokenBucket(100, 10)
+        self.server.headers = {'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset-After': '0.3'}
+        response = self.rocketchat().post('headers')
+        self.assertFalse(bucket.observe(response))
+        self.assertGreaterEqual(bucket.acquire(), 0.25)
+
+
+class TestCoalesce(ServerTestCase):
+    """Tests for merging bursts of messages into one post."""
+
+    def test_burst_is_merged(self):
+        """Ensure that messages posted within the window are sent as one payload once it closes."""
+        instance = self.rocketchat(coalesce=0.2)
+        for index in range(10):
+            self.assertIsNone(instance.post('message {0}'.format(index)))
+        self.assertEqual(len(self.server.requests), 0)
+        time.sleep(0.4)
+        self.assertEqual([payload['text'] for payload in self.server.payloads()],
+                         ['\n'.join('message {0}'.format(index) for index in range(10))])
+
+    def test_merged_payloads_respect_limits(self):
+        """Ensure that a window is sent early once merging another message would go over the length limit."""
+        instance = self.rocketchat(coalesce=10, coalesce_max_messages=3)
+        instance.coalescer.max_length = 20
+        for message in ['a' * 8, 'b' * 8, 'c' * 8, 'd', 'e', 'f']:
+            instance.post(message)
+        instance.coalescer.flush()
+        self.assertEqual([payload['text'] for payload in self.server.payloads()],
+                         ['a' * 8 + '\n' + 'b' * 8, 'c' * 8 + '\nd\ne', 'f'])
+
+
+class TestStreaming(ServerTestCase):
+    """Tests for posting streams of messages from the command line."""
+
+    def invoke(self, arguments, input):
+        return CliRunner().invoke(
+            cli.cli, ['rocketchat', '--base-url', self.server.base_url, '--token', 'token'] + arguments, input=input)
+
+    def test_plain_stream(self):
+        """Ensure that every non-blank line of stdin is posted, with a summary at the end."""
+        lines = ['line {0}'.format(index) for index in range(10)]
+        result = self.invoke(['--stream', '--concurrency', '3'], '\n'.join(lines[:5] + [''] + lines[5:]) + '\n')
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('Posted 10 message(s)', result.output)
+        self.assertEqual(sorted(payload['text'] for payload in self.server.payloads()), sorted(lines))
+
+    def test_ndjson_stream(self):
+        """Ensure that NDJSON records are posted with their overrides, and unreadable records are skipped."""
+        records = [json.dumps({'text': 'first', 'channel': '#alerts'}), '{"no text": true}', 'not json',
+                   json.dumps({'text': 'second'})]
+        result = self.invoke(['--stream', '--format', 'ndjson', '--concurrency', '1', '--channel', '#ops'],
+                             '\n'.join(records))
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('Posted 2 message(s)', result.output)
+        self.assertIn('2 skipped', result.output)
+        self.assertEqual([(payload['text'], payload['channel']) for payload in self.server.payloads()],
+                         [('first', '#alerts'), ('second', '#ops')])
+
+    def test_single_message(self):
+        """Ensure that a single message is still posted without streaming."""
+        result = self.invoke(['--message', 'single'], '')
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual([payload['text'] for payload in self.server.payloads()], ['single'])
+
+
+class TestConfiguration(ServerTestCase):
+    """Tests for loading the command line's configuration."""
+
+    def setUp(self):
+        super(TestConfiguration, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'eruption.cfg')
+        self.previous_cache_directory, config.CACHE_DIRECTORY = config.CACHE_DIRECTORY, self.directory
+        self.write('[eruption]\nuser_name = bot\n\n[rocketchat]\nbase_url = {0}\ntoken = token\n'.format(
+            self.server.base_url))
+
+    def tearDown(self):
+        config.CACHE_DIRECTORY = self.previous_cache_directory
+        shutil.rmtree(self.directory)
+        super(TestConfiguration, self).tearDown()
+
+    def write(self, text):
+        with open(self.path, 'w') as configuration:
+            configuration.write(text)
+
+    def test_cache_follows_changes(self):
+        """Ensure that the cached configuration is used until the file changes."""
+        self.assertEqual(config.get_section(config.load(self.path), 'rocketchat'),
+                         {'user_name': 'bot', 'base_url': self.server.base_url, 'token': 'token'})
+        self.assertEqual(len([name for name in os.listdir(self.directory) if name.endswith('.marshal')]), 1)
+
+        self.write('[rocketchat]\ntoken = changed\n')
+        os.utime(self.path, (time.time() + 10, time.time() + 10))
+        self.assertEqual(config.load(self.path), {'rocketchat': {'token': 'changed'}})
+
+    def test_cache_is_private(self):
+        """Ensure that the cache, which holds the tokens, and its directory can only be read by their owner."""
+        config.CACHE_DIRECTORY = os.path.join(self.directory, 'cache')
+        config.load(self.path)
+        self.assertEqual(os.stat(config.CACHE_DIRECTORY).st_mode & 0o777, 0o700)
+        for name in os.listdir(config.CACHE_DIRECTORY):
+            self.assertEqual(os.stat(os.path.join(config.CACHE_DIRECTORY, name)).st_mode & 0o777, 0o600)
+
+    def test_missing_file(self):
+        """Ensure that a missing configuration file is the same as an empty one."""
+        self.assertEqual(config.load(os.path.join(self.directory, 'missing.cfg')), {})
+
+    def test_cli_uses_configuration(self):
+        """Ensure that commands fall back to the configuration for what isn't given on the command line."""
+        result = CliRunner().invoke(cli.cli, ['--config', self.path, 'rocketchat', '--message', 'configured'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual([(payload['text'], payload['username']) for payload in self.server.payloads()],
+                         [('configured', 'bot')])
+
+        result = CliRunner().invoke(cli.cli, ['--config', self.path, 'discord', '--message', 'unconfigured'])
+        self.assertEqual(result.exit_code, 2)
+        self.assertIn('Missing the room id', result.output)
+
+
+class TestOutbox(ServerTestCase):
+    """Tests for the durable outbox."""
+
+    def setUp(self):
+        super(TestOutbox, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'outbox.sqlite3')
+        self.outbox = eruption.Outbox(self.path)
+
+    def tearDown(self):
+        self.outbox.close()
+        shutil.rmtree(self.directory)
+        super(TestOutbox, self).tearDown()
+
+    def test_delivered_messages_are_removed(self):
+        """Ensure that a message is only kept in the outbox until its post succeeds."""
+        self.rocketchat(outbox=self.outbox).post('delivered')
+        self.assertEqual(len(self.outbox), 0)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_shared_database(self):
+        """Ensure that settling a post doesn't hold the write lock of the database other outboxes share."""
+        other = eruption.Outbox(self.path)
+        self.addCleanup(other.close)
+        for status in (200, 500, 404):
+            self.outbox.settle(self.outbox.put('http://localhost', {}, b'{}'), status)
+            self.assertFalse(self.outbox._connection.in_transaction)
+            other.settle(other.put('http://localhost', {}, b'{}'), 200)
+        self.assertEqual(len(other), 1)
+        self.assertEqual(len(other.dead_letters()), 1)
+
+    def test_failed_messages_are_drained(self):
+        """Ensure that messages whose post failed survive a restart and are posted in order by a drain."""
+        self.server.status = 500
+        instance = self.rocketchat(outbox=self.outbox)
+        for index in range(3):
+            instance.post('message {0}'.format(index))
+        self.outbox.close()
+
+        self.outbox = eruption.Outbox(self.path)
+        self.assertEqual(len(self.outbox), 3)
+        self.assertEqual(self.outbox.drain(), (0, 1, 3))
+
+        self.server.status = 200
+        self.assertEqual(self.outbox.drain(), (3, 0, 0))
+        self.assertEqual([payload['text'] for payload in self.server.payloads()[-3:]],
+                         ['message 0', 'message 1', 'message 2'])
+
+    def test_refused_messages_are_buried(self):
+        """Ensure that a message refused for good is moved to the dead letters instead of holding up the others."""
+        self.server.status = 500
+        instance = self.rocketchat(outbox=self.outbox, retries=0)
+        for index in range(3):
+            instance.post('message {0}'.format(index))
+        self.server.status = 200
+        self.server.responses.append((400, {}))
+        self.assertEqual(self.outbox.drain(), (2, 0, 0))
+        self.assertEqual([payload['text'] for payload in self.server.payloads()[-2:]], ['message 1', 'message 2'])
+        self.assertEqual(self.outbox.dead_letters(), [(instance.room_url, 1, 'HTTP 400')])
+
+        self.server.status = 404
+        instance.post('revoked')
+        self.assertEqual(len(self.outbox), 0)
+        self.assertEqual(self.outbox.dead_letters(), [(instance.room_url, 2, 'HTTP 404')])
+
+    def test_cli(self):
+        """Ensure that the outbox command shows and drains the outbox."""
+        self.server.status = 500
+        self.rocketchat(outbox=self.outbox).post('queued')
+        self.server.status = 200
+
+        runner = CliRunner()
+        result = runner.invoke(cli.cli, ['outbox', '--path', self.path, 'show'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('{0}/hooks/...: 1 message(s)'.format(self.server.url), result.output)
+        result = runner.invoke(cli.cli, ['outbox', '--path', self.path, 'drain'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('Sent 1 message(s), 0 remaining.', result.output)
+
+
+class TestMessengerHandler(ServerTestCase):
+    """Tests for posting log records through a Messenger."""
+
+    def setUp(self):
+        super(TestMessengerHandler, self).setUp()
+        self.logger = logging.getLogger('eruption.tests.{0}'.format(self.id()))
+        self.logger.propagate = False
+
+    def handler(self, **kwargs):
+        handler = eruption.MessengerHandler(self.rocketchat(), **kwargs)
+        handler.setFormatter(logging.Formatter('%(levelname)s %(message)s'))
+        self.logger.addHandler(handler)
+        self.addCleanup(self.logger.removeHandler, handler)
+        self.addCleanup(handler.close)
+        return handler
+
+    def test_batches(self):
+        """Ensure that records are logged without waiting and posted together, above the handler's level only."""
+        self.server.delay = 0.5
+        handler = self.handler(batch_window=0.2)
+        start = time.time()
+        self.logger.warning('ignored')
+        for index in range(3):
+            self.logger.error('failure %s', index)
+        self.assertLess(time.time() - start, 0.1)
+        self.assertTrue(handler.flush(timeout=5))
+        self.assertEqual([payload['text'] for payload in self.server.payloads()],
+                         ['ERROR failure 0\nERROR failure 1\nERROR failure 2'])
+
+    def test_length_limit(self):
+        """Ensure that batches are split where they would go over the platform's length limit."""
+        handler = self.handler(batch_window=0.2)
+        handler.instance.max_text_length = 50
+        for index in range(4):
+            self.logger.error('failure number %s', index)
+        handler.flush(timeout=5)
+        self.assertEqual([payload['text'] for payload in self.server.payloads()],
+                         ['ERROR failure number 0\nERROR failure number 1',
+                          'ERROR failure number 2\nERROR failure number 3'])
+
+    def test_rate_limit(self):
+        """Ensure that records over the rate limit are dropped, and that the next post says so."""
+        handler = self.handler(rate_limit=(0.001, 2), batch_window=0.5)
+        for index in range(5):
+            self.logger.error('failure %s', index)
+        handler.flush(timeout=5)
+        self.assertEqual(handler.dropped, 3)
+        self.assertEqual([payload['text'] for payload in self.server.payloads()],
+                         ['ERROR failure 0\nERROR failure 1\n(3 log record(s) dropped)'])
+
+    def test_shutdown(self):
+        """Ensure that closing the handler, as logging.shutdown does, posts the queued records."""
+        handler = self.handler(batch_window=60)
+        self.logger.error('last words')
+        logging.shutdown([weakref.ref(handler)])
+        self.assertEqual([payload['text'] for payload in self.server.payloads()], ['ERROR last words'])
+
+
+class TestRetry(ServerTestCase):
+    """Tests for retries and the circuit breaker."""
+
+    def test_transient_statuses_are_retried(self):
+        """Ensure that a post that gets a 503 is resent after a backoff."""
+        self.server.responses.extend([(503, {}), (502, {})])
+        result = self.rocketchat(retry_backoff=(0.01, 0.01)).post('retried')
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_connection_errors_are_retried(self):
+        """Ensure that a post to a server that is down is retried, then raises the connection error."""
+        instance = self.rocketchat(retries=2, retry_backoff=(0.01, 0.01), circuit_breaker=None)
+        self.server.stop()
+        with self.assertRaises(IOError) as context:
+            instance.post('unreachable')
+        self.assertNotIsInstance(context.exception, eruption.CircuitOpenError)
+        self.server = StubServer()
+
+    def test_read_timeouts_are_not_retried(self):
+        """Ensure that a post that timed out waiting for the response isn't resent, since it may have been posted."""
+        self.server.delay = 0.3
+        instance = self.rocketchat(timeout=0.1, retries=2, retry_backoff=(0.01, 0.01), circuit_breaker=None)
+        with self.assertRaises(IOError):
+            instance.post('slow')
+        time.sleep(0.5)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_circuit_breaker(self):
+        """Ensure that the breaker opens after repeated failures, fails fast while open, and closes after a probe."""
+        self.server.status = 500
+        instance = self.rocketchat(circuit_breaker=(2, 0.2))
+        instance.post('first')
+        instance.post('second')
+        with self.assertRaises(eruption.CircuitOpenError):
+            instance.post('refused')
+        self.assertEqual(len(self.server.requests), 2)
+
+        time.sleep(0.2)
+        self.server.status = 200
+        self.assertEqual(instance.post('probe').status_code, 200)
+        self.assertEqual(instance.get_circuit_breaker().state, 'closed')
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_half_open_allows_one_probe(self):
+        """Ensure that a half-open breaker lets a single probe through, and a failed probe opens it again."""
+        breaker = retry.CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+        breaker.record_failure()
+        self.assertFalse(breaker.allow())
+        time.sleep(0.05)
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, 'open')
+        self.assertFalse(breaker.allow())
+
+
+class TestDedupe(ServerTestCase):
+    """Tests for dropping repeated messages."""
+
+    def test_repeats_are_summarized(self):
+        """Ensure that repeats within the window are dropped, and summarized once it closes."""
+        instance = self.rocketchat(dedupe=0.2)
+        self.assertIsNotNone(instance.post('disk full'))
+        for _ in range(5):
+            self.assertIsNone(instance.post('disk full'))
+        instance.post('disk full', channel='#other')
+        self.assertEqual(len(self.server.requests), 2)
+
+        deadline = time.time() + 5
+        while len(self.server.requests) < 3 and time.time() < deadline:
+            time.sleep(0.02)
+        payloads = self.server.payloads()
+        self.assertEqual(payloads[2]['text'], 'Suppressed 5 identical message(s) in the last 0.2s: disk full')
+        self.assertEqual(payloads[2]['channel'], '#general')
+        self.assertEqual(len(self.server.requests), 3)
+
+        self.assertIsNotNone(instance.post('disk full'))
+        self.assertEqual(len(self.server.requests), 4)
+
+    def test_memory_is_bounded(self):
+        """Ensure that the oldest posts are forgotten, after their summary, once the cache is full."""
+        instance = self.rocketchat(dedupe=60, dedupe_max_entries=3)
+        instance.post('first')
+        instance.post('first')
+        for index in range(3):
+            instance.post('other {0}'.format(index))
+        self.assertEqual(len(instance.deduplicator), 3)
+        self.assertEqual([payload['text'] for payload in self.server.payloads()][-2:],
+                         ['Suppressed 1 identical message(s) in the last 60s: first', 'other 2'])
+
+    def test_one_thread(self):
+        """Ensure that the summaries of many repeated posts are sent by one thread, which ends once they are sent."""
+        sent = []
+        deduplicator = dedupe.Deduplicator(lambda text, overrides: sent.append(text), window=0.2)
+
+        def sweepers():
+            return [thread for thread in threading.enumerate() if thread.name == 'eruption-dedupe']
+
+        for index in range(50):
+            for _ in range(2):
+                deduplicator.suppress('http://localhost', 'alert {0}'.format(index))
+        self.assertEqual(len(sweepers()), 1)
+        deadline = time.time() + 5
+        while (len(sent) < 50 or sweepers()) and time.time() < deadline:
+            time.sleep(0.02)
+        self.assertEqual(len(sent), 50)
+        self.assertEqual(sweepers(), [])
+
+
+class TestTimed(ServerTestCase):
+    """Tests for the timing decorator."""
+
+    def test_summary_per_window(self):
+        """Ensure that calls are summarized in one post per window, errors included."""
+        @eruption.timed(self.rocketchat(), interval=60, every=10)
+        def job(fail):
+            if fail:
+                raise ValueError('failed')
+            return 'done'
+
+        for index in range(9):
+            self.assertEqual(job(False), 'done')
+        with self.assertRaises(ValueError):
+            job(True)
+        self.assertTrue(eruption.flush(timeout=5))
+        self.assertEqual(len(self.server.requests), 1)
+        text = self.server.payloads()[0]['text']
+        self.assertTrue(text.startswith('TestTimed.test_summary_per_window.<locals>.job: 10 call(s) in 0s, 1 error(s) '
+                                        '(10.0%), p50 '), text)
+        self.assertEqual(job.__name__, 'job')
+        self.assertEqual(job.timing.pending, 0)
+
+    def test_threshold(self):
+        """Ensure that windows under the thresholds stay quiet, and the ones over them are posted."""
+        @eruption.timed(self.rocketchat(), interval=60, slow=0.05, name='job')
+        def job(seconds):
+            time.sleep(seconds)
+
+        job(0)
+        job.timing.flush()
+        self.assertEqual(len(self.server.requests), 0)
+        job(0.06)
+        job.timing.flush()
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertTrue(self.server.payloads()[0]['text'].startswith('job: 1 call(s)'))
+
+
+class TestTemplate(ServerTestCase):
+    """Tests for message templates."""
+
+    def test_render(self):
+        """Ensure that templates are formatted from the call of the decorated function."""
+        @eruption.rocketchat(eruption.Template('{name} copied {count} file(s) from {source!r} to {args[1]} in '
+                                               '{elapsed:.0f}s: {result[status]}'), self.rocketchat())
+        def copy(source, destination, count=3):
+            return {'status': 'ok'}
+
+        self.assertEqual(copy('/a', '/b'), {'status': 'ok'})
+        self.assertEqual(self.server.payloads()[0]['text'],
+                         "TestTemplate.test_render.<locals>.copy copied 3 file(s) from '/a' to /b in 0s: ok")
+
+    def test_exception(self):
+        """Ensure that templates referencing the exception are posted when the function raises."""
+        @eruption.rocketchat(eruption.Template('{name} failed: {exception!r}'), self.rocketchat())
+        def fail():
+            raise ValueError('broken')
+
+        with self.assertRaises(ValueError):
+            fail()
+        self.assertTrue(self.server.payloads()[0]['text'].endswith("fail failed: ValueError('broken')"))
+
+    def test_background(self):
+        """Ensure that background posts show the arguments as they were when the decorated function returned."""
+        sender = delivery.BackgroundSender(workers=1)
+        previous = delivery.set_sender(sender)
+        self.addCleanup(lambda: delivery.set_sender(previous).shutdown(timeout=5))
+        release = threading.Event()
+        sender.submit(release.wait, 5)
+
+        @eruption.rocketchat(eruption.Template('{items}'), self.rocketchat(), background=True)
+        def collect(items):
+            return items
+
+        collect(['first']).append('second')
+        release.set()
+        self.assertTrue(eruption.flush(timeout=5))
+        self.assertEqual(self.server.payloads()[0]['text'], "['first']")
+
+    def test_any_poster(self):
+        """Ensure that decorators hand the formatted text to whatever they post with, such as a Broadcaster."""
+        broadcaster = eruption.Broadcaster([self.rocketchat()])
+        self.addCleanup(broadcaster.close)
+
+        @eruption.messenger(eruption.Template('{name} got {result}'), broadcaster)
+        def answer():
+            return 42
+
+        self.assertEqual(answer(), 42)
+        self.assertTrue(self.server.payloads()[0]['text'].endswith('answer got 42'))
+
+    def test_invalid(self):
+        """Ensure that templates are checked when they are created and when the decorator is applied."""
+        with self.assertRaises(ValueError):
+            eruption.Template('positional {0}')
+        with self.assertRaises(ValueError):
+            eruption.rocketchat(eruption.Template('{missing}'), self.rocketchat())(lambda value: value)
+
+
+class TestChunking(ServerTestCase):
+    """Tests for splitting text that is too long for one post."""
+
+    def setUp(self):
+        super(TestChunking, self).setUp()
+        self.text = 'Traceback:\n```python\n{0}```\ndone'.format(
+            ''.join('  File "job.py", line {0}, in step\n'.format(index) for index in range(40)))
+
+    def test_split(self):
+        """Ensure that chunks fit, are numbered, and close and reopen the code blocks they split."""
+        chunks = list(chunking.split(self.text, 200))
+        self.assertGreater(len(chunks), 1)
+        for index, chunk in enumerate(chunks, 1):
+            self.assertLessEqual(len(chunk), 200)
+            self.assertTrue(chunk.startswith('({0}/{1})\n'.format(index, len(chunks))))
+            self.assertEqual(chunk.count('```') % 2, 0)
+        self.assertTrue(chunks[1].split('\n')[1] == '```python')
+        lines = [line for chunk in chunks for line in chunk.split('\n')[1:] if line not in ('```', '```python')]
+        self.assertEqual(lines, [line for line in self.text.split('\n') if line not in ('```', '```python')])
+
+    def test_incremental(self):
+        """Ensure that iterables are split as they are read."""
+        read = []
+
+        def output():
+            for index in range(1000):
+                read.append(index)
+                yield 'line {0}\n'.format(index).encode()
+
+        chunks = chunking.split(output(), 100)
+        self.assertEqual(next(chunks), '(1)\n' + '\n'.join('line {0}'.format(index) for index in range(11)))
+        self.assertLess(len(read), 30)
+        rest = list(chunks)
+        self.assertTrue(rest[-1].startswith('({0}/{0})\n'.format(len(rest) + 1)))
+        self.assertEqual(rest[0].split('\n')[:2], ['(2)', 'line 11'])
+
+    def test_long_lines(self):
+        """Ensure that lines longer than a chunk are cut, at a space where possible."""
+        chunks = list(chunking.split('word ' * 50, 100, numbered=False))
+        self.assertTrue(all(len(chunk) <= 100 and chunk.endswith('word ') for chunk in chunks[:-1]))
+        self.assertEqual(''.join(chunks), 'word ' * 50)
+
+    def test_post(self):
+        """Ensure that posting text over the platform's limit posts its chunks in order over one connection."""
+        instance = self.rocketchat()
+        instance.max_text_length = 200
+        self.assertEqual(instance.post(self.text).status_code, 200)
+        texts = [payload['text'] for payload in self.server.payloads()]
+        self.assertEqual(texts, list(chunking.split(self.text, 200)))
+        self.assertEqual(len(self.server.ports), 1)
+
+    def test_not_text(self):
+        """Ensure that messages that aren't text are posted as they are, without being measured."""
+        self.assertEqual(self.rocketchat().post(42).status_code, 200)
+        self.assertEqual(self.server.payloads()[0]['text'], 42)
+
+    def test_broadcast(self):
+        """Ensure that broadcasts post text over a target's limit in chunks, and whole to the other targets."""
+        limited = self.rocketchat()
+        limited.max_text_length = 200
+        unlimited = eruption.Mattermost(token='other', base_url=self.server.base_url)
+        with eruption.Broadcaster([limited, unlimited]) as broadcaster:
+            results = broadcaster.post(self.text)
+        self.assertEqual([result.response.status_code for result in results], [200, 200])
+        texts = sorted(payload['text'] for payload in self.server.payloads())
+        self.assertEqual(texts, sorted(list(chunking.split(self.text, 200)) + [self.text]))
+
+    @unittest.skipIf(aio is None, 'aiohttp is not installed')
+    def test_async_post(self):
+        """Ensure that async posts of text over the platform's limit post its chunks in order."""
+        instance = aio.AsyncRocketChat(base_url=self.server.base_url, token='token')
+        instance.max_text_length = 200
+
+        async def post():
+            try:
+                return await instance.post(self.text)
+            finally:
+                await aio.close_async_sessions()
+
+        self.assertEqual(asyncio.run(post()).status, 200)
+        texts = [payload['text'] for payload in self.server.payloads()]
+        self.assertEqual(texts, list(chunking.split(self.text, 200)))
+
+
+class TestRelay(ServerTestCase):
+    """Tests for posting through the relay daemon."""
+
+    def setUp(self):
+        super(TestRelay, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'relay.sock')
+        self.relay = relay.Relay(self.path, allowed_hosts=[self.server.base_url]).start()
+
+    def tearDown(self):
+        self.relay.stop(timeout=5)
+        relay.get_client(self.path).close()
+        shutil.rmtree(self.directory)
+        super(TestRelay, self).tearDown()
+
+    def test_posts_are_forwarded(self):
+        """Ensure that posts in relay mode are forwarded in order over one pooled connection."""
+        instance = self.rocketchat(relay=self.path)
+        for index in range(20):
+            self.assertIsNone(instance.post('relayed {0}'.format(index)))
+        deadline = time.time() + 5
+        while len(self.server.requests) < 20 and time.time() < deadline:
+            time.sleep(0.02)
+        self.assertEqual([payload['text'] for payload in self.server.payloads()],
+                         ['relayed {0}'.format(index) for index in range(20)])
+        self.assertEqual(len(self.server.ports), 1)
+        self.assertEqual(self.server.requests[0][1]['Authorization'], 'Bearer token')
+
+    def test_unreachable_relay(self):
+        """Ensure that posts are sent directly when the relay can't be reached."""
+        self.relay.stop()
+        result = self.rocketchat(relay=self.path).post('direct')
+        self.assertEqual(result.status_code, 200)
+
+    def wait_for(self, condition):
+        deadline = time.time() + 5
+        while not condition() and time.time() < deadline:
+            time.sleep(0.02)
+
+    def test_hosts_are_allowed(self):
+        """Ensure that the relay only forwards to the allowed hosts."""
+        self.relay.allowed_hosts = relay.DEFAULT_ALLOWED_HOSTS
+        self.assertIsNone(self.rocketchat(relay=self.path).post('not allowed'))
+        self.wait_for(lambda: self.relay.dropped)
+        self.assertEqual(self.relay.dropped, 1)
+        self.assertEqual(len(self.server.requests), 0)
+
+    def test_idle_lanes_are_retired(self):
+        """Ensure that the thread forwarding to a url stops once no posts have come in for a while."""
+        previous, relay.LANE_IDLE_TIMEOUT = relay.LANE_IDLE_TIMEOUT, 0.1
+        try:
+            self.rocketchat(relay=self.path).post('relayed')
+            self.wait_for(lambda: self.server.requests)
+            self.wait_for(lambda: not self.relay._lanes)
+            self.assertEqual(self.relay._lanes, {})
+            self.rocketchat(relay=self.path).post('relayed again')
+            self.wait_for(lambda: len(self.server.requests) == 2)
+            self.assertEqual(len(self.server.requests), 2)
+        finally:
+            relay.LANE_IDLE_TIMEOUT = previous
+
+    def test_socket_is_only_replaced_when_stale(self):
+        """Ensure that starting a relay refuses to take over a running relay's socket or anything else in its place."""
+        with self.assertRaises(IOError):
+            relay.Relay(self.path).start()
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+
+        # What a relay that was killed leaves behind, a socket nothing listens on.
+        self.relay.stop(timeout=5)
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(self.path)
+        stale.close()
+        self.relay = relay.Relay(self.path, allowed_hosts=[self.server.base_url]).start()
+        self.assertIsNone(self.rocketchat(relay=self.path).post('restarted'))
+        self.wait_for(lambda: self.server.requests)
+        self.assertEqual(len(self.server.requests), 1)
+
+        other = os.path.join(self.directory, 'other.sock')
+        with open(other, 'w'):
+            pass
+        with self.assertRaises(IOError):
+            relay.Relay(other).start()
+        self.assertTrue(os.path.isfile(other))
+
+    def test_platforms_without_user_ids(self):
+        """Ensure that the command line and the relay module can be imported where there are no user ids."""
+        code = ('import os, sys\n'
+                'del os.getuid\n'
+                'os.environ.pop("XDG_RUNTIME_DIR", None)\n'
+                'from eruption import cli\n'
+                'print("eruption.relay" in sys.modules)\n'
+                'from eruption import relay\n')
+        self.assertEqual(subprocess.check_output([sys.executable, '-c', code]).strip(), b'False')
+
+    def test_private_directory(self):
+        """Ensure that a directory other users can open isn't trusted with the relay's socket."""
+        os.chmod(self.directory, 0o755)
+        with self.assertRaises(IOError):
+            relay._check_private_directory(self.directory)
+        os.chmod(self.directory, 0o700)
+        relay._check_private_directory(self.directory)
+
+    def test_frames(self):
+        """Ensure that frames split across reads are only decoded once complete."""
+        frame = relay.encode(b'{"url":"http://localhost"}', b'{"text":"framed"}')
+        buffer = bytearray(frame + frame[:5])
+        self.assertEqual(relay.decode(buffer), [({'url': 'http://localhost'}, b'{"text":"framed"}')])
+        self.assertEqual(relay.decode(buffer), [])
+        buffer.extend(frame[5:])
+        self.assertEqual(len(relay.decode(buffer)), 1)
+        self.assertEqual(buffer, bytearray())
+
+
+@unittest.skipUnless(hasattr(os, 'register_at_fork'), 'os.register_at_fork is not available')
+class TestFork(ServerTestCase):
+    """Tests for posting from forked children."""
+
+    def setUp(self):
+        super(TestFork, self).setUp()
+        self.previous_sender = delivery.set_sender(delivery.BackgroundSender(workers=1))
+
+    def tearDown(self):
+        delivery.set_sender(self.previous_sender).shutdown(timeout=5)
+        super(TestFork, self).tearDown()
+
+    def test_child_gets_its_own_state(self):
+        """Ensure that a child connects on its own, and that what the parent queued is sent once, by the parent."""
+        instance = self.rocketchat()
+        instance.post('parent')
+        parent_session = instance.get_session()
+        self.server.delay = 0.2
+        for index in range(3):
+            instance.submit('queued {0}'.format(index))
+
+        read, write = os.pipe()
+        pid = os.fork()
+        if not pid:
+            status = 1
+            try:
+                os.close(read)
+                child_session = instance.get_session()
+                pending = delivery.get_sender().pending
+                response = instance.post('child')
+                os.write(write, json.dumps([child_session is parent_session, pending, response.status_code]).encode())
+                status = 0
+            finally:
+                os._exit(status)
+        os.close(write)
+        with os.fdopen(read) as pipe:
+            reused_session, pending, status = json.loads(pipe.read())
+        os.waitpid(pid, 0)
+
+        self.assertFalse(reused_session)
+        self.assertEqual(pending, 0)
+        self.assertEqual(status, 200)
+        self.assertTrue(eruption.flush(timeout=5))
+        self.assertEqual(sorted(payload['text'] for payload in self.server.payloads()),
+                         ['child', 'parent', 'queued 0', 'queued 1', 'queued 2'])
+
+
+class TestUpload(ServerTestCase):
+    """Tests for streaming file uploads."""
+
+    def setUp(self):
+        super(TestUpload, self).setUp()
+        handle, self.path = tempfile.mkstemp(suffix='.log')
+        self.content = b''.join(b'line %d of the build log\n' % index for index in range(20000))
+        with os.fdopen(handle, 'wb') as log:
+            log.write(self.content)
+
+    def tearDown(self):
+        os.remove(self.path)
+        super(TestUpload, self).tearDown()
+
+    def parts(self, request):
+        _, headers, body = request
+        content_type = dict((key.lower(), value) for key, value in headers.items())['content-type']
+        header = 'Content-Type: {0}\r\n\r\n'.format(content_type).encode()
+        message = email.parser.BytesParser().parsebytes(header + body)
+        return dict((part.get_param('name', header='content-disposition'), part) for part in message.get_payload())
+
+    def test_discord(self):
+        """Ensure that Discord files are posted as multipart attachments along with the payload."""
+        instance = eruption.Discord(room_id='room', token='token', url_template=self.server.url + '/{room_id}/{token}')
+        self.assertEqual(instance.post_file(self.path, message='Build failed').status_code, 200)
+        parts = self.parts(self.server.requests[0])
+        self.assertEqual(json.loads(parts['payload_json'].get_payload()),
+                         {'content': 'Build failed', 'username': 'David Bowie'})
+        self.assertEqual(parts['files[0]'].get_filename(), os.path.basename(self.path))
+        self.assertEqual(parts['files[0]'].get_payload(decode=True), self.content)
+
+    def test_gzip(self):
+        """Ensure that files can be gzipped on the way."""
+        instance = eruption.Discord(room_id='room', token='token', url_template=self.server.url + '/{room_id}/{token}')
+        with open(self.path, 'rb') as log:
+            instance.post_file(log, filename='build.log', gzip=True)
+        attachment = self.parts(self.server.requests[0])['files[0]']
+        self.assertEqual(attachment.get_filename(), 'build.log.gz')
+        self.assertEqual(gzip.decompress(attachment.get_payload(decode=True)), self.content)
+        self.assertLess(int(self.server.requests[0][1]['Content-Length']), len(self.content) / 4)
+
+    def test_slack(self):
+        """Ensure that Slack files go through the external upload flow."""
+        self.server.bodies.extend([
+            json.dumps({'ok': True, 'upload_url': self.server.url + '/upload/1', 'file_id': 'F1'}).encode(),
+            b'OK',
+            b'{"ok": true}'
+        ])
+        instance = eruption.Slack(room_id='room', token='token', channel='channel', bot_token='bot',
+                                  channel_id='C1', api_url=self.server.url + '/api/')
+        self.assertEqual(instance.post_file(self.path, message='Build failed', title='Log').status_code, 200)
+        ticket, uploaded, completed = self.server.requests
+        self.assertEqual(ticket[0], '/api/files.getUploadURLExternal')
+        self.assertEqual(ticket[1]['Authorization'], 'Bearer bot')
+        self.assertIn('length={0}'.format(len(self.content)).encode(), ticket[2])
+        self.assertEqual(uploaded[0], '/upload/1')
+        self.assertNotIn('Authorization', uploaded[1])
+        self.assertEqual(self.parts(uploaded)['file'].get_payload(decode=True), self.content)
+        self.assertEqual(json.loads(completed[2].decode()), {
+            'files': [{'id': 'F1', 'title': 'Log'}], 'channel_id': 'C1', 'initial_comment': 'Build failed'})
+
+    def test_slack_error(self):
+        """Ensure that an upload the Slack API refuses raises."""
+        self.server.bodies.append(b'{"ok": false, "error": "not_authed"}')
+        instance = eruption.Slack(room_id='room', token='token', channel='channel', bot_token='bot',
+                                  api_url=self.server.url + '/api/')
+        with self.assertRaises(eruption.UploadError) as context:
+            instance.post_file(self.path)
+        self.assertEqual(context.exception.error, 'not_authed')
+
+
+class TestMetrics(ServerTestCase):
+    """Tests for the delivery instrumentation."""
+
+    def setUp(self):
+        super(TestMetrics, self).setUp()
+        metrics.get_registry().clear()
+        metrics.enable()
+
+    def tearDown(self):
+        metrics.disable()
+        metrics.get_registry().clear()
+        super(TestMetrics, self).tearDown()
+
+    def test_disabled(self):
+        """Ensure that nothing is recorded while instrumentation is disabled."""
+        metrics.disable()
+        self.rocketchat().post('quiet')
+        self.assertEqual(metrics.to_prometheus(), '')
+
+    def test_post_metrics(self):
+        """Ensure that a post records its serialize time, latency, size and status, labeled without its token."""
+        seen = []
+
+        def hook(name, labels, value):
+            seen.append(name)
+
+        metrics.add_hook(hook)
+        try:
+            self.server.responses.append((429, {'Retry-After': '0'}))
+            self.rocketchat(rate_limit=(100, 1)).post('measured')
+        finally:
+            metrics.remove_hook(hook)
+        labels = (('messenger', 'RocketChat'), ('endpoint', self.server.base_url))
+        histograms = metrics.get_registry().histograms()
+        counters = metrics.get_registry().counters()
+        self.assertEqual(histograms[('request_seconds', labels)].count, 1)
+        self.assertEqual(histograms[('serialize_seconds', labels)].count, 1)
+        self.assertEqual(histograms[('payload_bytes', labels)].sum, len(self.rocketchat()._process_data('measured')))
+        self.assertEqual(counters[('responses_total', labels + (('status', '200'),))], 1)
+        self.assertEqual(counters[('retries_total', labels)], 1)
+        self.assertEqual(set(seen), {'serialize_seconds', 'request_seconds', 'payload_bytes', 'responses_total',
+                                     'retries_total'})
+
+        text = metrics.to_prometheus()
+        self.assertIn('# TYPE eruption_request_seconds histogram', text)
+        self.assertIn('eruption_responses_total{{messenger="RocketChat",endpoint="{0}",status="200"}} 1'.format(
+            self.server.base_url), text)
+        self.assertNotIn('token', text)
+        self.assertIn('RocketChat {0}: 1 posts, 0 failed'.format(self.server.base_url), metrics.summary()[0])
+
+    def test_queue_wait(self):
+        """Ensure that background posts record how long they waited in the queue."""
+        sender = delivery.BackgroundSender(workers=1)
+        instance = self.rocketchat()
+        sender.submit(instance.post, 'queued').result(timeout=5)
+        sender.shutdown()
+        labels = (('messenger', 'RocketChat'), ('endpoint', self.server.base_url))
+        self.assertEqual(metrics.get_registry().histograms()[('queue_wait_seconds', labels)].count, 1)
+
+    def test_histogram_quantiles(self):
+        """Ensure that quantile estimates stay within a bucket of the exact ones."""
+        histogram = metrics.Histogram.exponential(0.001, 1.25, 40)
+        for value in range(1, 1001):
+            histogram.observe(value / 1000.0)
+        for fraction in (0.5, 0.95, 0.99):
+            self.assertAlmostEqual(histogram.quantile(fraction), fraction, delta=fraction * 0.25)
+        self.assertEqual(histogram.quantile(1.0), 1.0)
+
+
+@unittest.skipIf(aio is None, 'aiohttp is not installed')
+class TestAsyncMessenger(ServerTestCase):
+    """Tests for the asyncio Messenger family."""
+
+    def run_async(self, coroutine_function):
+        async def run():
+            try:
+                return await coroutine_function()
+            finally:
+                await aio.close_async_sessions()
+        return asyncio.run(run())
+
+    def test_post(self):
+        """Ensure that awaiting post sends the same payload as the blocking class."""
+        instance = aio.AsyncRocketChat(base_url=self.server.base_url, token='token')
+        result = self.run_async(lambda: instance.post('async'))
+        self.assertEqual(result.status, 200)
+        self.assertEqual(self.server.requests[0][2], self.rocketchat()._process_data('async'))
+
+    def test_post_many(self):
+        """Ensure that post_many posts every message over pooled connections and keeps the results in order."""
+        instance = aio.AsyncMattermost(token='token', base_url=self.server.base_url)
+        messages = ['message {0}'.format(index) for index in range(20)]
+        results = self.run_async(lambda: instance.post_many(messages, concurrency=4))
+        self.assertEqual([result.status for result in results], [200] * 20)
+        self.assertEqual(sorted(payload['text'] for payload in self.server.payloads()), sorted(messages))
+        self.assertLessEqual(len(self.server.ports), 4)
+
+    def test_pipeline(self):
+        """Ensure that async posts are rate limited, retried and time out like blocking ones."""
+        instance = aio.AsyncRocketChat(base_url=self.server.base_url, token='token', rate_limit=(20, 2),
+                                       retry_backoff=(0.01, 0.01))
+
+        async def run():
+            start = time.time()
+            for index in range(6):
+                await instance.post('message {0}'.format(index))
+            return time.time() - start
+
+        self.assertGreaterEqual(self.run_async(run), 0.19)
+        self.assertEqual(len(self.server.requests), 6)
+
+        self.server.responses.extend([(503, {}), (502, {})])
+        self.assertEqual(self.run_async(lambda: instance.post('retried')).status, 200)
+        self.assertEqual(len(self.server.requests), 9)
+
+        self.server.delay = 0.5
+        hung = aio.AsyncRocketChat(base_url=self.server.base_url, token='token', timeout=0.1, retries=0,
+                                   url_template='http://{base_url}/hooks/hung/{token}')
+        with self.assertRaises(asyncio.TimeoutError):
+            self.run_async(lambda: hung.post('hung'))
+
+    def test_coalesce(self):
+        """Ensure that async posts are coalesced, and the merged payload is sent on the loop they were posted from."""
+        instance = aio.AsyncRocketChat(base_url=self.server.base_url, token='token', coalesce=0.2)
+
+        async def run():
+            for index in range(5):
+                self.assertIsNone(await instance.post('message {0}'.format(index)))
+            await asyncio.sleep(0.3)
+            return await eruption.flush_async(timeout=5)
+
+        self.assertTrue(self.run_async(run))
+        self.assertEqual([payload['text'] for payload in self.server.payloads()],
+                         ['\n'.join('message {0}'.format(index) for index in range(5))])
+
+    def test_session_pool(self):
+        """Ensure that the pool hands out a session per loop, and lets go of the sessions of closed loops."""
+        pool = aio.AsyncSessionPool()
+        instance = aio.AsyncRocketChat(base_url=self.server.base_url, token='token', session_pool=pool)
+
+        async def get():
+            return instance.get_session(instance.room_url)
+
+        first = asyncio.run(get())
+        self.assertEqual(len(pool), 1)
+        second = asyncio.run(get())
+        self.assertIsNot(first, second)
+        self.assertEqual(len(pool), 1)
+
+    def test_post_file(self):
+        """Ensure that async instances upload files over the blocking sessions, without blocking the event loop."""
+        handle, path = tempfile.mkstemp(suffix='.log')
+        self.addCleanup(os.remove, path)
+        with os.fdopen(handle, 'wb') as log:
+            log.write(b'build log')
+        instance = aio.AsyncDiscord(room_id='room', token='token', url_template=self.server.url + '/{room_id}/{token}')
+        result = self.run_async(lambda: instance.post_file(path, message='Build failed'))
+        self.assertEqual(result.status_code, 200)
+        self.assertIn(b'build log', self.server.requests[0][2])
+        self.assertIn(b'Build failed', self.server.requests[0][2])
+
+    def test_decorated_coroutine(self):
+        """Ensure that decorated coroutine functions are awaited before posting, and don't wait for the post."""
+        self.server.delay = 0.5
+        calls = []
+
+        @eruption.rocketchat('done', self.rocketchat())
+        async def blocking_instance():
+            calls.append('blocking')
+            return 'blocking'
+
+        @eruption.rocketchat('done', aio.AsyncRocketChat(base_url=self.server.base_url, token='token'))
+        async def async_instance():
+            calls.append('async')
+            return 'async'
+
+        async def run():
+            start = time.time()
+            results = await asyncio.gather(blocking_instance(), async_instance())
+            elapsed = time.time() - start
+            return results, elapsed, await eruption.flush_async(timeout=5)
+
+        results, elapsed, flushed = self.run_async(run)
+        self.assertEqual(results, ['blocking', 'async'])
+        self.assertEqual(calls, ['blocking', 'async'])
+        self.assertLess(elapsed, 0.4)
+        self.assertTrue(flushed)
+        self.assertEqual([payload['text'] for payload in self.server.payloads()], ['done', 'done'])
+
+    def test_timed_coroutine(self):
+        """Ensure that timed records the awaited duration of coroutine functions."""
+        @eruption.timed(self.rocketchat(), every=100)
+        async def wait():
+            await asyncio.sleep(0.05)
+
+        self.run_async(wait)
+        self.assertEqual(wait.timing.pending, 1)
+        self.assertGreaterEqual(wait.timing._histogram.max, 0.05)
+        wait.timing.flush()
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_timed_async_instance(self):
+        """Ensure that timing summaries are posted on the loop of an AsyncMessenger, which only times coroutines."""
+        instance = aio.AsyncRocketChat(base_url=self.server.base_url, token='token')
+
+        @eruption.timed(instance, every=100)
+        async def wait():
+            await asyncio.sleep(0.01)
+
+        async def run():
+            await wait()
+            wait.timing.flush()
+            await asyncio.sleep(0)
+            return await eruption.flush_async(timeout=5)
+
+        self.assertTrue(self.run_async(run))
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertTrue(self.server.payloads()[0]['text'].startswith('{0}: 1 call(s)'.format(wait.__qualname__)))
+        with self.assertRaises(TypeError):
+            eruption.timed(instance)(lambda: None)
+
+    def test_decorated_functions_are_coroutines(self):
+        """Ensure that an AsyncMessenger can't be given to the decorator of a function that can't await its posts."""
+        instance = aio.AsyncRocketChat(base_url=self.server.base_url, token='token')
+        with self.assertRaises(TypeError):
+            eruption.rocketchat('done', instance)(lambda: None)
+        with self.assertRaises(TypeError):
+            eruption.rocketchat('done', instance, background=True)(lambda: None)
+
+    def test_asyncio_is_imported_lazily(self):
+        """Ensure that importing the blocking classes doesn't import asyncio, which only the async posts need."""
+        output = subprocess.check_output(
+            [sys.executable, '-c', 'import sys, eruption; print("asyncio" in sys.modules)'])
+        self.assertEqual(output.strip(), b'False')
+
+
+if __name__ == '__main__':
+    unittest.main()